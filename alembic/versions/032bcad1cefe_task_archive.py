@@ -0,0 +1,80 @@
+"""Archive tables for finished tasks
+
+Revision ID: 032bcad1cefe
+Revises: f7b0e48c3b13
+Create Date: 2020-11-30 15:21:07.863152
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '032bcad1cefe'
+down_revision = 'f7b0e48c3b13'
+branch_labels = None
+depends_on = None
+
+DONE_STATUSES = (
+    "('finished', 'failed', 'superseded', 'cancelled', 'timed_out')"
+)
+
+
+def upgrade():
+    status = postgresql.ENUM(name='status', create_type=False)
+    jsonb = postgresql.JSONB(astext_type=sa.Text())
+
+    # Колонки совпадают с tasks и task_reports: строки переносятся целиком
+    op.create_table(
+        'tasks_archive',
+        sa.Column('task_id', postgresql.UUID(), nullable=False),
+        sa.Column('status', status, nullable=False),
+        sa.Column('script', sa.String(), nullable=False),
+        sa.Column('type', sa.String(), nullable=False),
+        sa.Column('locked_by', sa.String(), nullable=True),
+        sa.Column('locked_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('args', jsonb, nullable=True),
+        sa.Column('result', jsonb, nullable=True),
+        sa.Column('errortext', sa.String(), nullable=True),
+        sa.Column('meta', jsonb, nullable=False),
+        sa.Column('extra', jsonb, nullable=True),
+        sa.Column('created', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('updated', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('lease_expires', sa.DateTime(timezone=True),
+                  nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('priority', sa.Integer(), nullable=False),
+        sa.Column('coalesce_key', sa.String(), nullable=True),
+        sa.Column('timeout', sa.Integer(), nullable=True),
+        sa.Column('cancel_requested', sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint('task_id'),
+    )
+    op.create_table(
+        'task_reports_archive',
+        sa.Column('id', sa.BigInteger(), autoincrement=False,
+                  nullable=False),
+        sa.Column('task_id', postgresql.UUID(), nullable=False),
+        sa.Column('status', status, nullable=False),
+        sa.Column('meta', jsonb, nullable=False),
+        sa.Column('created', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(
+        'task_reports_archive_task_id_index', 'task_reports_archive',
+        ['task_id'],
+    )
+
+    # Индекс под выборку завершенных задач для переноса в архив
+    op.create_index(
+        'tasks_done_created_index', 'tasks', ['created'],
+        postgresql_where=sa.text("status IN %s" % DONE_STATUSES),
+    )
+
+
+def downgrade():
+    op.drop_index('tasks_done_created_index', table_name='tasks')
+    op.drop_index('task_reports_archive_task_id_index',
+                  table_name='task_reports_archive')
+    op.drop_table('task_reports_archive')
+    op.drop_table('tasks_archive')
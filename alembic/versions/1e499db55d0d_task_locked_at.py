@@ -0,0 +1,31 @@
+"""Task claim time for host capacity limits
+
+Revision ID: 1e499db55d0d
+Revises: b41a25519dfa
+Create Date: 2020-11-25 12:18:55.402713
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1e499db55d0d'
+down_revision = 'b41a25519dfa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tasks', sa.Column(
+        'locked_at', sa.DateTime(timezone=True), nullable=True
+    ))
+    # Индекс под подсчет задач обработчиков при проверке ограничений выборки
+    op.create_index(
+        'tasks_locked_index', 'tasks', ['locked_by', 'locked_at'],
+    )
+
+
+def downgrade():
+    op.drop_index('tasks_locked_index', table_name='tasks')
+    op.drop_column('tasks', 'locked_at')
@@ -0,0 +1,46 @@
+"""Write task status history with a trigger
+
+Revision ID: 225136e02db5
+Revises: 032bcad1cefe
+Create Date: 2020-12-02 10:14:36.502917
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '225136e02db5'
+down_revision = '032bcad1cefe'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # История статусов пишется только при смене статуса, в той же
+    # транзакции и для любых изменений: ORM, массовых UPDATE и asyncpg.
+    op.execute("""
+        CREATE OR REPLACE FUNCTION tasks_report_status() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO task_reports (task_id, status)
+                VALUES (NEW.task_id, NEW.status);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    op.execute("""
+        CREATE TRIGGER tasks_report_status_trigger
+            AFTER UPDATE OF status ON tasks
+            FOR EACH ROW
+            WHEN (OLD.status IS DISTINCT FROM NEW.status)
+            EXECUTE PROCEDURE tasks_report_status();
+    """)
+    # Индекс под выборку истории задачи (task.progress, перенос в архив)
+    op.create_index(
+        'task_reports_task_id_index', 'task_reports', ['task_id'],
+    )
+
+
+def downgrade():
+    op.drop_index('task_reports_task_id_index', table_name='task_reports')
+    op.execute("DROP TRIGGER tasks_report_status_trigger ON tasks")
+    op.execute("DROP FUNCTION tasks_report_status()")
@@ -0,0 +1,48 @@
+"""Notify workers about enqueued tasks
+
+Revision ID: 4b65ecf9b6c2
+Revises: ece0bd5a0e49
+Create Date: 2020-11-02 11:40:12.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b65ecf9b6c2'
+down_revision = 'ece0bd5a0e49'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Канал должен совпадать с settings.TASK_NOTIFY_CHANNEL, в payload
+    # передается тип задачи, чтобы будить только нужных обработчиков.
+    op.execute("""
+        CREATE OR REPLACE FUNCTION tasks_notify_enqueued()
+            RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('tasks_enqueued', NEW.type);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    op.execute("""
+        CREATE TRIGGER tasks_notify_enqueued_trigger
+            AFTER INSERT OR UPDATE OF status ON tasks
+            FOR EACH ROW
+            WHEN (NEW.status = 'enqueued')
+            EXECUTE PROCEDURE tasks_notify_enqueued();
+    """)
+    # Индекс под выборку очередной задачи обработчиком
+    op.create_index(
+        'tasks_enqueued_index', 'tasks', ['type', 'created'],
+        postgresql_where=sa.text("status = 'enqueued'"),
+    )
+
+
+def downgrade():
+    op.drop_index('tasks_enqueued_index', table_name='tasks')
+    op.execute("DROP TRIGGER tasks_notify_enqueued_trigger ON tasks")
+    op.execute("DROP FUNCTION tasks_notify_enqueued()")
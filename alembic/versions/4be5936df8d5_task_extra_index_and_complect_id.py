@@ -0,0 +1,70 @@
+"""GIN index on task extra and complect_id column
+
+Revision ID: 4be5936df8d5
+Revises: 90c73de3521a
+Create Date: 2020-12-11 14:36:22.904117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4be5936df8d5'
+down_revision = '90c73de3521a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Фильтр task.list по extra - один предикат extra @> '{...}'
+    op.create_index(
+        'tasks_extra_index', 'tasks', ['extra'],
+        postgresql_using='gin',
+        postgresql_ops={'extra': 'jsonb_path_ops'},
+        postgresql_where=sa.text('extra IS NOT NULL'),
+    )
+
+    # Копия extra->>'complect_id' для списка задач комплекта по btree-индексу.
+    # Колонку заполняет триггер, код пишет только extra.
+    op.add_column('tasks', sa.Column('complect_id', sa.String(),
+                                     nullable=True))
+    op.add_column('tasks_archive', sa.Column('complect_id', sa.String(),
+                                             nullable=True))
+    op.execute("""
+        CREATE OR REPLACE FUNCTION tasks_set_complect_id()
+            RETURNS trigger AS $$
+        BEGIN
+            NEW.complect_id := NEW.extra ->> 'complect_id';
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    op.execute("""
+        CREATE TRIGGER tasks_set_complect_id_trigger
+            BEFORE INSERT OR UPDATE OF extra ON tasks
+            FOR EACH ROW
+            EXECUTE PROCEDURE tasks_set_complect_id();
+    """)
+    op.execute("""
+        UPDATE tasks SET complect_id = extra ->> 'complect_id'
+        WHERE extra ? 'complect_id'
+    """)
+    op.execute("""
+        UPDATE tasks_archive SET complect_id = extra ->> 'complect_id'
+        WHERE extra ? 'complect_id'
+    """)
+    op.create_index(
+        'tasks_complect_id_index', 'tasks',
+        ['type', 'complect_id', 'created', 'task_id'],
+        postgresql_where=sa.text('complect_id IS NOT NULL'),
+    )
+
+
+def downgrade():
+    op.drop_index('tasks_complect_id_index', table_name='tasks')
+    op.execute("DROP TRIGGER tasks_set_complect_id_trigger ON tasks")
+    op.execute("DROP FUNCTION tasks_set_complect_id()")
+    op.drop_column('tasks_archive', 'complect_id')
+    op.drop_column('tasks', 'complect_id')
+    op.drop_index('tasks_extra_index', table_name='tasks')
@@ -0,0 +1,37 @@
+"""Store full task outputs compressed in a separate table
+
+Revision ID: 63bf93d3de59
+Revises: b42144ebcbd1
+Create Date: 2020-12-07 12:27:45.190374
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '63bf93d3de59'
+down_revision = 'b42144ebcbd1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'task_outputs',
+        sa.Column('task_id', postgresql.UUID(), nullable=False),
+        sa.Column('data', sa.LargeBinary(), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=False),
+        sa.Column('created', sa.DateTime(timezone=True),
+                  server_default=sa.text('now()'), nullable=False),
+        sa.PrimaryKeyConstraint('task_id'),
+    )
+    # Данные уже сжаты, повторное сжатие TOAST бесполезно
+    op.execute(
+        "ALTER TABLE task_outputs ALTER COLUMN data SET STORAGE EXTERNAL"
+    )
+
+
+def downgrade():
+    op.drop_table('task_outputs')
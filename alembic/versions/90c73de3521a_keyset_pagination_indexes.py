@@ -0,0 +1,33 @@
+"""Indexes for cursor pagination of tasks and complect revisions
+
+Revision ID: 90c73de3521a
+Revises: 63bf93d3de59
+Create Date: 2020-12-09 11:48:03.615027
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '90c73de3521a'
+down_revision = '63bf93d3de59'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Страница списка находится по индексу без пропуска предыдущих строк
+    op.create_index(
+        'tasks_type_created_index', 'tasks',
+        ['type', 'created', 'task_id'],
+    )
+    op.create_index(
+        'complects_revisions_complect_created_index', 'complects_revisions',
+        ['complect_id', 'created', 'revision_id'],
+    )
+
+
+def downgrade():
+    op.drop_index('complects_revisions_complect_created_index',
+                  table_name='complects_revisions')
+    op.drop_index('tasks_type_created_index', table_name='tasks')
@@ -0,0 +1,36 @@
+"""Task leases
+
+Revision ID: aba0c1f0b193
+Revises: 4b65ecf9b6c2
+Create Date: 2020-11-09 15:21:47.530112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'aba0c1f0b193'
+down_revision = '4b65ecf9b6c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tasks', sa.Column(
+        'lease_expires', sa.DateTime(timezone=True), nullable=True
+    ))
+    op.add_column('tasks', sa.Column(
+        'attempts', sa.Integer(), server_default='0', nullable=False
+    ))
+    # Индекс под поиск задач с истекшей арендой
+    op.create_index(
+        'tasks_lease_expires_index', 'tasks', ['lease_expires'],
+        postgresql_where=sa.text("status = 'working'"),
+    )
+
+
+def downgrade():
+    op.drop_index('tasks_lease_expires_index', table_name='tasks')
+    op.drop_column('tasks', 'attempts')
+    op.drop_column('tasks', 'lease_expires')
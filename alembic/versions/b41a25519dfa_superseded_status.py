@@ -0,0 +1,29 @@
+"""Superseded task status
+
+Revision ID: b41a25519dfa
+Revises: d35e07bc8996
+Create Date: 2020-11-20 16:34:19.885210
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b41a25519dfa'
+down_revision = 'd35e07bc8996'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # ALTER TYPE ... ADD VALUE нельзя выполнять внутри транзакции
+    op.execute("COMMIT")
+    op.execute("ALTER TYPE status ADD VALUE IF NOT EXISTS 'superseded'")
+
+
+def downgrade():
+    # Значение из enum postgres не удаляется, задачи переводятся в failed
+    op.execute("UPDATE tasks SET status = 'failed' "
+               "WHERE status = 'superseded'")
+    op.execute("UPDATE task_reports SET status = 'failed' "
+               "WHERE status = 'superseded'")
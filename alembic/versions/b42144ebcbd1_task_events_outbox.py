@@ -0,0 +1,59 @@
+"""Outbox of task status notifications
+
+Revision ID: b42144ebcbd1
+Revises: 225136e02db5
+Create Date: 2020-12-04 16:02:51.730448
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b42144ebcbd1'
+down_revision = '225136e02db5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'task_events',
+        sa.Column('id', sa.BigInteger(), autoincrement=True,
+                  nullable=False),
+        sa.Column('task_id', postgresql.UUID(), nullable=False),
+        sa.Column('type', sa.String(), nullable=False),
+        sa.Column('status', postgresql.ENUM(name='status', create_type=False),
+                  nullable=False),
+        sa.Column('created', sa.DateTime(timezone=True),
+                  server_default=sa.text('now()'), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+    # Уведомление пишется в той же транзакции, что и смена статуса, NOTIFY
+    # доставляется после ее фиксации. Канал должен совпадать с
+    # settings.TASK_EVENTS_CHANNEL.
+    op.execute("""
+        CREATE OR REPLACE FUNCTION tasks_outbox_status() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO task_events (task_id, type, status)
+                VALUES (NEW.task_id, NEW.type, NEW.status);
+            PERFORM pg_notify('task_events', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    op.execute("""
+        CREATE TRIGGER tasks_outbox_status_trigger
+            AFTER UPDATE OF status ON tasks
+            FOR EACH ROW
+            WHEN (OLD.status IS DISTINCT FROM NEW.status)
+            EXECUTE PROCEDURE tasks_outbox_status();
+    """)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER tasks_outbox_status_trigger ON tasks")
+    op.execute("DROP FUNCTION tasks_outbox_status()")
+    op.drop_table('task_events')
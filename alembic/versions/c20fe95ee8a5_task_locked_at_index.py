@@ -0,0 +1,25 @@
+"""Index recent claims for fair share ordering
+
+Revision ID: c20fe95ee8a5
+Revises: 4be5936df8d5
+Create Date: 2020-12-14 10:52:17.338215
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c20fe95ee8a5'
+down_revision = '4be5936df8d5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Справедливая очередность учитывает элементы, выбранные владельцем за
+    # последние минуты (см. QueuePostgresSqlachemyBackend.claim_many)
+    op.create_index('tasks_locked_at_index', 'tasks', ['locked_at'])
+
+
+def downgrade():
+    op.drop_index('tasks_locked_at_index', table_name='tasks')
@@ -0,0 +1,38 @@
+"""Task priority
+
+Revision ID: cf305dd386dc
+Revises: aba0c1f0b193
+Create Date: 2020-11-16 10:52:03.614077
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'cf305dd386dc'
+down_revision = 'aba0c1f0b193'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tasks', sa.Column(
+        'priority', sa.Integer(), server_default='0', nullable=False
+    ))
+    # Выборка идет по убыванию приоритета
+    op.drop_index('tasks_enqueued_index', table_name='tasks')
+    op.create_index(
+        'tasks_enqueued_index', 'tasks',
+        ['type', sa.text('priority DESC'), 'created'],
+        postgresql_where=sa.text("status = 'enqueued'"),
+    )
+
+
+def downgrade():
+    op.drop_index('tasks_enqueued_index', table_name='tasks')
+    op.create_index(
+        'tasks_enqueued_index', 'tasks', ['type', 'created'],
+        postgresql_where=sa.text("status = 'enqueued'"),
+    )
+    op.drop_column('tasks', 'priority')
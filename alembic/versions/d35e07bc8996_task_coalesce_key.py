@@ -0,0 +1,32 @@
+"""Task coalesce key
+
+Revision ID: d35e07bc8996
+Revises: cf305dd386dc
+Create Date: 2020-11-18 13:07:41.290635
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd35e07bc8996'
+down_revision = 'cf305dd386dc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tasks', sa.Column(
+        'coalesce_key', sa.String(), nullable=True
+    ))
+    # Индекс под поиск ожидающей задачи с тем же ключом объединения
+    op.create_index(
+        'tasks_coalesce_key_index', 'tasks', ['coalesce_key'],
+        postgresql_where=sa.text("status = 'enqueued'"),
+    )
+
+
+def downgrade():
+    op.drop_index('tasks_coalesce_key_index', table_name='tasks')
+    op.drop_column('tasks', 'coalesce_key')
@@ -0,0 +1,39 @@
+"""Task timeouts and cancellation
+
+Revision ID: f7b0e48c3b13
+Revises: 1e499db55d0d
+Create Date: 2020-11-27 11:06:41.517384
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7b0e48c3b13'
+down_revision = '1e499db55d0d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tasks', sa.Column('timeout', sa.Integer, nullable=True))
+    op.add_column('tasks', sa.Column(
+        'cancel_requested', sa.Boolean, server_default='false',
+        nullable=False,
+    ))
+
+    # ALTER TYPE ... ADD VALUE нельзя выполнять внутри транзакции
+    op.execute("COMMIT")
+    op.execute("ALTER TYPE status ADD VALUE IF NOT EXISTS 'cancelled'")
+    op.execute("ALTER TYPE status ADD VALUE IF NOT EXISTS 'timed_out'")
+
+
+def downgrade():
+    # Значения из enum postgres не удаляются, задачи переводятся в failed
+    for table in ('tasks', 'task_reports'):
+        op.execute("UPDATE %s SET status = 'failed' "
+                   "WHERE status IN ('cancelled', 'timed_out')" % table)
+
+    op.drop_column('tasks', 'cancel_requested')
+    op.drop_column('tasks', 'timeout')
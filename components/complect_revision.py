@@ -21,10 +21,16 @@ class ComplectRevisionRpc(RpcGroup):
 
     @rpc_name("list")
     def list_of_complect_revisions(self, complect_id=None, offset=None,
-                                   limit=None, order=None) -> dict:
+                                   limit=None, order=None, cursor=None,
+                                   with_total=False) -> dict:
         """
             Возвращает строки из таблицы "revisions" для комплекта
             с "complect_id" (в словаре).
+
+            Если передан "cursor", строки отдаются постранично по
+            (created, revision_id): "" - первая страница, далее
+            "next_cursor" предыдущей страницы. Общее количество в этом
+            режиме считается только при "with_total".
         """
         # TODO: Надо вынести отсюда эту функцию (и желательно переименовать)
         def form_items(items):
@@ -36,6 +42,19 @@ class ComplectRevisionRpc(RpcGroup):
             filter_q.append(ComplectRevision.complect_id == complect_id)
 
         # Запрос
+        if cursor is not None:
+            items, next_cursor, total_items = \
+                self.complect_revision.filter_page(
+                    filter_q=filter_q, cursor=cursor or None, limit=limit,
+                    form_items=form_items, order=order,
+                    with_total=with_total,
+                )
+
+            return {
+                "items": items, "next_cursor": next_cursor,
+                "total": total_items,
+            }
+
         items, total_items = self.complect_revision.filter(
             filter_q=filter_q,
             offset=offset, limit=limit, form_items=form_items, order=order,
@@ -67,6 +86,24 @@ class ComplectRevisionRpc(RpcGroup):
         """
         return str(complect_code) + '.' + str(revision_number)
 
+    def _find_binary_by_source_hash(self, complect_id, source_hash, host,
+                                    created_after):
+        """
+            Возвращает путь к бинарнику последней ревизии комплекта,
+            собранной на хосте "host" из исходников с тем же хешем, или None.
+        """
+        with self.create_session() as session:
+            binary_path = session.query(ComplectRevision.binary_path).filter(
+                ComplectRevision.complect_id == complect_id,
+                ComplectRevision.meta["source_hash"].astext == source_hash,
+                ComplectRevision.binary_path.startswith(host + ":"),
+                ComplectRevision.created >= created_after,
+            ).order_by(
+                ComplectRevision.created.desc()
+            ).limit(1).scalar()
+
+            return binary_path
+
     def _create(self, complect_id, source_archive_path, binary_path, meta) \
             -> dict:
         """
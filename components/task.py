@@ -1,13 +1,23 @@
+import hashlib
+import json
 from datetime import datetime
 
-from models import Task
+import settings
+from components_utils.db import load_task_output
+from models import Task, TaskReports
 from nlab.rpc import ApiError, RpcGroup, rpc_name
 from nlab.rpc.object import VersionObject
-from sqlalchemy import Integer
+from pyqu.impl.queue.postgres import QueuePostgresSqlachemyBackend
+from scripts import TASK_SCRIPTS
+from tables import task_reports_archive_table, tasks_archive_table
 
 
 class TaskRpc(RpcGroup):
     """Задача"""
+    TASK_SPEC_FIELDS = {
+        "script", "type", "args", "meta", "extra", "priority", "timeout",
+    }
+
     def __init__(self, tracer, create_session):
 
         super().__init__(
@@ -17,18 +27,56 @@ class TaskRpc(RpcGroup):
             name=self.name, primary_key="task_id", entity=Task,
             create_session=create_session
         )
+        self.queue = QueuePostgresSqlachemyBackend(
+            entity=Task, create_session=create_session
+        )
 
-    def create(self, script, type, args=None, meta=None, extra=None):
+    def create(self, script, type, args=None, meta=None, extra=None,
+               priority=None, timeout=None):
         """Создание"""
 
         return self._store(
-            script=script, type=type, args=args, meta=meta, extra=extra
+            script=script, type=type, args=args, meta=meta, extra=extra,
+            priority=priority, timeout=timeout,
         )
 
+    def create_many(self, tasks):
+        """Создание пачки задач одним запросом"""
+
+        if not isinstance(tasks, list):
+            raise ApiError(
+                code="INVALID_TASKS",
+                message="Tasks must be list, got %r" % type(tasks).__name__
+            )
+
+        if len(tasks) > settings.TASK_CREATE_MANY_LIMIT:
+            raise ApiError(
+                code="TOO_MANY_TASKS",
+                message="Can't create more than %d tasks at once" %
+                        settings.TASK_CREATE_MANY_LIMIT
+            )
+
+        items = []
+        for spec in tasks:
+            if (not isinstance(spec, dict)
+                    or not {"script", "type"} <= spec.keys()
+                    or not spec.keys() <= self.TASK_SPEC_FIELDS):
+                raise ApiError(
+                    code="INVALID_TASKS",
+                    message="Invalid task spec %r" % (spec,)
+                )
+
+            items.append(self._task_fields(**spec))
+
+        return {
+            "items": self.queue.enqueue_many(items),
+        }
+
     def info(self, task_id):
         """Получение задачи"""
         with self.create_session() as session:
-            task_model = self.task.get(task_id, session=session)
+            task_model = self.task.get(task_id, session=session) \
+                or self._get_archived(task_id, session=session)
             if not task_model:
                 raise ApiError(
                     code="NOT_EXISTS",
@@ -37,30 +85,135 @@ class TaskRpc(RpcGroup):
 
             return task_model.to_dict()
 
+    def progress(self, task_id):
+        """Ход выполнения задачи по этапам"""
+        with self.create_session() as session:
+            reports_table = TaskReports.__table__
+            task_model = self.task.get(task_id, session=session)
+            if not task_model:
+                task_model = self._get_archived(task_id, session=session)
+                reports_table = task_reports_archive_table
+            if not task_model:
+                raise ApiError(
+                    code="NOT_EXISTS",
+                    message="Can't find task_id with id=%r" % task_id
+                )
+
+            reports = session.execute(reports_table.select().where(
+                reports_table.c.task_id == task_id
+            ).where(
+                reports_table.c.meta.has_key("stage")  # noqa
+            ).order_by(reports_table.c.id)).fetchall()
+
+            return {
+                "task_id": task_id,
+                "status": task_model.status,
+                "stages": self._stages(reports),
+            }
+
+    def output(self, task_id, offset=0, limit=None):
+        """Полный вывод задачи по частям"""
+        if limit is None:
+            limit = settings.TASK_OUTPUT_PAGE_CHARS
+
+        for name, value in (("offset", offset), ("limit", limit)):
+            if not isinstance(value, int) or value < 0:
+                raise ApiError(
+                    code="INVALID_%s" % name.upper(),
+                    message="%s must be non-negative integer, got %r" % (
+                        name.capitalize(), value
+                    )
+                )
+        limit = min(limit, settings.TASK_OUTPUT_PAGE_CHARS)
+
+        with self.create_session() as session:
+            output = load_task_output(session, task_id)
+            if output is None:
+                # Короткий вывод хранится целиком в результате задачи
+                task_model = self.task.get(task_id, session=session) \
+                    or self._get_archived(task_id, session=session)
+                if not task_model:
+                    raise ApiError(
+                        code="NOT_EXISTS",
+                        message="Can't find task_id with id=%r" % task_id
+                    )
+                output = (task_model.result or {}).get("output") or ""
+
+        return {
+            "task_id": task_id,
+            "offset": offset,
+            "total": len(output),
+            "output": output[offset:offset + limit],
+        }
+
+    def cancel(self, task_id):
+        """Отмена задачи"""
+        status = self.queue.cancel(task_id)
+        if status is None:
+            raise ApiError(
+                code="NOT_EXISTS",
+                message="Can't find task_id with id=%r" % task_id
+            )
+
+        # Выполняемая задача остается working, пока обработчик не прервет
+        # ее и не выставит cancelled. Завершенная задача не меняется.
+        return {
+            "task_id": task_id,
+            "status": status,
+        }
+
     @rpc_name("list")
     def list_(self, type,
-              extra=None, offset=None, limit=None, order=None):
-        """Получение списка"""
+              extra=None, offset=None, limit=None, order=None,
+              cursor=None, with_total=False):
+        """
+        Получение списка.
+
+        Если передан cursor, список отдается постранично по (created,
+        task_id): "" - первая страница, далее next_cursor предыдущей
+        страницы. Общее количество в этом режиме считается только при
+        with_total.
+        """
 
         def form_items(items):
             return [it[0].to_short_dict() for it in items]
 
+        # Загружаем только выводимые колонки, без result и args
+        load_only = Task.SHORT_DICT_FIELDS
+
         filter_q = [Task.type == type]
 
         if extra is not None and isinstance(extra, dict):
-            for key, value in extra.items():
-                if isinstance(value, int):
-                    filter_q.append(
-                        Task.extra[str(key)].astext.cast(Integer) == value
-                    )
-                else:
-                    filter_q.append(
-                        Task.extra[str(key)].astext == value
-                    )
+            extra = {str(key): value for key, value in extra.items()}
+
+            # Задачи комплекта ищутся по отдельной колонке и ее индексу
+            if "complect_id" in extra:
+                complect_id = extra.pop("complect_id")
+                filter_q.append(
+                    Task.complect_id.is_(None) if complect_id is None
+                    else Task.complect_id == str(complect_id)
+                )
+
+            # Один предикат extra @> '{...}' под gin-индекс tasks_extra_index
+            if extra:
+                filter_q.append(Task.extra.contains(extra))
+
+        if cursor is not None:
+            items, next_cursor, total_items = self.task.filter_page(
+                filter_q=filter_q, cursor=cursor or None, limit=limit,
+                form_items=form_items, order=order, with_total=with_total,
+                load_only=load_only,
+            )
+
+            return {
+                "items": items,
+                "next_cursor": next_cursor,
+                "total": total_items,
+            }
 
         items, total_items = self.task.filter(
             filter_q=filter_q, offset=offset, limit=limit,
-            form_items=form_items, order=order
+            form_items=form_items, order=order, load_only=load_only,
         )
 
         return {
@@ -68,20 +221,109 @@ class TaskRpc(RpcGroup):
             "total": total_items,
         }
 
-    def _store(self, script, type, args=None, meta=None, extra=None):
+    def _store(self, script, type, args=None, meta=None, extra=None,
+               priority=None, timeout=None):
 
-        with self.create_session() as session:
+        return self.queue.enqueue(**self._task_fields(
+            script=script, type=type, args=args, meta=meta, extra=extra,
+            priority=priority, timeout=timeout,
+        ))
 
-            task_model = Task(
-                script=script,
-                type=type,
-                args=args,
-                meta=meta,
-                extra=extra,
-                created=datetime.now(),
+    def _task_fields(self, script, type, args=None, meta=None, extra=None,
+                     priority=None, timeout=None):
+        """
+        Поля новой задачи. Набор полей одинаков для всех задач, чтобы пачку
+        можно было вставить одним запросом.
+        """
+        if priority is not None and not isinstance(priority, int):
+            raise ApiError(
+                code="INVALID_PRIORITY",
+                message="Priority must be integer, got %r" % priority
             )
 
-            session.add(task_model)
-            session.commit()
+        if timeout is not None and (not isinstance(timeout, int)
+                                    or timeout <= 0):
+            raise ApiError(
+                code="INVALID_TIMEOUT",
+                message="Timeout must be positive integer, got %r" % timeout
+            )
 
-            return task_model.to_dict()
+        # Незарегистрированный скрипт упал бы только у обработчика,
+        # заняв его впустую
+        if script not in TASK_SCRIPTS:
+            raise ApiError(
+                code="UNKNOWN_SCRIPT",
+                message="Unknown task script %r" % script
+            )
+
+        if TASK_SCRIPTS[script] != type:
+            raise ApiError(
+                code="INVALID_TYPE",
+                message="Script %r can't run as %r task" % (script, type)
+            )
+
+        return {
+            "script": script,
+            "type": type,
+            "args": args,
+            "meta": meta or {},
+            "extra": extra,
+            "priority": priority or 0,
+            "timeout": timeout,
+            "coalesce_key": self._coalesce_key(script, type, args),
+            "created": datetime.now(),
+        }
+
+    @staticmethod
+    def _get_archived(task_id, session):
+        """
+        Задача из архива (см. TASK_ARCHIVE_AFTER_DAYS) или None
+        """
+        row = session.execute(tasks_archive_table.select().where(
+            tasks_archive_table.c.task_id == task_id
+        )).first()
+
+        return Task(**dict(row)) if row else None
+
+    @staticmethod
+    def _stages(reports):
+        """
+        Этапы из событий начала и конца. Этап без конца еще выполняется
+        (или процесс обработчика прервался на нем).
+        """
+        stages = []
+        running = {}
+        for report in reports:
+            info = dict(report.meta)
+            name = info.pop("stage")
+            event = info.pop("event", None)
+
+            if event == "start":
+                stage = {
+                    "stage": name, "started": report.created,
+                    "finished": None, "duration": None,
+                }
+                stages.append(stage)
+                running[name] = stage
+            else:
+                stage = running.pop(name, None)
+                if stage is None:
+                    stage = {"stage": name, "started": None}
+                    stages.append(stage)
+                stage["finished"] = report.created
+
+            stage.update(info)
+
+        return stages
+
+    @staticmethod
+    def _coalesce_key(script, type, args):
+        """
+        Ключ объединения одинаковых задач. Повторные запросы компиляции
+        комплекта, пока первая не начала выполняться, получают ту же задачу.
+        """
+        if type not in settings.TASK_COALESCE_TYPES:
+            return None
+
+        data = json.dumps([type, script, args or {}], sort_keys=True)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
@@ -1,5 +1,11 @@
+import zlib
+
 from models import ComplectRevisionSeq
+from sqlalchemy import select, text
 from sqlalchemy.dialects.postgresql import insert
+from tables import (TASK_DONE_STATUSES, task_events_table,
+                    task_outputs_table, task_reports_archive_table,
+                    task_reports_table, tasks_archive_table, tasks_table)
 
 
 def get_next_complect_revision_number(complect_id, session) -> int:
@@ -45,3 +51,143 @@ def get_next_complect_revision_number_rawsql(complect_id, session) -> int:
     revision_number = session.execute(q).fetchone()[0]
 
     return revision_number
+
+
+def _columns(table) -> str:
+    return ", ".join(column.name for column in table.columns)
+
+
+ARCHIVE_TASKS_SQL = '''
+    WITH batch AS (
+        SELECT task_id FROM {tasks}
+        WHERE status IN ({statuses}) AND created < :before
+        ORDER BY created
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    ), moved_reports AS (
+        DELETE FROM {reports}
+        WHERE task_id IN (SELECT task_id FROM batch)
+        RETURNING {reports_columns}
+    ), archived_reports AS (
+        INSERT INTO {reports_archive} ({reports_columns})
+        SELECT {reports_columns} FROM moved_reports
+    ), deleted_outputs AS (
+        DELETE FROM {outputs}
+        WHERE task_id IN (SELECT task_id FROM batch)
+    ), moved AS (
+        DELETE FROM {tasks}
+        WHERE task_id IN (SELECT task_id FROM batch)
+        RETURNING {tasks_columns}
+    ), archived AS (
+        INSERT INTO {tasks_archive} ({tasks_columns})
+        SELECT {tasks_columns} FROM moved
+        RETURNING task_id
+    )
+    SELECT count(*) FROM archived
+'''.format(
+    tasks=tasks_table.name,
+    tasks_archive=tasks_archive_table.name,
+    tasks_columns=_columns(tasks_table),
+    reports=task_reports_table.name,
+    reports_archive=task_reports_archive_table.name,
+    reports_columns=_columns(task_reports_table),
+    outputs=task_outputs_table.name,
+    statuses=", ".join("'%s'" % status for status in TASK_DONE_STATUSES),
+)
+
+
+def archive_tasks(session, *, before, limit) -> int:
+    """
+        Переносит пачку завершенных задач, созданных раньше "before", вместе
+        с историей статусов в архивные таблицы. Строки переносятся одним
+        запросом, задачи и история не расходятся. Полный вывод задач из
+        "task_outputs" удаляется: в архиве остается его конец в результате
+        задачи.
+
+        Заблокированные строки пропускаются (SKIP LOCKED), поэтому перенос
+        не ждет обработчиков и сервис.
+
+        Возвращает количество перенесенных задач (меньше limit - больше
+        переносить нечего).
+    """
+    count = session.execute(
+        text(ARCHIVE_TASKS_SQL), {"before": before, "limit": limit}
+    ).scalar()
+    session.commit()
+
+    return count
+
+
+# Первый ключ pg_try_advisory_xact_lock(int, int) для передачи уведомлений,
+# чтобы она не пересекалась с блокировками ограничений выборки задач
+EVENTS_RELAY_LOCK_CLASS = 7080
+
+
+def relay_task_events(session, send, *, limit):
+    """
+        Передает в "send" первые "limit" уведомлений из "task_events" и
+        удаляет переданные в той же транзакции. Непереданные остаются в
+        таблице и будут переданы следующим вызовом.
+
+        Передачу в каждый момент ведет один процесс (advisory-блокировка),
+        поэтому уведомления об изменениях одной задачи передаются в порядке
+        изменений.
+
+        "send" получает список строк (id, task_id, type, status) и
+        возвращает количество переданных строк с начала списка.
+
+        Возвращает количество переданных уведомлений или None, если
+        передачу ведет другой процесс.
+    """
+    locked = session.execute(
+        text("SELECT pg_try_advisory_xact_lock(:lock_class, 0)"),
+        {"lock_class": EVENTS_RELAY_LOCK_CLASS},
+    ).scalar()
+    if not locked:
+        session.rollback()
+        return None
+
+    table = task_events_table
+    rows = session.execute(
+        table.select().order_by(table.c.id).limit(limit)
+    ).fetchall()
+
+    sent = send(rows) if rows else 0
+    if sent:
+        session.execute(table.delete().where(
+            table.c.id.in_([row.id for row in rows[:sent]])
+        ))
+    session.commit()
+
+    return sent
+
+
+def store_task_output(session, task_id, output):
+    """
+        Сохраняет полный вывод задачи "task_id" сжатым в "task_outputs".
+        Вывод повторного выполнения задачи заменяет прежний.
+    """
+    values = {
+        "data": zlib.compress(output.encode("utf-8")),
+        "size": len(output),
+    }
+    session.execute(insert(task_outputs_table).values(
+        task_id=task_id, **values
+    ).on_conflict_do_update(
+        index_elements=["task_id"], set_=values,
+    ))
+    session.commit()
+
+
+def load_task_output(session, task_id):
+    """
+        Возвращает полный вывод задачи "task_id" из "task_outputs" или None,
+        если вывод целиком хранится в результате задачи.
+    """
+    data = session.execute(select([task_outputs_table.c.data]).where(
+        task_outputs_table.c.task_id == task_id
+    )).scalar()
+    if data is None:
+        return None
+
+    return zlib.decompress(data).decode("utf-8")
@@ -0,0 +1,57 @@
+import logging
+from urllib.parse import urljoin
+
+import requests
+
+logger = logging.getLogger()
+
+
+class NotificationSender:
+    """
+    Отправка уведомлений о смене статуса задач в сервис уведомлений через
+    одну сессию requests: соединение keep-alive переиспользуется между
+    пачками, каждый запрос ограничен таймаутом.
+    """
+    def __init__(self, url, *, timeout=5):
+        """
+        :param url: адрес сервиса уведомлений, None - уведомления
+            не отправляются и считаются доставленными
+        :param timeout: таймаут соединения и ответа (в секундах)
+        """
+        self._url = urljoin(url, "send_notification") if url else None
+        self._timeout = timeout
+        self._session = requests.Session()
+
+    def send(self, events) -> int:
+        """
+        Отправка уведомлений по порядку. На первой ошибке отправка
+        прекращается, чтобы следующие уведомления не обогнали неотправленное.
+
+        :param events: кортежи (namespace, task_id, status, event)
+        :return: количество отправленных уведомлений с начала списка
+        """
+        if self._url is None:
+            return len(events)
+
+        for sent, (namespace, task_id, status, event) in enumerate(events):
+            try:
+                response = self._session.post(
+                    url=self._url,
+                    json={
+                        "event": event,
+                        "data": {
+                            "data": {
+                                "task_id": task_id,
+                                "status": status,
+                            }
+                        },
+                        "namespace": "/{}".format(namespace)
+                    },
+                    timeout=self._timeout,
+                )
+                response.raise_for_status()
+            except requests.exceptions.RequestException as error:
+                logger.warning("Can't send notification: %s", error)
+                return sent
+
+        return len(events)
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from pathlib import Path
+from typing import Optional
 
 
 class ComplectRemotePath:
@@ -71,9 +72,13 @@ class EngineUploadResult:
     Upload preprocessed sources to compiler result
     """
     def __init__(self, complect_path: ComplectRemotePath,
-                 result: CallExecutionResult):
+                 result: CallExecutionResult, bytes_sent=None):
+        """
+        :param bytes_sent: size of transferred data (archive or file)
+        """
         self.complect_path = complect_path
         self.result = result
+        self.bytes_sent = bytes_sent
 
 
 class EngineCompileResult:
@@ -104,6 +109,10 @@ class EngineBackend(ABC):
     """
     Backend engine templates handling abstract layer.
     """
+    # Interrupts long remote commands (compilation) when the task is
+    # cancelled or timed out, see pyqu.cancel.CancelToken
+    cancel_token = None
+
     @abstractmethod
     def connect(self):
         pass
@@ -160,3 +169,12 @@ class EngineBackend(ABC):
         Download single file to path. Needs paths to file in both params
         """
         pass
+
+    def find_complect(self, remote_path) -> Optional[ComplectRemotePath]:
+        """
+        Complect compiled earlier on this host
+
+        :param remote_path: path in system volume
+        :return: None if the complect binary is not available
+        """
+        return None
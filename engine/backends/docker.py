@@ -12,7 +12,7 @@ class DockerBackend(SshBackendMixin):
     Docker backend
     """
     def __init__(self, *, target, user, host, engine_path, data_path,
-                 container_name, private_key):
+                 container_name, private_key, update_lock_path=None):
         super().__init__(
             target=target,
             user=user,
@@ -20,6 +20,7 @@ class DockerBackend(SshBackendMixin):
             engine_path=engine_path,
             data_path=data_path,
             private_key=private_key,
+            update_lock_path=update_lock_path,
         )
         self._container_name = container_name
 
@@ -41,9 +42,11 @@ class DockerBackend(SshBackendMixin):
         if len(args) != 1 and len(kwargs) == 0:
             raise RuntimeError("Only one str parameter supported in _execute!")
 
-        call = f"sudo docker exec {self._get_docker_container()} " \
-               f"bash -c '{args[0]}'"
-        return super()._execute(call)
+        return super()._execute(self._remote_command(args[0]))
+
+    def _remote_command(self, cmd):
+        return f"sudo docker exec {self._get_docker_container()} " \
+               f"bash -c '{cmd}'"
 
     def _mktemp(self):
         """
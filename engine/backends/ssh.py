@@ -4,6 +4,7 @@ from abc import ABC
 from io import StringIO
 from pathlib import Path
 from stat import S_ISDIR
+from typing import Optional
 
 import paramiko
 from engine.backend import (CallExecutionResult, ComplectRemotePath,
@@ -23,7 +24,11 @@ class SshBackendMixin(EngineBackend, ABC):
     strict_mode = True
 
     def __init__(self, *, target, user, host, engine_path, data_path,
-                 private_key):
+                 private_key, update_lock_path=None):
+        """
+        :param update_lock_path: lock file on the host which serializes
+            engine update and restart when several jobs share the host
+        """
 
         self.target = target
         self.client = None
@@ -32,6 +37,7 @@ class SshBackendMixin(EngineBackend, ABC):
         self.engine_path = Path(engine_path)
         self.private_key = private_key
         self.data_path = data_path
+        self.update_lock_path = update_lock_path
 
         self._sftp = None
 
@@ -47,6 +53,17 @@ class SshBackendMixin(EngineBackend, ABC):
         """
         return self._get_file(remotepath, localpath)
 
+    def find_complect(self, remote_path) -> Optional[ComplectRemotePath]:
+        binary_path = Path(remote_path) / "dldata.ie2"
+        try:
+            self._sftp.stat(str(binary_path))
+        except OSError:
+            # Старые комплекты удаляются с диска через неделю
+            logger.info(f"Complect binary {binary_path} not found")
+            return None
+
+        return self._complect_path(remote_path)
+
     def _connect(self):
         self.client = paramiko.SSHClient()
         self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy)
@@ -95,6 +112,7 @@ class SshBackendMixin(EngineBackend, ABC):
                 Path(local_path)/arch_file_name,
                 Path(remote_path)/arch_file_name
             )
+            bytes_sent = (Path(local_path)/arch_file_name).stat().st_size
 
             # 3. На удаленном сервере извлечем все из архива в remote_path
             # и удалим файл с архивом
@@ -117,6 +135,7 @@ class SshBackendMixin(EngineBackend, ABC):
 
         else:
             self._put_file(Path(local_path), Path(remote_path))
+            bytes_sent = Path(local_path).stat().st_size
 
         # Удалим файлы и папки старше недели на удаленном диске
         # (для освобождения места)
@@ -130,14 +149,18 @@ class SshBackendMixin(EngineBackend, ABC):
             f'Got - exit_code: {exit_code}, err: "{err}".'
         )
 
+        complect = self._complect_path(remote_path)
+        upload_result = CallExecutionResult(code=0, out="", err="")  # TODO
+
+        return EngineUploadResult(complect, result=upload_result,
+                                  bytes_sent=bytes_sent)
+
+    def _complect_path(self, remote_path) -> ComplectRemotePath:
         docker_path = Path("/root/volume") / Path(remote_path).relative_to(
             self.data_path)
 
-        complect = ComplectRemotePath(remote_path=remote_path,
-                                      docker_path=str(docker_path))
-        upload_result = CallExecutionResult(code=0, out="", err="")  # TODO
-
-        return EngineUploadResult(complect, result=upload_result)
+        return ComplectRemotePath(remote_path=remote_path,
+                                  docker_path=str(docker_path))
 
     def _execute(self, *args, **kwargs) -> CallExecutionResult:
         """
@@ -159,6 +182,52 @@ class SshBackendMixin(EngineBackend, ABC):
 
         return CallExecutionResult(code=exit_code, out=out, err=err)
 
+    def _execute_cancellable(self, cmd) -> CallExecutionResult:
+        """
+        Execute remote process which is killed when cancel_token is
+        cancelled. The shell prints its pid first, so the process can be
+        killed over a separate channel even if the command hangs.
+
+        :param cmd: shell command
+        :return:
+        """
+        if self.cancel_token is None:
+            return self._execute(cmd)
+
+        logger.info(f"Running cancellable: {cmd}")
+        stdin, stdout, stderr = self.client.exec_command(
+            self._remote_command(f"echo $$; {cmd}")
+        )
+        pid = stdout.readline().strip()
+        kill_cmd = self._remote_command(
+            f"pkill -TERM -P {pid}; kill -TERM {pid}"
+        )
+
+        def kill(reason):
+            logger.warning(f"Killing remote process {pid}: {reason}")
+            self.client.exec_command(kill_cmd)
+
+        self.cancel_token.add_callback(kill)
+        try:
+            exit_code = stdout.channel.recv_exit_status()
+            out = stdout.read().decode("utf-8")
+            err = stderr.read().decode("utf-8")
+        finally:
+            self.cancel_token.remove_callback(kill)
+
+        logger.info(
+            f"Executed: {cmd}. "
+            f"Got: code: {exit_code}, out: {out}, err: {err}"
+        )
+
+        return CallExecutionResult(code=exit_code, out=out, err=err)
+
+    def _remote_command(self, cmd):
+        """
+        Command line which runs the shell command on the host
+        """
+        return cmd
+
     def _check_execute(self, *args, **kwargs) -> CallExecutionResult:
         """
         Execute process with ensuring 0 code result
@@ -191,22 +260,30 @@ class SshBackendMixin(EngineBackend, ABC):
         ]
 
         cmd_str = " ".join(cmd)
-        result = self._execute(cmd_str)
+        result = self._execute_cancellable(cmd_str)
 
         return EngineCompileResult(result)
 
     def _update(self, complect_path: Path) -> EngineUpdateResult:
-        result = self._execute(
+        result = self._execute(self._with_update_lock(
             "InfEngineManager.pl --dl-update %s --verbose" %
             (Path(complect_path) / "dldata.ie2",)
-        )
+        ))
 
         return EngineUpdateResult(result)
 
     def _restart(self) -> EngineRestartResult:
-        result = self._execute("InfEngineControl.pl --restart")
+        result = self._execute(
+            self._with_update_lock("InfEngineControl.pl --restart")
+        )
         return EngineRestartResult(result)
 
+    def _with_update_lock(self, cmd):
+        if not self.update_lock_path:
+            return cmd
+
+        return f"flock {self.update_lock_path} {cmd}"
+
     def _put_dir(self, source: Path, dest: Path):
         for root, dirs, files in os.walk(source):
             relative_root = Path(root).relative_to(source)
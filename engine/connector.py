@@ -5,6 +5,8 @@ from engine.backends.docker import DockerBackend
 from engine.backends.kubernetes import KubernetesBackend
 from engine.backends.virtual_machine import VirtualMachineBackend
 
+ENGINE_UPDATE_LOCK_PATH = "/tmp/arm-engine-update.lock"
+
 
 class EngineConnectorImpl:
     """
@@ -24,6 +26,12 @@ class EngineConnectorImpl:
         data_path = engine_info["data_path"]
         container_name = engine_info.get("container_name")
 
+        # Several jobs share the host: engine update and restart
+        # must run one at a time
+        update_lock_path = None
+        if engine_info.get("max_jobs", 1) > 1:
+            update_lock_path = ENGINE_UPDATE_LOCK_PATH
+
         if container_name:
             return DockerBackend(
                 target=target,
@@ -33,6 +41,7 @@ class EngineConnectorImpl:
                 private_key=private_key,
                 data_path=data_path,
                 container_name=container_name,
+                update_lock_path=update_lock_path,
             )
         else:
             return VirtualMachineBackend(
@@ -42,6 +51,7 @@ class EngineConnectorImpl:
                 engine_path=engine_info["engine_path"],
                 private_key=private_key,
                 data_path=data_path,
+                update_lock_path=update_lock_path,
             )
 
     def _create_kubernetes_backend(self, target, engine_info):
@@ -3,9 +3,16 @@ from pathlib import Path
 from typing import Optional
 
 from engine.backend import EngineDownloadResult, EnginePreprocessResult
+from engine.progress import StageReporter
 
 
 class Preprocessor:
+    # Interrupts preprocessor subprocesses when the task is cancelled or
+    # timed out, see pyqu.cancel.CancelToken
+    cancel_token = None
+    # Reports durations of preprocessing steps
+    stage_reporter = StageReporter()
+
     @abstractmethod
     def download(self, root_dir: Path,
                  complect_id: Optional[str] = None) -> EngineDownloadResult:
@@ -23,10 +23,12 @@ class Arm1Preprocessor(Preprocessor):
     def download(self, root_dir: Path, complect_id: Optional[str] = None) \
             -> EngineDownloadResult:
         logger.debug("Started downloading")
-        php_process_result = self._run_php_preprocessor(
-            complect_id=complect_id,
-            root_dir=root_dir,
-        )
+        with self.stage_reporter.stage("download") as info:
+            php_process_result = self._run_php_preprocessor(
+                complect_id=complect_id,
+                root_dir=root_dir,
+            )
+            info["code"] = php_process_result.code
 
         if php_process_result.code != 0:
             # Return root dir, will fail
@@ -39,19 +41,27 @@ class Arm1Preprocessor(Preprocessor):
     def preprocess(self, base_path: Path) \
             -> EnginePreprocessResult:
         logger.debug("Started preprocessing")
-        perl_process_result = self._run_perl_preprocessor(base_path)
+        with self.stage_reporter.stage("preprocess") as info:
+            perl_process_result = self._run_perl_preprocessor(base_path)
+            info["code"] = perl_process_result.code
 
         if "ERROR" not in perl_process_result.out:
             logger.debug("Started processing templates")
-            used_dicts = self._process_templates_and_vars(base_path)
+            with self.stage_reporter.stage("templates") as info:
+                used_dicts = self._process_templates_and_vars(base_path)
+                info["used_dicts"] = len(used_dicts)
             logger.debug("Finished processing templates")
 
             dict_export = DictionariesList(base_path=base_path)
-            dict_export.export(
-                common_dicts=True,
-                used_dicts=used_dicts,
-                dictionary_rpc=self.gateway_client.component("dictionary"),
-            )
+            with self.stage_reporter.stage("dictionaries") as info:
+                dict_export.export(
+                    common_dicts=True,
+                    used_dicts=used_dicts,
+                    dictionary_rpc=self.gateway_client.component(
+                        "dictionary"
+                    ),
+                )
+                info["count"] = len(dict_export.dicts)
 
         logger.debug("Finished preprocessing")
 
@@ -94,8 +104,9 @@ class Arm1Preprocessor(Preprocessor):
 
         with tempfile.TemporaryFile() as fout:
             with tempfile.TemporaryFile() as ferr:
-                result = subprocess.run(cmd, stdout=fout, stderr=ferr)
-                code = result.returncode
+                code = self._wait_subprocess(
+                    subprocess.Popen(cmd, stdout=fout, stderr=ferr)
+                )
 
                 fout.seek(0)
                 out = fout.read().decode(errors='replace')
@@ -107,6 +118,23 @@ class Arm1Preprocessor(Preprocessor):
 
         return CallExecutionResult(code=code, out=out, err=err)
 
+    def _wait_subprocess(self, process: subprocess.Popen) -> int:
+        """
+        Waits for the process, kills it when the task is cancelled
+        """
+        if self.cancel_token is None:
+            return process.wait()
+
+        def kill(reason):
+            logger.warning("Killing %s: %s", process.args, reason)
+            process.kill()
+
+        self.cancel_token.add_callback(kill)
+        try:
+            return process.wait()
+        finally:
+            self.cancel_token.remove_callback(kill)
+
     def _process_templates_and_vars(self, source_dir: Path):
         """
         Read templates for dictionary and var references.
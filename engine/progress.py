@@ -0,0 +1,54 @@
+import contextlib
+import logging
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class StageReporter:
+    """
+    Emits start and end events of task stages with durations, so slow
+    stages can be found and users can watch the progress.
+
+        with reporter.stage("upload") as info:
+            result = backend.upload(path)
+            info["bytes"] = result.bytes_sent
+    """
+    def __init__(self, emit: Optional[Callable[[dict], None]] = None):
+        """
+        :param emit: stores event dict, stage events are only logged
+            without it
+        """
+        self._emit = emit
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        """
+        Reports the stage around the block. Values put into the yielded
+        dict (bytes, exit code, counts) are added to the end event.
+        """
+        self._send(dict(info, stage=name, event="start"))
+
+        started = time.monotonic()
+        ok = False
+        try:
+            yield info
+            ok = True
+        finally:
+            self._send(dict(
+                info, stage=name, event="end", ok=ok,
+                duration=round(time.monotonic() - started, 3),
+            ))
+
+    def _send(self, event):
+        logger.info("Stage event: %s", event)
+
+        if self._emit is None:
+            return
+
+        try:
+            self._emit(event)
+        except Exception:
+            # Lost progress record must not break the task itself
+            logger.exception("Can't store stage event")
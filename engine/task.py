@@ -88,6 +88,16 @@ class CompilerTaskResult(EngineTaskResult):
         self.exc_result: Optional[ErrorWithTraceback] = None
         self.engine_complect = None
         self.host = None
+        # Compilation was aborted because a newer one was queued
+        self.superseded = False
+        # Compilation was aborted because the task was cancelled or timed
+        # out, reason is stored
+        self.cancelled = None
+        # Hash of preprocessed sources
+        self.source_hash = None
+        # Upload and compilation were skipped, binary compiled earlier from
+        # the same sources is used
+        self.cached = False
 
 
 class DeployTask(EngineTask):
@@ -119,3 +129,6 @@ class DeployTaskResult(EngineTaskResult):
         self.success = False
         self.output = ""
         self.complect_id = ""
+        # Deploy was aborted because the task was cancelled or timed out,
+        # reason is stored
+        self.cancelled = None
@@ -3,17 +3,22 @@ import os
 import shutil
 import tempfile
 import traceback
+from datetime import datetime, timedelta
 from pathlib import Path
+from typing import Callable, Optional
 
 from components import ComplectRevisionRpc
-from engine.backend import EngineBackend
+from engine.backend import (CallExecutionResult, ComplectRemotePath,
+                            EngineBackend)
 from engine.engine_output_parser import EngineOutput, parse_engine_output,\
     load_client_data
 from engine.preprocessor import Preprocessor
+from engine.progress import StageReporter
 from engine.task import CompilerTaskResult, CompilerTask, ErrorWithTraceback
+from engine.util import close_on_cancel, hash_source_tree
 from nlab.rpc.client import WebClient
 from nlab.service import Tracer
-from task_executor import create_engine
+from task_executor import get_sessionmaker
 
 logger = logging.getLogger(__name__)
 
@@ -24,12 +29,31 @@ class EngineCompilerProcess:
     """
 
     def __init__(self, *, preprocessor: Preprocessor, backend: EngineBackend,
-                 task: CompilerTask, root_path: Path):
+                 task: CompilerTask, root_path: Path,
+                 is_superseded: Optional[Callable[[], bool]] = None,
+                 find_cached: Optional[Callable[[str], Optional[str]]] = None,
+                 cancel_token=None,
+                 stage_reporter: Optional[StageReporter] = None):
+        """
+        :param is_superseded: checks whether a newer compilation of the same
+            complect was queued, called at every stage boundary
+        :param find_cached: returns remote path of a complect compiled
+            earlier on the compiler host from sources with the given hash
+        :param cancel_token: pyqu.cancel.CancelToken of the task, checked at
+            every stage boundary. Preprocessor and backend kill running
+            processes themselves if they got the same token.
+        :param stage_reporter: receives start and end of upload, compile,
+            update and restart stages
+        """
         self._preprocessor: Preprocessor = preprocessor
         self._backend: EngineBackend = backend
         self._task = task
         self._result = CompilerTaskResult()
         self._root_path = root_path
+        self._is_superseded = is_superseded
+        self._find_cached = find_cached
+        self._cancel_token = cancel_token
+        self._stages = stage_reporter or StageReporter()
 
     def execute(self):
         """
@@ -61,6 +85,9 @@ class EngineCompilerProcess:
         logger.debug('_execute: self._backend.connect()')
         self._backend.connect()
 
+        if self._stopped("download"):
+            return
+
         logger.debug('_execute: self._preprocessor.download()')
         download_result = self._preprocessor.download(
             base_path,
@@ -75,6 +102,9 @@ class EngineCompilerProcess:
 
         base_path = download_result.base_path
 
+        if self._stopped("preprocess"):
+            return
+
         logger.debug('_execute: self._preprocessor.preprocess()')
         preprocess_result = self._preprocessor.preprocess(base_path)
         self._result.perl_process_result = preprocess_result.result
@@ -86,40 +116,36 @@ class EngineCompilerProcess:
             logger.debug('_execute: END - preprocess_result.result.code != 0')
             return
 
-        logger.debug('_execute: self._backend.upload()')
-        upload_result = self._backend.upload(base_path)
-        complect_path = upload_result.complect_path
-        self._result.upload_result = upload_result.result
-        self._result.engine_complect = complect_path
-
-        if not self._task.do_compile:
-            logger.debug('_execute: END - not self._task.do_compile')
-            return
-        if upload_result.result.code != 0:
-            logger.debug('_execute: END - upload_result.result.code != 0')
-            return
-
-        logger.debug('_execute: self._backend.compile()')
-        compile_result = self._backend.compile(complect_path)
-        self._result.compile_result = compile_result.result
+        complect_path = self._find_cached_complect(base_path)
+        if complect_path is None:
+            complect_path = self._upload_and_compile(base_path)
+            if complect_path is None:
+                return
 
         if not self._task.do_update:
             logger.debug('_execute: END - not self._task.do_update')
             return
-        if compile_result.result.code != 0:
-            logger.debug('_execute: END - compile_result.result.code != 0')
+
+        if self._stopped("update"):
             return
 
         logger.debug('_execute: self._backend.update()')
-        update_result = self._backend.update(complect_path)
+        with self._stages.stage("update") as info:
+            update_result = self._backend.update(complect_path)
+            info["code"] = update_result.result.code
         self._result.update_result = update_result.result
 
         if update_result.result.code != 0:
             logger.debug('_execute: END - update_result.result.code != 0')
             return
 
+        if self._stopped("restart"):
+            return
+
         logger.debug('_execute: self._backend.restart()')
-        restart_result = self._backend.restart()
+        with self._stages.stage("restart") as info:
+            restart_result = self._backend.restart()
+            info["code"] = restart_result.result.code
         self._result.restart_result = restart_result.result
         if restart_result.result.code != 0:
             logger.debug('_execute: END - restart_result.result.code != 0')
@@ -140,6 +166,110 @@ class EngineCompilerProcess:
 
         logger.debug('_execute: END successful')
 
+    def _find_cached_complect(self, base_path: Path) \
+            -> Optional[ComplectRemotePath]:
+        """
+        Looks up a binary compiled earlier from the same sources, so upload
+        and compilation can be skipped
+        """
+        with self._stages.stage("cache_lookup") as info:
+            self._result.source_hash = hash_source_tree(base_path)
+
+            if self._find_cached is None or not self._task.do_compile:
+                return None
+
+            remote_path = self._find_cached(self._result.source_hash)
+            if remote_path is None:
+                return None
+
+            complect_path = self._backend.find_complect(remote_path)
+            if complect_path is None:
+                return None
+
+            info["hit"] = True
+
+        logger.info('_execute: compiled complect found in %s', remote_path)
+        self._result.engine_complect = complect_path
+        self._result.compile_result = CallExecutionResult(
+            code=0, out="", err=""
+        )
+        self._result.cached = True
+
+        return complect_path
+
+    def _upload_and_compile(self, base_path: Path) \
+            -> Optional[ComplectRemotePath]:
+        """
+        Uploads sources and compiles them
+
+        :return: compiled complect or None if the process should stop
+        """
+        if self._stopped("upload"):
+            return None
+
+        logger.debug('_execute: self._backend.upload()')
+        with self._stages.stage("upload") as info, \
+                close_on_cancel(self._backend, self._cancel_token):
+            upload_result = self._backend.upload(base_path)
+            info["bytes"] = upload_result.bytes_sent
+        complect_path = upload_result.complect_path
+        self._result.upload_result = upload_result.result
+        self._result.engine_complect = complect_path
+
+        if not self._task.do_compile:
+            logger.debug('_execute: END - not self._task.do_compile')
+            return None
+        if upload_result.result.code != 0:
+            logger.debug('_execute: END - upload_result.result.code != 0')
+            return None
+
+        if self._stopped("compile"):
+            return None
+
+        logger.debug('_execute: self._backend.compile()')
+        with self._stages.stage("compile") as info:
+            compile_result = self._backend.compile(complect_path)
+            info["code"] = compile_result.result.code
+        self._result.compile_result = compile_result.result
+
+        if compile_result.result.code != 0:
+            logger.debug('_execute: END - compile_result.result.code != 0')
+            return None
+
+        return complect_path
+
+    def _stopped(self, stage):
+        """
+        Checks before the stage whether the compilation is cancelled or stale
+        """
+        if self._cancel_token is not None and self._cancel_token.cancelled:
+            logger.info('_execute: END - %s before %s',
+                        self._cancel_token.reason, stage)
+            self._result.cancelled = self._cancel_token.reason
+            return True
+
+        return self._superseded(stage)
+
+    def _superseded(self, stage):
+        """
+        Checks before the stage whether the compilation is stale
+        """
+        if self._is_superseded is None:
+            return False
+
+        try:
+            superseded = self._is_superseded()
+        except Exception:
+            # Failed check must not break the compilation itself
+            logger.exception("Can't check whether compilation is superseded")
+            return False
+
+        if superseded:
+            logger.info('_execute: END - superseded before %s', stage)
+            self._result.superseded = True
+
+        return superseded
+
     def _create_base_dir(self):
 
         base_path = Path(tempfile.mkdtemp(dir=self._root_path))
@@ -181,6 +311,12 @@ def format_output_result(result: CompilerTaskResult,
     if result.exc_result is not None:
         parse_out += 'ERROR: ' + str(result.exc_result.error)
 
+    if result.superseded:
+        parse_out += 'SUPERSEDED: a newer compilation was queued'
+
+    if result.cancelled:
+        parse_out += 'CANCELLED: ' + result.cancelled
+
     success = (result.compile_result
                and result.compile_result.code == 0
                and not len(riched_out.messages)) or False
@@ -197,6 +333,7 @@ def format_output_result(result: CompilerTaskResult,
             "p2": result.compile_result.to_dict()
                 if result.compile_result else {},
             "host": result.host,
+            "cached": result.cached,
             "path": result.engine_complect.remote_path
                 if result.engine_complect else "",
             "exc_error": str(result.exc_result.error)
@@ -209,17 +346,20 @@ def format_output_result(result: CompilerTaskResult,
     return output_result
 
 
-def create_complect_revision(*, remote_path, compiler_host, complect_id):
+def create_complect_revision(*, remote_path, compiler_host, complect_id,
+                             source_hash=None):
     """
     Creates complect revision from parameters
     :param remote_path:
     :param compiler_host:
     :param complect_id:
+    :param source_hash: hash of successfully compiled sources, makes the
+        binary reusable by find_cached_complect
     :return:
     """
     rpc = ComplectRevisionRpc(
         tracer=Tracer("compilation"),
-        create_session=create_engine(),
+        create_session=get_sessionmaker(),
     )
 
     binary_path = Path(remote_path) / "dldata.ie2"
@@ -230,10 +370,42 @@ def create_complect_revision(*, remote_path, compiler_host, complect_id):
         complect_id=complect_id,
         binary_path=str(binary_full_path),
         source_archive_path="",
-        meta={},
+        meta={"source_hash": source_hash} if source_hash else {},
     )
 
     return {
         "complect_revision_id": complect_revision["id"],
         "complect_revision_code": complect_revision["code"],
     }
+
+
+def find_cached_complect(*, source_hash, compiler_host, complect_id,
+                         max_age: timedelta) -> Optional[str]:
+    """
+    Finds remote path of the latest complect revision compiled on the host
+    from the same sources
+    :param source_hash:
+    :param compiler_host:
+    :param complect_id:
+    :param max_age: older binaries are not used (they are removed from the
+        host disk and may be compiled by an outdated engine)
+    :return:
+    """
+    rpc = ComplectRevisionRpc(
+        tracer=Tracer("compilation"),
+        create_session=get_sessionmaker(),
+    )
+
+    binary_path = rpc._find_binary_by_source_hash(
+        complect_id=complect_id,
+        source_hash=source_hash,
+        host=compiler_host,
+        created_after=datetime.now() - max_age,
+    )
+    if binary_path is None:
+        return None
+
+    # binary path is stored as "<host>:<path to dldata.ie2>"
+    _, path = binary_path.split(":", 1)
+
+    return str(Path(path).parent)
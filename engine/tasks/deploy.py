@@ -3,7 +3,9 @@ import os
 import tempfile
 from pathlib import Path
 
+from engine.progress import StageReporter
 from engine.task import DeployTask, DeployTaskResult, EngineTaskResult
+from engine.util import close_on_cancel
 from models import ComplectRevision
 
 logger = logging.getLogger(__name__)
@@ -15,12 +17,22 @@ class EngineDeployProcess(EngineTaskResult):
     """
 
     def __init__(self, factory: 'EngineFactory', task: DeployTask,  # noqa
-                 create_session):
+                 create_session, cancel_token=None,
+                 stage_reporter: StageReporter = None):
+        """
+        :param cancel_token: pyqu.cancel.CancelToken of the task, checked
+            between stages. Engine update and restart are not interrupted,
+            so the engine is not left half-updated.
+        :param stage_reporter: receives start and end of download, upload,
+            update and restart stages
+        """
         self._factory = factory
         self._task = task
         self._result = DeployTaskResult()
 
         self._create_session = create_session
+        self._cancel_token = cancel_token
+        self._stages = stage_reporter or StageReporter()
 
     def execute(self):
         """
@@ -74,6 +86,9 @@ class EngineDeployProcess(EngineTaskResult):
         source_engine, source_remote_path = paths
 
         # Download binary file
+        if self._stopped("download"):
+            return
+
         source_engine = self._factory.create_compiler_backend(
             source_engine,
         )
@@ -86,13 +101,19 @@ class EngineDeployProcess(EngineTaskResult):
             f'_execute: Created local_binary_path="{local_binary_path}"'
         )
 
-        source_engine.get_file(source_remote_path, local_binary_path)
+        with self._stages.stage("download") as info, \
+                close_on_cancel(source_engine, self._cancel_token):
+            source_engine.get_file(source_remote_path, local_binary_path)
+            info["bytes"] = local_binary_path.stat().st_size
         logger.debug(
             f'_execute: Downloaded from remote "{source_remote_path}"'
             f' to "{local_binary_path}"'
         )
         source_engine.close()  # TODO: with block
 
+        if self._stopped("upload"):
+            return
+
         target_engine = self._factory.create_deployer_backend(
             self._task.target,
         )
@@ -100,19 +121,31 @@ class EngineDeployProcess(EngineTaskResult):
         logger.debug('_execute: target_engine.connect() Ok')
 
         # Upload binary data
-        upload_result = uploaded_binary = target_engine.upload(local_path)
+        with self._stages.stage("upload") as info, \
+                close_on_cancel(target_engine, self._cancel_token):
+            upload_result = uploaded_binary = target_engine.upload(local_path)
+            info["bytes"] = upload_result.bytes_sent
         if upload_result.result.code != 0:
             logger.debug('_execute: END - upload_result.result.code != 0')
             return
         logger.debug('_execute: target_engine.upload(local_path) Ok')
 
-        update_result = target_engine.update(uploaded_binary.complect_path)
+        if self._stopped("update"):
+            return
+
+        with self._stages.stage("update") as info:
+            update_result = target_engine.update(
+                uploaded_binary.complect_path
+            )
+            info["code"] = update_result.result.code
         if update_result.result.code != 0:
             logger.debug('_execute: END - update_result.result.code != 0')
             return
         logger.debug('_execute: target_engine.update() Ok')
 
-        restart_result = target_engine.restart()
+        with self._stages.stage("restart") as info:
+            restart_result = target_engine.restart()
+            info["code"] = restart_result.result.code
         if restart_result.result.code != 0:
             logger.debug('_execute: END - restart_result.result.code != 0')
             return
@@ -133,3 +166,16 @@ class EngineDeployProcess(EngineTaskResult):
         self._result.success = True
 
         logger.debug('_execute: END successful')
+
+    def _stopped(self, stage):
+        """
+        Checks before the stage whether the deploy is cancelled
+        """
+        if self._cancel_token is None or not self._cancel_token.cancelled:
+            return False
+
+        logger.info('_execute: END - %s before %s',
+                    self._cancel_token.reason, stage)
+        self._result.cancelled = self._cancel_token.reason
+        self._result.output = "CANCELLED: " + self._cancel_token.reason
+        return True
@@ -1,4 +1,8 @@
+import contextlib
 import datetime
+import hashlib
+import os
+from pathlib import Path
 
 
 def generate_mktemp_pattern(now=None):
@@ -9,3 +13,47 @@ def generate_mktemp_pattern(now=None):
     now_str = now.strftime("%Y%m%d-%H%M%S")
 
     return f"arm_{now_str}_XXXXXXXX"
+
+
+def hash_source_tree(base_path: Path) -> str:
+    """
+    Content hash of the source tree: relative paths and file contents
+    in a stable order, so equal sources give equal hashes on any host
+    """
+    digest = hashlib.sha256()
+
+    for root, dirs, files in os.walk(base_path):
+        dirs.sort()
+
+        for name in sorted(files):
+            path = Path(root) / name
+            relative_path = path.relative_to(base_path).as_posix()
+            digest.update(relative_path.encode("utf-8") + b"\0")
+
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 16), b""):
+                    digest.update(chunk)
+
+            digest.update(b"\0")
+
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def close_on_cancel(backend, cancel_token):
+    """
+    Closes backend connection when the task is cancelled inside the block,
+    so a hung SFTP transfer fails instead of blocking the worker
+    """
+    if cancel_token is None:
+        yield
+        return
+
+    def close(reason):
+        backend.close()
+
+    cancel_token.add_callback(close)
+    try:
+        yield
+    finally:
+        cancel_token.remove_callback(close)
@@ -1,7 +1,5 @@
-from datetime import datetime
-
-from sqlalchemy.event import listens_for
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import column_property
 
 from tables import (complects_revisions_seq_table, complects_revisions_table,
                     metadata, task_reports_table, tasks_table)
@@ -24,11 +22,30 @@ class Task(Base):
     created = tasks_table.c.created
     updated = tasks_table.c.updated
     locked_by = tasks_table.c.locked_by
+    locked_at = tasks_table.c.locked_at
+    lease_expires = tasks_table.c.lease_expires
+    attempts = tasks_table.c.attempts
+    priority = tasks_table.c.priority
+    coalesce_key = tasks_table.c.coalesce_key
+    timeout = tasks_table.c.timeout
+    cancel_requested = tasks_table.c.cancel_requested
+    complect_id = tasks_table.c.complect_id
+    # Признак успеха из result. Отдельное выражение, чтобы списки не
+    # загружали весь result (в нем бывает вывод компиляции на мегабайты)
+    success = column_property(tasks_table.c.result["success"], deferred=True)
+
+    # Колонки, которые нужны to_short_dict
+    SHORT_DICT_FIELDS = (
+        "task_id", "status", "success", "meta", "extra", "created", "updated",
+    )
 
     ENQUEUED = "enqueued"
     WORKING = "working"
     FINISHED = "finished"
     FAILED = "failed"
+    SUPERSEDED = "superseded"
+    CANCELLED = "cancelled"
+    TIMED_OUT = "timed_out"
 
     def to_dict(self):
 
@@ -38,6 +55,8 @@ class Task(Base):
             "success": self.get_success(),
             "meta": self.meta,
             "extra": self.extra,
+            "priority": self.priority,
+            "timeout": self.timeout,
             "created": self.created,
             "updated": self.updated,
             "errortext": self.errortext,
@@ -49,7 +68,7 @@ class Task(Base):
         return {
             "task_id": self.task_id,
             "status": self.status,
-            "success": self.get_success(),
+            "success": self.success,
             "meta": self.meta,
             "extra": self.extra,
             "created": self.created,
@@ -81,18 +100,6 @@ class TaskReports(Base):
         }
 
 
-@listens_for(Task, 'after_update')
-def task_after_update_function(mapper, connection, target):
-
-    table = TaskReports.__table__
-    connection.execute(
-        table.insert().values(
-            status=target.status, task_id=target.task_id,
-            created=datetime.now()
-        )
-    )
-
-
 class ComplectRevision(Base):
     __table__ = complects_revisions_table
 
@@ -1,5 +1,9 @@
+import base64
+import datetime
+import json
+
 import sqlalchemy as sa
-from sqlalchemy import desc, asc, or_, and_
+from sqlalchemy import desc, asc, or_, and_, orm
 from nlab.rpc.exceptions import ApiError
 
 
@@ -19,11 +23,11 @@ class VersionObject:
         self.create_session = create_session
 
     def filter(self, *, offset=None, limit=None, filter_q=None, filter_by_q=None, join=None, outerjoin=None, fetch_args=None,
-               group_by=None, order=None, form_items=None):
+               group_by=None, order=None, form_items=None, load_only=None):
         with self.create_session() as session:
             q = self.prepare_filter_q(offset=offset, limit=limit, filter_q=filter_q, filter_by_q=filter_by_q,
                                       join=join, outerjoin=outerjoin, fetch_args=fetch_args, group_by=group_by,
-                                      session=session, order=order)
+                                      session=session, order=order, load_only=load_only)
 
             items = q.all()
             total_items = 0
@@ -95,7 +99,10 @@ class VersionObject:
 
     def prepare_filter_q(self, *, session, offset=None, limit=None, filter_q=None, filter_by_q=None, join=None,
                          fetch_args=None, group_by=None, outerjoin=None,
-                         order=None):
+                         order=None, load_only=None):
+        """
+        :param load_only: names of entity columns to load, the rest are deferred (loaded on access)
+        """
         if not order and hasattr(self.entity, "created"):
             order = {"field": "created", "order": 1}
 
@@ -108,17 +115,10 @@ class VersionObject:
             *fetch_args,
         )
 
-        if join:
-            q = q.join(*join)
-
-        if outerjoin:
-            q = q.outerjoin(*outerjoin)
-
-        if filter_q:
-            q = q.filter(*filter_q)
+        q = self._add_filters(q, filter_q=filter_q, filter_by_q=filter_by_q, join=join, outerjoin=outerjoin)
 
-        if filter_by_q:
-            q = q.filter_by(**filter_by_q)
+        if load_only:
+            q = q.options(orm.load_only(*load_only))
 
         if group_by:
             q = q.group_by(*group_by)
@@ -136,6 +136,59 @@ class VersionObject:
 
         return q
 
+    def filter_page(self, *, cursor=None, limit=None, filter_q=None, filter_by_q=None, join=None, outerjoin=None,
+                    fetch_args=None, order=None, with_total=False, form_items=None, load_only=None):
+        """
+        Keyset pagination by (created, primary key). Unlike filter, a page is found by the index without skipping
+        previous rows, so deep pages are as fast as the first one, and the total is counted only on request.
+
+        :param cursor: next_cursor of the previous page, None - the first page
+        :param order: sorting by created only (1 or -1), the primary key breaks ties
+        :param with_total: count all matching rows with a separate query
+        :param load_only: names of entity columns to load, the rest are deferred (loaded on access)
+        :return: items, next_cursor (None on the last page) and total (None without with_total)
+        """
+        descending = self._keyset_descending(order)
+        sort_direct = desc if descending else asc
+
+        if limit is None:
+            limit = 50
+
+        created_field = self.entity.created
+        key_field = self._primary_key_field()
+
+        with self.create_session() as session:
+            q = self._add_filters(session.query(self.entity), filter_q=filter_q, filter_by_q=filter_by_q, join=join,
+                                  outerjoin=outerjoin)
+
+            total_items = q.count() if with_total else None
+
+            if cursor is not None:
+                position = sa.tuple_(created_field, key_field)
+                cursor_position = sa.tuple_(*self._decode_cursor(cursor))
+                q = q.filter(position < cursor_position if descending else position > cursor_position)
+
+            if load_only:
+                q = q.options(orm.load_only(*load_only))
+
+            if fetch_args:
+                q = q.add_columns(*fetch_args)
+
+            q = q.order_by(sort_direct(created_field), sort_direct(key_field)).limit(limit + 1)
+
+            # Rows are (entity, *fetch_args) as in filter
+            items = [it if fetch_args else (it,) for it in q.all()]
+
+            next_cursor = None
+            if len(items) > limit:
+                items = items[:limit]
+                last = items[-1][0]
+                next_cursor = self._encode_cursor(last.created, getattr(last, self.primary_key))
+
+            result_items = form_items(items) if form_items else [it[0].to_dict() for it in items]
+
+            return result_items, next_cursor, total_items
+
     def get(self, id, *, session=None):
         if session:
             it = self._fetch(id, session=session)
@@ -152,6 +205,47 @@ class VersionObject:
             with self.create_session() as session:
                 return self._remove(id=id, session=session)
 
+    def _add_filters(self, q, *, filter_q=None, filter_by_q=None, join=None, outerjoin=None):
+        if join:
+            q = q.join(*join)
+
+        if outerjoin:
+            q = q.outerjoin(*outerjoin)
+
+        if filter_q:
+            q = q.filter(*filter_q)
+
+        if filter_by_q:
+            q = q.filter_by(**filter_by_q)
+
+        return q
+
+    def _keyset_descending(self, order):
+        if order is None:
+            return False
+
+        if isinstance(order, dict):
+            order = [order]
+        self._validate_order(order)
+
+        if len(order) != 1 or order[0]["field"] != "created":
+            raise ValueError("Cursor pagination supports sorting by created only")
+
+        return order[0]["order"] == -1
+
+    @staticmethod
+    def _encode_cursor(created, key):
+        data = json.dumps([created.isoformat(), str(key)])
+        return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            created, key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            return datetime.datetime.fromisoformat(created), key
+        except (AttributeError, TypeError, ValueError):
+            raise ApiError(message="Invalid cursor in request", code="INVALID_PARAMS")
+
     def _validate_id(self, id):
         if not len(self.primary_key) == len(id):
             raise ValueError("The count of fields in the primary key and the count of arguments do not match.")
@@ -0,0 +1,104 @@
+import logging
+import threading
+
+logger = logging.getLogger()
+
+# Причины отмены, они же итоговые статусы элементов
+CANCELLED = "cancelled"
+TIMED_OUT = "timed_out"
+
+
+class ItemCancelled(Exception):
+    """
+    Обработка элемента прервана отменой или таймаутом
+    """
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancelToken:
+    """
+    Признак отмены обработки элемента очереди.
+
+    Обработчик отменяет токен по запросу отмены или по таймауту, функция
+    задачи проверяет его между этапами. Долгие блокирующие операции (SSH,
+    подпроцессы) регистрируют обратные вызовы, которые прерывают их сразу
+    при отмене:
+
+        token.add_callback(kill)
+        try:
+            wait_process()
+        finally:
+            token.remove_callback(kill)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._reason = None
+        self._callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def reason(self):
+        """
+        Причина отмены (итоговый статус элемента) или None
+        """
+        return self._reason
+
+    def cancel(self, reason) -> bool:
+        """
+        Отмена. Повторная отмена ничего не делает, причина остается первой.
+
+        :return: True, если токен отменен этим вызовом
+        """
+        with self._lock:
+            if self._event.is_set():
+                return False
+
+            self._reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks)
+
+        for callback in callbacks:
+            self._call(callback)
+
+        return True
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Ожидание отмены
+
+        :return: True, если токен отменен
+        """
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise ItemCancelled(self._reason)
+
+    def add_callback(self, callback):
+        """
+        Регистрация callback(reason), который вызывается при отмене. Если
+        токен уже отменен, вызывается сразу.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+
+        self._call(callback)
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self._reason)
+        except Exception:
+            logger.exception("Cancel callback error")
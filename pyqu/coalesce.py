@@ -0,0 +1,45 @@
+def merge_coalesced(items):
+    """
+    Поля запросов, объединяемых по coalesce_key: наибольший priority и
+    meta, extra всех запросов (при совпадении ключей - из более позднего)
+
+    :return: словарь coalesce_key -> {"priority", "meta", "extra"}
+    """
+    merged = {}
+    for fields in items:
+        key = fields.get("coalesce_key")
+        if key is None:
+            continue
+
+        values = merged.setdefault(key, {
+            "priority": 0, "meta": {}, "extra": None,
+        })
+        values["priority"] = max(
+            values["priority"], fields.get("priority") or 0
+        )
+        values["meta"].update(fields.get("meta") or {})
+        if fields.get("extra") is not None:
+            values["extra"] = dict(values["extra"] or {}, **fields["extra"])
+
+    return merged
+
+
+def coalesced_update(item, values):
+    """
+    Изменения ожидающего элемента item (to_dict()) при объединении с ним
+    запросов с полями values (см. merge_coalesced)
+    """
+    update = {}
+    if values["priority"] > (item.get("priority") or 0):
+        update["priority"] = values["priority"]
+
+    meta = dict(item.get("meta") or {}, **values["meta"])
+    if meta != (item.get("meta") or {}):
+        update["meta"] = meta
+
+    if values["extra"] is not None:
+        extra = dict(item.get("extra") or {}, **values["extra"])
+        if extra != item.get("extra"):
+            update["extra"] = extra
+
+    return update
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Optional
 
 
 class WorkerContext:
@@ -33,6 +33,222 @@ class ProcessBackend(ABC):
     def wait(self, timeout=None):
         pass
 
+    def stats(self) -> List[dict]:
+        """
+        Состояние обработчиков
+        """
+        return []
+
+
+class QueueLimit:
+    """
+    Ограничение выборки для группы обработчиков (например, слотов одного
+    хоста): сколько элементов они могут выполнять одновременно и сколько
+    выбрать за минуту
+    """
+    def __init__(self, key, worker_names, max_working=None,
+                 max_per_minute=None):
+        """
+        :param key: уникальное имя ограничения
+        :param worker_names: имена обработчиков, на которых оно действует
+        :param max_working: максимум одновременно выполняемых элементов
+        :param max_per_minute: максимум выбранных элементов за минуту
+        """
+        self.key = key
+        self.worker_names = list(worker_names)
+        self.max_working = max_working
+        self.max_per_minute = max_per_minute
+
+    def __repr__(self):
+        return "QueueLimit(key=%r, max_working=%r, max_per_minute=%r)" % (
+            self.key, self.max_working, self.max_per_minute
+        )
+
+
+class QueueRoute:
+    """
+    Условия выборки элементов очереди обработчиком: тип и значения аргументов
+    """
+    def __init__(self, item_type=None, json_args=None, limits=None):
+        """
+        :param item_type: тип элемента, None - любой
+        :param json_args: список пар (аргумент, значение)
+        :param limits: список QueueLimit, которые проверяются при выборке
+        """
+        self.item_type = item_type
+        self.json_args = list(json_args or [])
+        self.limits = list(limits or [])
+
+        for arg in self.json_args:
+            assert isinstance(arg, (tuple, list))
+
+    def __repr__(self):
+        return "QueueRoute(item_type=%r, json_args=%r, limits=%r)" % (
+            self.item_type, self.json_args, self.limits
+        )
+
+
+class QueueItem:
+    """
+    Элемент, выбранный обработчиком из очереди
+    """
+    def __init__(self, *, item_id, type, script, args, timeout=None):
+        """
+        :param timeout: ограничение времени обработки (в секундах), None -
+            по умолчанию для типа
+        """
+        self.item_id = item_id
+        self.type = type
+        self.script = script
+        self.args = args or {}
+        self.timeout = timeout
+
+    def __repr__(self):
+        return "QueueItem(item_id=%r, type=%r, script=%r)" % (
+            self.item_id, self.type, self.script
+        )
+
 
 class QueueBackend(ABC):
-    pass
+    @abstractmethod
+    def enqueue(self, *, coalesce_key=None, **fields) -> dict:
+        """
+        Добавление элемента в очередь
+
+        :param coalesce_key: ключ объединения. Если в очереди уже ждет
+        элемент с таким ключом, новый не создается, возвращается ожидающий
+        (его priority поднимается до переданного).
+        :return: сохраненный элемент
+        """
+        pass
+
+    def enqueue_many(self, items: List[dict]) -> List[dict]:
+        """
+        Добавление пачки элементов в очередь
+
+        :param items: поля элементов, как в enqueue (включая coalesce_key)
+        :return: сохраненные элементы в порядке items
+        """
+        return [self.enqueue(**fields) for fields in items]
+
+    def claim(self, route: QueueRoute, worker_name) -> Optional[QueueItem]:
+        """
+        Выбор одного элемента и блокировка его за обработчиком
+
+        :return: элемент или None, если очередь пуста
+        """
+        items = self.claim_many(route, worker_name, limit=1)
+        return items[0] if items else None
+
+    @abstractmethod
+    def claim_many(self, route: QueueRoute, worker_name,
+                   limit) -> List[QueueItem]:
+        """
+        Выбор пачки элементов и блокировка их за обработчиком. Пачка
+        уменьшается, чтобы не превысить ограничения route.limits.
+        """
+        pass
+
+    @abstractmethod
+    def ack(self, item_id, *, worker_name=None, result=None, extra=None,
+            status=None) -> bool:
+        """
+        Успешное завершение обработки элемента
+
+        :param worker_name: обработчик, за которым должен быть заблокирован
+        элемент. Если элемент уже освобожден (например, истекла аренда),
+        результат не записывается.
+        :param status: итоговый статус вместо FINISHED (например, элемент
+        вытеснен более новым)
+        :return: True, если результат записан
+        """
+        pass
+
+    @abstractmethod
+    def nack(self, item_id, *, worker_name=None, errortext=None,
+             result=None) -> bool:
+        """
+        Завершение обработки элемента с ошибкой
+
+        :return: True, если результат записан
+        """
+        pass
+
+    @abstractmethod
+    def requeue(self, item_id):
+        """
+        Возврат элемента в очередь
+        """
+        pass
+
+    @abstractmethod
+    def heartbeat(self, item_id, worker_name) -> bool:
+        """
+        Продление аренды элемента обработчиком
+
+        :return: False, если элемент больше не заблокирован обработчиком
+        """
+        pass
+
+    @abstractmethod
+    def release_locked(self, worker_name, *, max_attempts,
+                       max_attempts_by_type=None, result=None) -> int:
+        """
+        Освобождение элементов, заблокированных обработчиком (например,
+        оставшихся после его перезапуска). Элементы с неисчерпанными
+        попытками возвращаются в очередь, остальные завершаются с ошибкой.
+        Элементы с запрошенной отменой получают статус CANCELLED.
+
+        :param max_attempts: количество попыток по умолчанию
+        :param max_attempts_by_type: количество попыток по типам элементов
+        :param result: результат элементов, завершенных с ошибкой
+        :return: количество элементов
+        """
+        pass
+
+    @abstractmethod
+    def reap_expired(self, *, max_attempts, max_attempts_by_type=None,
+                     result=None) -> int:
+        """
+        Освобождение элементов с истекшей арендой по тем же правилам, что
+        и release_locked
+
+        :return: количество элементов
+        """
+        pass
+
+    @abstractmethod
+    def is_superseded(self, item_id) -> bool:
+        """
+        Есть ли в очереди более новый элемент с тем же ключом объединения,
+        ожидающий или выполняемый. Используется долгими обработчиками, чтобы
+        прервать устаревшую работу.
+        """
+        pass
+
+    @abstractmethod
+    def cancel(self, item_id) -> Optional[str]:
+        """
+        Отмена элемента. Ожидающий элемент сразу получает статус CANCELLED,
+        для выполняемого выставляется запрос отмены, который обработчик
+        проверяет при продлении аренды (см. is_cancel_requested).
+
+        :return: статус элемента после вызова или None, если элемента нет
+        """
+        pass
+
+    @abstractmethod
+    def is_cancel_requested(self, item_id) -> bool:
+        """
+        Запрошена ли отмена выполняемого элемента
+        """
+        pass
+
+    @abstractmethod
+    def wait(self, route: QueueRoute, timeout) -> bool:
+        """
+        Ожидание появления новых элементов
+
+        :return: True, если элементы могли появиться до истечения timeout
+        """
+        pass
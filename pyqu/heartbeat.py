@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+
+from pyqu.cancel import CANCELLED, TIMED_OUT, CancelToken
+from pyqu.core import QueueBackend
+
+logger = logging.getLogger()
+
+
+class Heartbeat:
+    """
+    Продление аренды элемента очереди, пока обработчик его выполняет.
+
+    Продление идет в отдельном потоке, поэтому аренда не истекает, даже если
+    функция задачи надолго блокируется (SSH, HTTP). Если поток обработчика
+    умер вместе с процессом, продление прекращается и элемент освобождает
+    reap_expired.
+
+    Если передан cancel_token, тот же поток следит за отменой: токен
+    отменяется по истечении timeout (причина TIMED_OUT) или по запросу
+    отмены элемента (причина CANCELLED). Если функция не завершилась за
+    grace секунд после отмены, вызывается on_stuck (например, завершение
+    процесса обработчика), и аренда больше не продлевается: on_stuck
+    отвечает за итоговый статус элемента.
+
+        with Heartbeat(queue, item.item_id, worker_name, interval=15):
+            function(**kwargs)
+    """
+    def __init__(self, queue: QueueBackend, item_id, worker_name, interval,
+                 cancel_token: CancelToken = None, timeout=None, grace=None,
+                 on_stuck=None):
+        """
+        :param queue: очередь, в которой арендован элемент
+        :param item_id: идентификатор элемента
+        :param worker_name: имя обработчика, арендовавшего элемент
+        :param interval: период продления (в секундах), должен быть заметно
+            меньше срока аренды
+        :param cancel_token: токен отмены обработки элемента
+        :param timeout: ограничение времени обработки (в секундах)
+        :param grace: сколько ждать завершения функции после отмены
+        :param on_stuck: вызывается, если функция не завершилась за grace
+        """
+        self._queue = queue
+        self._item_id = item_id
+        self._worker_name = worker_name
+        self._interval = interval
+        self._cancel_token = cancel_token
+        self._timeout = timeout
+        self._grace = grace
+        self._on_stuck = on_stuck
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self._run, name="heartbeat-%s" % self._worker_name,
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        started = time.monotonic()
+        next_beat = started + self._interval
+        deadline = started + self._timeout if self._timeout else None
+        grace = self._grace
+        stuck_at = None
+
+        while True:
+            now = time.monotonic()
+            wake_at = min(
+                it for it in (next_beat, deadline, stuck_at) if it is not None
+            )
+            if self._stopped.wait(max(wake_at - now, 0)):
+                return
+
+            now = time.monotonic()
+
+            if deadline is not None and now >= deadline:
+                deadline = None
+                self._cancel(TIMED_OUT)
+
+            if stuck_at is None and grace is not None \
+                    and self._cancel_token is not None \
+                    and self._cancel_token.cancelled:
+                stuck_at = now + grace
+            elif stuck_at is not None and now >= stuck_at:
+                logger.error(
+                    "Item %s is not stopped %s s after cancel",
+                    self._item_id, grace
+                )
+                if self._on_stuck is not None:
+                    self._on_stuck()
+                    return
+                grace = stuck_at = None
+
+            if now >= next_beat:
+                next_beat = now + self._interval
+                if not self._beat():
+                    return
+
+    def _beat(self) -> bool:
+        """
+        Продление аренды и проверка запроса отмены
+
+        :return: False, если аренда потеряна
+        """
+        try:
+            alive = self._queue.heartbeat(self._item_id, self._worker_name)
+            if alive and self._cancel_token is not None \
+                    and not self._cancel_token.cancelled \
+                    and self._queue.is_cancel_requested(self._item_id):
+                self._cancel(CANCELLED)
+        except Exception:
+            # Ошибка БД не повод прерывать задачу: аренда продлится
+            # следующей попыткой, если успеет до истечения
+            logger.exception(
+                "Heartbeat error: item=%s", self._item_id
+            )
+            return True
+
+        if not alive:
+            logger.error(
+                "Lease lost: item=%s; worker=%s",
+                self._item_id, self._worker_name
+            )
+
+        return alive
+
+    def _cancel(self, reason):
+        if self._cancel_token is None:
+            return
+
+        if self._cancel_token.cancel(reason):
+            logger.warning(
+                "Item %s cancelled: %s", self._item_id, reason
+            )
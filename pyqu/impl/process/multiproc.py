@@ -1,5 +1,6 @@
 import logging
 import multiprocessing
+import multiprocessing.connection
 import time
 from typing import List
 
@@ -7,44 +8,161 @@ from pyqu.core import ProcessBackend, WorkerContext, WorkerData
 
 logger = logging.getLogger()
 
+# Код выхода обработчика, который завершился сам для перезапуска (например,
+# чтобы освободить память). Такой выход не считается падением: обработчик
+# перезапускается сразу, задержка перезапуска сбрасывается.
+RECYCLE_EXIT_CODE = 75
+
+
+class RestartBackoff:
+    """
+    Задержка перезапуска обработчика. Процесс, проживший меньше min_uptime,
+    считается упавшим при старте, и задержка для него растет
+    экспоненциально, чтобы не перезапускать его в цикле.
+    """
+    def __init__(self, min_uptime=10, initial_delay=1, max_delay=60):
+        """
+        :param min_uptime: минимальное время работы нормального процесса
+        :param initial_delay: задержка после первого падения
+        :param max_delay: максимальная задержка (все в секундах)
+        """
+        self.min_uptime = min_uptime
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+    def delay(self, failures):
+        if not failures:
+            return 0
+
+        return min(self.initial_delay * 2 ** (failures - 1), self.max_delay)
+
 
 class MultiprocessingWorker(WorkerData):
-    def __init__(self, worker_args: WorkerContext):
+    def __init__(self, worker_args: WorkerContext, context=None,
+                 backoff: RestartBackoff = None):
         self._worker_args = worker_args
+        self._context = context or multiprocessing.get_context()
+        self._backoff = backoff or RestartBackoff()
         self._process = self._start_process(worker_args)
 
+        self._started = None
+        self._restart_at = None
+        self._restarts = 0
+        self._failures = 0
+
     def start(self):
         self._process.start()
+        self._started = time.monotonic()
         logger.debug(
             "Start worker: pid=%s; %s", self._process.pid, self._worker_args
         )
 
+    @property
+    def sentinel(self):
+        """
+        Дескриптор, готовый к чтению после завершения процесса, или None,
+        если процесс не запущен
+        """
+        if self._restart_at is not None:
+            return None
+
+        return self._process.sentinel
+
+    @property
+    def restart_at(self):
+        """
+        Время (time.monotonic) отложенного перезапуска или None
+        """
+        return self._restart_at
+
     def ensure_alive(self):
-        if not self._process.is_alive():
-            logger.info(
-                "Restart worker: exitcode: %s; %s", self._process.exitcode,
-                self._worker_args
+        if self._process.is_alive():
+            return
+
+        now = time.monotonic()
+
+        if self._restart_at is None:
+            uptime = now - self._started
+            recycled = self._process.exitcode == RECYCLE_EXIT_CODE
+            if recycled or uptime >= self._backoff.min_uptime:
+                self._failures = 0
+            else:
+                self._failures += 1
+
+            delay = self._backoff.delay(self._failures)
+            self._restart_at = now + delay
+
+            log = logger.warning if self._failures else logger.info
+            log(
+                "Worker %s: exitcode: %s; uptime: %.1f s; "
+                "restart in %.1f s; restarts: %d; failures: %d; %s",
+                "recycled" if recycled else "exited",
+                self._process.exitcode, uptime, delay, self._restarts,
+                self._failures, self._worker_args
             )
-            self._process = self._start_process(self._worker_args)
-            self._process.start()
+
+        if now < self._restart_at:
+            return
+
+        self._restart_at = None
+        self._restarts += 1
+        self._process = self._start_process(self._worker_args)
+        self.start()
 
     def restart(self):
+        self._restart_at = None
+        self._restarts += 1
         self._process = self._start_process(self._worker_args)
-        self._process.start()
+        self.start()
 
     def terminate(self):
         if self._process.is_alive():
             self._process.terminate()
 
+    def stats(self) -> dict:
+        alive = self._process.is_alive()
+
+        return {
+            "worker_name": getattr(self._worker_args, "worker_name", None),
+            "pid": self._process.pid if alive else None,
+            "alive": alive,
+            "uptime": time.monotonic() - self._started if alive else 0,
+            "restarts": self._restarts,
+            "failures": self._failures,
+        }
+
     def _start_process(self, worker_args):
-        proc = multiprocessing.Process(target=worker_args.func,
-                                       args=(worker_args,))
+        proc = self._context.Process(target=worker_args.func,
+                                     args=(worker_args,))
         proc.daemon = True
         return proc
 
 
 class MultiprocessingProcessBackend(ProcessBackend):
-    def __init__(self):
+    """
+    Запуск обработчиков отдельными процессами.
+
+    В режиме forkserver процессы порождаются от сервера, в котором один раз
+    импортированы модули preload, поэтому перезапуск обработчика не тратит
+    время на импорт и инициализацию. Аргументы обработчиков при этом
+    передаются через pickle.
+
+    Супервизор не опрашивает процессы, а ждет завершения любого из них
+    (sentinel) или времени отложенного перезапуска.
+    """
+    def __init__(self, start_method=None, preload=None,
+                 backoff: RestartBackoff = None):
+        """
+        :param start_method: способ запуска multiprocessing (fork, spawn,
+            forkserver), None - по умолчанию для платформы
+        :param preload: модули, импортируемые сервером forkserver
+        :param backoff: задержки перезапуска упавших обработчиков
+        """
+        self._context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver" and preload:
+            self._context.set_forkserver_preload(list(preload))
+
+        self._backoff = backoff or RestartBackoff()
         self._processes: List[MultiprocessingWorker] = []
 
     def init(self, all_worker_args: List[WorkerContext]):
@@ -55,13 +173,28 @@ class MultiprocessingProcessBackend(ProcessBackend):
             proc.start()
 
     def wait(self, timeout=None):
-        start = time.time()
+        deadline = None if timeout is None else time.monotonic() + timeout
+
         while True:
             self.handle_cycle()
-            time.sleep(0.1)
-            now = time.time()
 
-            if timeout is not None and now - start >= timeout:
+            now = time.monotonic()
+            wait_timeout = self._until_next_restart(now)
+            if deadline is not None:
+                remaining = deadline - now
+                if remaining <= 0:
+                    break
+
+                if wait_timeout is None or wait_timeout > remaining:
+                    wait_timeout = remaining
+
+            sentinels = [proc.sentinel for proc in self._processes
+                         if proc.sentinel is not None]
+            if sentinels:
+                multiprocessing.connection.wait(sentinels, wait_timeout)
+            elif wait_timeout is not None:
+                time.sleep(wait_timeout)
+            else:
                 break
 
     def terminate(self):
@@ -72,7 +205,23 @@ class MultiprocessingProcessBackend(ProcessBackend):
         for proc in self._processes:
             proc.ensure_alive()
 
+    def stats(self) -> List[dict]:
+        """
+        Состояние обработчиков: pid, время работы, число перезапусков
+        """
+        return [proc.stats() for proc in self._processes]
+
+    def _until_next_restart(self, now):
+        restarts = [proc.restart_at for proc in self._processes
+                    if proc.restart_at is not None]
+        if not restarts:
+            return None
+
+        return max(min(restarts) - now, 0)
+
     def _init_processes(self, all_worker_args):
         for args in all_worker_args:
-            worker_process = MultiprocessingWorker(args)
+            worker_process = MultiprocessingWorker(
+                args, context=self._context, backoff=self._backoff
+            )
             self._processes.append(worker_process)
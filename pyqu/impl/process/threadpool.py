@@ -0,0 +1,238 @@
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future
+from typing import List
+
+from pyqu.core import ProcessBackend, WorkerContext, WorkerData
+
+logger = logging.getLogger()
+
+# Брошенные потоки: их функция задачи зависла, слот передан новому потоку
+_abandoned = set()
+_abandoned_lock = threading.Lock()
+# Будит супервизор, когда от потока отказались
+_wakeup = Future()
+
+
+def abandon_thread(thread: threading.Thread):
+    """
+    Отказ от потока обработчика, который нельзя прервать. Супервизор
+    запускает вместо него новый поток, а брошенный должен завершиться сам,
+    как только вернется из функции задачи (см. is_abandoned).
+    """
+    with _abandoned_lock:
+        _abandoned.add(thread)
+        if not _wakeup.done():
+            _wakeup.set_result(None)
+
+
+def is_abandoned(thread: threading.Thread) -> bool:
+    with _abandoned_lock:
+        return thread in _abandoned
+
+
+def _wakeup_future() -> Future:
+    global _wakeup
+
+    with _abandoned_lock:
+        if _wakeup.done():
+            _wakeup = Future()
+        return _wakeup
+
+
+class ThreadWorker(WorkerData):
+    # Поток обработчика перезапускается не раньше, чем через столько секунд
+    # после предыдущего запуска, чтобы падающий при старте поток не
+    # перезапускался в цикле
+    min_restart_interval = 1
+
+    def __init__(self, worker_args: WorkerContext):
+        self._worker_args = worker_args
+        self._thread, self._future = self._start_thread(worker_args)
+        self._started = None
+        self._restart_at = None
+        # Брошенные потоки этого обработчика, которые еще работают, и их
+        # future
+        self._abandoned = []
+
+    def start(self):
+        self._thread.start()
+        self._started = time.monotonic()
+        logger.debug(
+            "Start worker: thread=%s; %s", self._thread.name, self._worker_args
+        )
+
+    @property
+    def futures(self) -> List[Future]:
+        """
+        Future работающих потоков обработчика, завершаются вместе с потоком
+        """
+        return [future for future in [self._future] + [
+            future for _, future in self._abandoned
+        ] if not future.done()]
+
+    @property
+    def restart_at(self):
+        """
+        Время (time.monotonic) отложенного перезапуска или None
+        """
+        return self._restart_at
+
+    def ensure_alive(self):
+        for thread, future in self._abandoned:
+            if future.done():
+                with _abandoned_lock:
+                    _abandoned.discard(thread)
+        self._abandoned = [
+            (thread, future) for thread, future in self._abandoned
+            if not future.done()
+        ]
+
+        if is_abandoned(self._thread):
+            logger.warning("Replace abandoned worker: thread=%s; %s",
+                           self._thread.ident, self._worker_args)
+            self._abandoned.append((self._thread, self._future))
+            self.restart()
+            return
+
+        if not self._future.done():
+            return
+
+        now = time.monotonic()
+        if self._restart_at is None:
+            self._restart_at = max(
+                now, self._started + self.min_restart_interval
+            )
+
+        if now < self._restart_at:
+            return
+
+        logger.info("Restart worker: %s", self._worker_args)
+        self.restart()
+
+    @property
+    def abandoned(self) -> int:
+        """
+        Сколько брошенных потоков обработчика еще не завершилось
+        """
+        return len(self._abandoned)
+
+    def restart(self):
+        self._restart_at = None
+        self._thread, self._future = self._start_thread(self._worker_args)
+        self.start()
+
+    def terminate(self):
+        # Потоки нельзя прервать снаружи: они daemon и завершаются вместе
+        # с процессом
+        pass
+
+    def _start_thread(self, worker_args):
+        # Future завершается, когда функция обработчика вышла: супервизор
+        # ждет его вместо опроса потоков
+        future = Future()
+
+        def run():
+            try:
+                worker_args.func(worker_args)
+            except Exception:
+                logger.exception("Worker failed: %s", worker_args)
+            finally:
+                future.set_result(None)
+
+        thread = threading.Thread(
+            target=run, name=getattr(worker_args, "worker_name", None),
+        )
+        thread.daemon = True
+        return thread, future
+
+
+class ThreadPoolProcessBackend(ProcessBackend):
+    """
+    Запуск обработчиков потоками одного процесса. Подходит для задач,
+    которые в основном ждут сеть (HTTP, SSH): много слотов обходятся без
+    отдельного процесса на каждый.
+
+    Как и MultiprocessingProcessBackend, супервизор не опрашивает потоки, а
+    ждет завершения любого из них (future) или времени отложенного
+    перезапуска.
+
+    Функции обработчиков должны быть потокобезопасны и не разделять сессии
+    БД между потоками.
+
+    Поток, от которого отказались (abandon_thread), заменяется новым, а сам
+    работает, пока не вернется из зависшей функции. Если таких потоков
+    больше max_abandoned, процесс завершается, чтобы супервизор перезапустил
+    его и освободил ресурсы.
+    """
+    def __init__(self, max_abandoned=None):
+        """
+        :param max_abandoned: сколько брошенных потоков может работать
+            одновременно, None - без ограничения
+        """
+        self._threads: List[ThreadWorker] = []
+        self._max_abandoned = max_abandoned
+
+    def init(self, all_worker_args: List[WorkerContext]):
+        self._init_threads(all_worker_args)
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            # Берется до проверки потоков, чтобы не пропустить отказ от
+            # потока во время проверки
+            wakeup = _wakeup_future()
+            self.handle_cycle()
+
+            now = time.monotonic()
+            wait_timeout = self._until_next_restart(now)
+            if deadline is not None:
+                remaining = deadline - now
+                if remaining <= 0:
+                    break
+
+                if wait_timeout is None or wait_timeout > remaining:
+                    wait_timeout = remaining
+
+            futures = [wakeup] + [
+                future for thread in self._threads
+                for future in thread.futures
+            ]
+            concurrent.futures.wait(
+                futures, wait_timeout, return_when=FIRST_COMPLETED
+            )
+
+    def terminate(self):
+        for thread in self._threads:
+            thread.terminate()
+
+    def handle_cycle(self):
+        for thread in self._threads:
+            thread.ensure_alive()
+
+        abandoned = sum(thread.abandoned for thread in self._threads)
+        if self._max_abandoned is not None \
+                and abandoned > self._max_abandoned:
+            logger.error("Too many abandoned threads: %d, exit", abandoned)
+            os._exit(1)
+
+    def _until_next_restart(self, now):
+        restarts = [thread.restart_at for thread in self._threads
+                    if thread.restart_at is not None]
+        if not restarts:
+            return None
+
+        return max(min(restarts) - now, 0)
+
+    def _init_threads(self, all_worker_args):
+        for args in all_worker_args:
+            worker_thread = ThreadWorker(args)
+            self._threads.append(worker_thread)
@@ -0,0 +1,342 @@
+import collections
+import datetime
+import json
+import threading
+import uuid
+from typing import List, Optional
+
+from pyqu.cancel import CANCELLED
+from pyqu.coalesce import coalesced_update, merge_coalesced
+from pyqu.core import QueueBackend, QueueItem, QueueRoute
+
+ENQUEUED = "enqueued"
+WORKING = "working"
+FINISHED = "finished"
+FAILED = "failed"
+
+
+class QueueMemoryBackend(QueueBackend):
+    """
+    Очередь в памяти процесса. Для тестов и замеров обработчиков без БД,
+    между процессами не разделяется.
+    """
+    def __init__(self, lease_sec=60, fair_share_keys=None,
+                 fair_share_window_sec=600):
+        self._items = {}
+        self._cond = threading.Condition()
+        self._lease = datetime.timedelta(seconds=lease_sec)
+        self._fair_share_keys = list(fair_share_keys or [])
+        self._fair_share_window = datetime.timedelta(
+            seconds=fair_share_window_sec
+        )
+
+    def enqueue(self, *, coalesce_key=None, **fields) -> dict:
+        item = dict(fields, coalesce_key=coalesce_key)
+        item.setdefault("task_id", str(uuid.uuid4()))
+        item.setdefault("created", datetime.datetime.now())
+        if item.get("priority") is None:
+            item["priority"] = 0
+        item["status"] = ENQUEUED
+        item["locked_by"] = None
+        item["locked_at"] = None
+        item["lease_expires"] = None
+        item["attempts"] = 0
+        item["cancel_requested"] = False
+
+        with self._cond:
+            coalesced = self._find_coalesced(coalesce_key)
+            if coalesced is not None:
+                coalesced.update(coalesced_update(
+                    coalesced, merge_coalesced([item])[coalesce_key]
+                ))
+                return dict(coalesced)
+
+            self._items[item["task_id"]] = item
+            self._cond.notify_all()
+
+        return dict(item)
+
+    def claim_many(self, route: QueueRoute, worker_name,
+                   limit) -> List[QueueItem]:
+        with self._cond:
+            now = datetime.datetime.now()
+            limit = self._apply_limits(route.limits, limit, now)
+            if limit <= 0:
+                return []
+
+            found = self._ranked(
+                [it for it in self._items.values() if self._match(it, route)],
+                now,
+            )[:limit]
+
+            for item in found:
+                item["status"] = WORKING
+                item["locked_by"] = worker_name
+                item["locked_at"] = now
+                item["updated"] = now
+                item["lease_expires"] = now + self._lease
+                item["attempts"] += 1
+
+            return [self._to_item(it) for it in found]
+
+    def ack(self, item_id, *, worker_name=None, result=None, extra=None,
+            status=None) -> bool:
+        values = {"status": status or FINISHED, "result": result}
+        if extra is not None:
+            values["extra"] = extra
+
+        return self._update(item_id, values, worker_name=worker_name)
+
+    def nack(self, item_id, *, worker_name=None, errortext=None,
+             result=None) -> bool:
+        values = {"status": FAILED, "errortext": errortext}
+        if result is not None:
+            values["result"] = result
+
+        return self._update(item_id, values, worker_name=worker_name)
+
+    def requeue(self, item_id):
+        self._update(item_id, {
+            "status": ENQUEUED, "locked_by": None, "lease_expires": None,
+        })
+
+    def heartbeat(self, item_id, worker_name) -> bool:
+        with self._cond:
+            item = self._items[item_id]
+            if not self._is_locked_by(item, worker_name):
+                return False
+
+            item["lease_expires"] = datetime.datetime.now() + self._lease
+            return True
+
+    def release_locked(self, worker_name, *, max_attempts,
+                       max_attempts_by_type=None, result=None) -> int:
+        return self._release(
+            lambda it: it["locked_by"] == worker_name,
+            max_attempts=max_attempts,
+            max_attempts_by_type=max_attempts_by_type, result=result,
+        )
+
+    def reap_expired(self, *, max_attempts, max_attempts_by_type=None,
+                     result=None) -> int:
+        now = datetime.datetime.now()
+        return self._release(
+            lambda it: it["lease_expires"] < now,
+            max_attempts=max_attempts,
+            max_attempts_by_type=max_attempts_by_type, result=result,
+        )
+
+    def is_superseded(self, item_id) -> bool:
+        with self._cond:
+            item = self._items[item_id]
+            if item["coalesce_key"] is None:
+                return False
+
+            return any(
+                it["coalesce_key"] == item["coalesce_key"]
+                and it["created"] > item["created"]
+                and it["status"] in (ENQUEUED, WORKING)
+                for it in self._items.values()
+            )
+
+    def cancel(self, item_id) -> Optional[str]:
+        with self._cond:
+            item = self._items.get(item_id)
+            if item is None:
+                return None
+
+            if item["status"] == ENQUEUED:
+                item["status"] = CANCELLED
+                item["updated"] = datetime.datetime.now()
+            elif item["status"] == WORKING:
+                item["cancel_requested"] = True
+
+            return item["status"]
+
+    def is_cancel_requested(self, item_id) -> bool:
+        with self._cond:
+            return self._items[item_id]["cancel_requested"]
+
+    def wait(self, route: QueueRoute, timeout) -> bool:
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: any(
+                    self._match(it, route) for it in self._items.values()
+                ) and self._apply_limits(
+                    route.limits, 1, datetime.datetime.now()
+                ) > 0,
+                timeout=timeout,
+            )
+
+    def get(self, item_id) -> dict:
+        """
+        Текущее состояние элемента
+        """
+        with self._cond:
+            return dict(self._items[item_id])
+
+    def _update(self, item_id, values, worker_name=None) -> bool:
+        with self._cond:
+            item = self._items[item_id]
+            if worker_name is not None:
+                if not self._is_locked_by(item, worker_name):
+                    return False
+                item["lease_expires"] = None
+
+            item.update(values)
+            item["updated"] = datetime.datetime.now()
+
+            # Будим и ожидающих освобождения места по ограничениям
+            self._cond.notify_all()
+
+            return True
+
+    def _release(self, match, *, max_attempts, max_attempts_by_type,
+                 result) -> int:
+        max_attempts_by_type = max_attempts_by_type or {}
+
+        with self._cond:
+            released = [it for it in self._items.values()
+                        if it["status"] == WORKING and match(it)]
+
+            for item in released:
+                attempts = max_attempts_by_type.get(item["type"], max_attempts)
+                exhausted = item["attempts"] >= attempts
+                if item["cancel_requested"]:
+                    item["status"] = CANCELLED
+                elif exhausted:
+                    item["status"] = FAILED
+                else:
+                    item["status"] = ENQUEUED
+
+                # Как и в postgres, результат пишется по числу попыток
+                # независимо от итогового статуса
+                if exhausted:
+                    item["result"] = result
+
+                item["locked_by"] = None
+                item["lease_expires"] = None
+
+            if released:
+                self._cond.notify_all()
+
+            return len(released)
+
+    def _apply_limits(self, limits, limit, now):
+        minute_ago = now - datetime.timedelta(minutes=1)
+
+        for queue_limit in limits:
+            locked = [it for it in self._items.values()
+                      if it["locked_by"] in queue_limit.worker_names]
+
+            if queue_limit.max_working is not None:
+                working = sum(1 for it in locked if it["status"] == WORKING)
+                limit = min(limit, queue_limit.max_working - working)
+
+            if queue_limit.max_per_minute is not None:
+                claimed = sum(1 for it in locked
+                              if it["locked_at"] > minute_ago)
+                limit = min(limit, queue_limit.max_per_minute - claimed)
+
+        return limit
+
+    def _find_coalesced(self, coalesce_key):
+        if coalesce_key is None:
+            return None
+
+        for item in self._items.values():
+            if (item["status"] == ENQUEUED
+                    and item["coalesce_key"] == coalesce_key):
+                return item
+
+        return None
+
+    def _ranked(self, items, now):
+        """
+        Очередность выборки как в QueuePostgresSqlachemyBackend
+        """
+        items = sorted(items, key=lambda it: (-it["priority"], it["created"]))
+
+        ranks = {}
+        counters = collections.Counter()
+        for item in items:
+            owner = self._owner(item)
+            counters[owner] += 1
+            ranks[item["task_id"]] = counters[owner]
+
+        if not self._fair_share_keys:
+            return sorted(items, key=lambda it: (
+                -it["priority"], ranks[it["task_id"]], it["created"]
+            ))
+
+        # Выполняемые элементы владельцев и время их последней выборки
+        working = collections.Counter()
+        last_locked = {}
+        window_start = now - self._fair_share_window
+        for item in self._items.values():
+            locked_at = item["locked_at"]
+            recent = locked_at is not None and locked_at > window_start
+            if item["status"] != WORKING and not recent:
+                continue
+
+            owner = self._owner(item)
+            if item["status"] == WORKING:
+                working[owner] += 1
+            if locked_at is not None and locked_at > last_locked.get(
+                    owner, datetime.datetime.min):
+                last_locked[owner] = locked_at
+
+        return sorted(items, key=lambda it: (
+            -it["priority"],
+            ranks[it["task_id"]] + working[self._owner(it)],
+            last_locked.get(self._owner(it), datetime.datetime.min),
+            it["created"],
+        ))
+
+    def _owner(self, item):
+        for field, key in self._fair_share_keys:
+            value = (item.get(field) or {}).get(key)
+            if value is not None:
+                return str(value)
+
+        return None
+
+    @staticmethod
+    def _is_locked_by(item, worker_name):
+        return item["status"] == WORKING and item["locked_by"] == worker_name
+
+    @staticmethod
+    def _match(item, route: QueueRoute):
+        if item["status"] != ENQUEUED:
+            return False
+
+        if route.item_type and item["type"] != route.item_type:
+            return False
+
+        args = item.get("args") or {}
+        for name, value in route.json_args:
+            if QueueMemoryBackend._json_text(args.get(name)) != value:
+                return False
+
+        return True
+
+    @staticmethod
+    def _json_text(value):
+        """
+        Значение как текст args->>name в postgres: строка без кавычек,
+        остальное - JSON (true, 1.5), null - NULL
+        """
+        if value is None or isinstance(value, str):
+            return value
+
+        return json.dumps(value)
+
+    @staticmethod
+    def _to_item(item) -> QueueItem:
+        return QueueItem(
+            item_id=item["task_id"],
+            type=item["type"],
+            script=item["script"],
+            args=item.get("args"),
+            timeout=item.get("timeout"),
+        )
@@ -1,5 +1,730 @@
-from pyqu.core import QueueBackend
+import collections
+import datetime
+import logging
+import select
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+import psycopg2
+import sqlalchemy as sa
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import aliased
+
+from pyqu.coalesce import coalesced_update, merge_coalesced
+from pyqu.core import QueueBackend, QueueItem, QueueRoute
+
+logger = logging.getLogger()
+
+# Первый ключ pg_advisory_xact_lock(int, int) для блокировок ограничений
+# выборки, чтобы они не пересекались с другими advisory-блокировками
+LIMIT_LOCK_CLASS = 7079
+
+
+class PostgresNotifyListener:
+    """
+    Ожидание уведомлений NOTIFY на канале postgres.
+
+    Держит отдельное соединение в режиме autocommit: уведомления доставляются
+    только вне транзакции. Соединение отсоединяется от пула sqlalchemy, чтобы
+    подписка LISTEN не досталась другим сессиям.
+
+    Один слушатель может использоваться из нескольких потоков: соединение
+    читает один из ожидающих потоков, остальные ждут на условии. Уведомление,
+    прочитанное до начала ожидания потока, этот поток не разбудит, поэтому
+    ожидание всегда ограничивается таймаутом.
+    """
+    def __init__(self, engine, channel, retry_interval=2):
+        """
+        :param engine: sqlalchemy engine
+        :param channel: канал LISTEN
+        :param retry_interval: пауза после ошибки соединения (в секундах)
+        """
+        self._engine = engine
+        self._channel = channel
+        self._retry_interval = retry_interval
+        self._conn = None
+
+        self._conn_lock = threading.RLock()
+        self._cond = threading.Condition()
+        self._polling = False
+        self._received = collections.Counter()
+
+    def listen(self) -> bool:
+        """
+        Подписка на канал. Нужно вызывать до первой выборки задач, иначе
+        уведомления, пришедшие между выборкой и ожиданием, будут потеряны.
+
+        :return: True, если подписка активна
+        """
+        with self._conn_lock:
+            if self._conn is not None:
+                return True
+
+            try:
+                conn = self._engine.raw_connection()
+                conn.detach()
+                conn.connection.set_isolation_level(
+                    ISOLATION_LEVEL_AUTOCOMMIT
+                )
+
+                cursor = conn.cursor()
+                cursor.execute('LISTEN "%s"' % self._channel)
+                cursor.close()
+
+            except (OSError, psycopg2.Error):
+                logger.exception("Can't listen channel %s", self._channel)
+                return False
+
+            self._conn = conn
+            return True
+
+    def wait(self, timeout, payloads=None) -> bool:
+        """
+        Ожидание уведомления
+
+        :param timeout: максимальное время ожидания (в секундах)
+        :param payloads: интересующие значения payload, None - любые
+        :return: True, если пришло подходящее уведомление
+        """
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            seen = self._snapshot(payloads)
+
+        while True:
+            with self._cond:
+                if self._snapshot(payloads) != seen:
+                    return True
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+
+                if self._polling:
+                    self._cond.wait(remaining)
+                    continue
+
+                self._polling = True
+
+            try:
+                self._poll(remaining)
+            finally:
+                with self._cond:
+                    self._polling = False
+                    self._cond.notify_all()
+
+    def close(self):
+        with self._conn_lock:
+            if self._conn is None:
+                return
+
+            try:
+                self._conn.close()
+            except (OSError, psycopg2.Error):
+                pass
+            finally:
+                self._conn = None
+
+    def _poll(self, timeout):
+        if not self.listen():
+            time.sleep(min(timeout, self._retry_interval))
+            return
+
+        try:
+            dbapi_conn = self._conn.connection
+
+            if not dbapi_conn.notifies:
+                readable, _, _ = select.select([dbapi_conn], [], [], timeout)
+                if not readable:
+                    return
+
+                dbapi_conn.poll()
+
+            self._drain(dbapi_conn)
+
+        except (OSError, psycopg2.Error):
+            logger.exception("Listen error on channel %s", self._channel)
+            self.close()
+            time.sleep(min(timeout, self._retry_interval))
+
+    def _drain(self, dbapi_conn):
+        with self._cond:
+            while dbapi_conn.notifies:
+                notify = dbapi_conn.notifies.pop(0)
+                self._received[notify.payload] += 1
+                self._received[None] += 1
+
+    def _snapshot(self, payloads):
+        if payloads is None:
+            return self._received[None]
+
+        return tuple(self._received[payload] for payload in payloads)
 
 
 class QueuePostgresSqlachemyBackend(QueueBackend):
-    pass
+    """
+    Очередь поверх таблицы postgres через sqlalchemy.
+
+    Сущность должна содержать поля task_id, status, script, type, args,
+    result, errortext, extra, locked_by, locked_at, lease_expires, attempts,
+    priority, coalesce_key, created, updated, константы статусов ENQUEUED,
+    WORKING, FINISHED, FAILED и метод to_dict().
+
+    Элементы выбираются по убыванию priority. При равном приоритете очередь
+    делится между владельцами (fair_share_keys): раньше выдается элемент
+    владельца, у которого меньше выполняемых элементов и который дольше не
+    получал элементов (за последние fair_share_window_sec секунд), поэтому
+    пакет от одного владельца не задерживает одиночные элементы остальных,
+    даже если обработчики выбирают элементы по одному.
+
+    Выбранный элемент арендуется обработчиком на lease_sec секунд. Аренду
+    продлевает heartbeat, элементы с истекшей арендой освобождает
+    reap_expired. Время аренды считается по часам БД.
+
+    Каждая операция выполняется в своей сессии, поэтому сессии не переживают
+    ошибки БД между вызовами, а один экземпляр можно использовать из
+    нескольких потоков. Sessionmaker создается лениво, чтобы соединения не
+    наследовались дочерними процессами.
+    """
+    def __init__(self, entity, *, create_session=None,
+                 sessionmaker_factory=None, notify_channel=None,
+                 retry_interval=2, lease_sec=60, fair_share_keys=None,
+                 fair_share_window_sec=600):
+        """
+        :param entity: модель sqlalchemy
+        :param create_session: готовая фабрика сессий
+        :param sessionmaker_factory: функция создания фабрики сессий
+        :param notify_channel: канал NOTIFY о новых элементах, None - опрос
+        :param retry_interval: пауза ожидания без уведомлений (в секундах)
+        :param lease_sec: срок аренды элемента обработчиком (в секундах)
+        :param fair_share_keys: пары (поле jsonb, ключ), по первому
+            непустому значению определяется владелец элемента
+        :param fair_share_window_sec: за какое время учитываются выборки
+            элементов владельца (в секундах)
+        """
+        assert create_session or sessionmaker_factory
+
+        self._entity = entity
+        self._create_session = create_session
+        self._sessionmaker_factory = sessionmaker_factory
+        self._notify_channel = notify_channel
+        self._retry_interval = retry_interval
+        self._lease = datetime.timedelta(seconds=lease_sec)
+        self._fair_share_keys = list(fair_share_keys or [])
+        self._fair_share_window = datetime.timedelta(
+            seconds=fair_share_window_sec
+        )
+        self._listener = None
+        self._lock = threading.Lock()
+        # Маршрут, выборку по которому в этом потоке отклонили ограничения
+        self._limited = threading.local()
+
+    def __getstate__(self):
+        # Экземпляр передается в процессы обработчиков: блокировки и
+        # соединения не копируются, а создаются заново в процессе
+        state = dict(
+            self.__dict__, _lock=None, _listener=None, _limited=None,
+        )
+        if self._sessionmaker_factory is not None:
+            state["_create_session"] = None
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._limited = threading.local()
+
+    def enqueue(self, *, coalesce_key=None, **fields) -> dict:
+        return self.enqueue_many([dict(fields, coalesce_key=coalesce_key)])[0]
+
+    def enqueue_many(self, items: List[dict]) -> List[dict]:
+        if not items:
+            return []
+
+        merged = merge_coalesced(items)
+
+        with self._session() as session:
+            coalesced = self._find_coalesced(session, merged)
+
+            # Для каждого элемента: найденный ожидающий элемент или
+            # идентификатор новой строки
+            refs = []
+            values = []
+            for fields in items:
+                key = fields.get("coalesce_key")
+                if key is not None and key in coalesced:
+                    refs.append(coalesced[key])
+                    continue
+
+                # Идентификатор задается заранее, чтобы сопоставить строки
+                # RETURNING с элементами независимо от их порядка
+                fields = dict(fields, task_id=str(uuid.uuid4()))
+                if key is not None:
+                    # Новая строка получает поля повторов из той же пачки.
+                    # Меняются только переданные поля: набор колонок должен
+                    # быть одинаков у всех строк INSERT.
+                    fields.update({
+                        name: value for name, value in merged[key].items()
+                        if name in fields
+                    })
+                values.append(fields)
+                refs.append(fields["task_id"])
+
+                if key is not None:
+                    # Повторы ключа внутри пачки объединяются с первым
+                    coalesced[key] = fields["task_id"]
+
+            created = {}
+            if values:
+                # Один INSERT на всю пачку, значения по умолчанию
+                # возвращаются из RETURNING без отдельного SELECT
+                rows = session.execute(
+                    self._entity.__table__.insert().values(
+                        values
+                    ).returning(*self._entity.__table__.c)
+                ).fetchall()
+
+                for row in rows:
+                    created[row["task_id"]] = self._entity(**dict(row))
+
+            session.commit()
+
+        return [
+            dict(ref) if isinstance(ref, dict) else created[ref].to_dict()
+            for ref in refs
+        ]
+
+    def claim_many(self, route: QueueRoute, worker_name,
+                   limit) -> List[QueueItem]:
+        entity = self._entity
+
+        if self._notify_channel:
+            # Подписка до выборки, чтобы не пропустить уведомления
+            self._get_listener().listen()
+
+        with self._session() as session:
+            limit = self._apply_limits(session, route.limits, limit)
+            self._limited.route = route if limit <= 0 else None
+            if limit <= 0:
+                session.rollback()
+                return []
+
+            fair_key = self._fair_key()
+
+            # Оконные функции несовместимы с FOR UPDATE, поэтому очередность
+            # считается в подзапросе, а блокируются строки самой таблицы
+            ranked = session.query(
+                entity.task_id.label("task_id"),
+                sa.func.row_number().over(
+                    partition_by=fair_key,
+                    order_by=(entity.priority.desc(), entity.created),
+                ).label("rank"),
+                (fair_key if fair_key is not None else sa.null()).label(
+                    "owner"
+                ),
+            ).filter(*self._route_filter(route)).subquery()
+
+            # SKIP LOCKED: обработчики одного типа не ждут блокировок друг
+            # друга, а берут следующие свободные элементы. Условия повторяются
+            # снаружи, чтобы перепроверить строку после ожидания блокировки.
+            q = session.query(entity).join(
+                ranked, ranked.c.task_id == entity.task_id
+            ).filter(
+                *self._route_filter(route)
+            )
+
+            if fair_key is None:
+                q = q.order_by(
+                    entity.priority.desc(), ranked.c.rank, entity.created
+                )
+            else:
+                # Номер элемента у владельца считается только по ожидающим
+                # элементам: у каждого владельца самый старый - первый. Чтобы
+                # владелец пакета не получал все выборки по одной, к номеру
+                # прибавляются выполняемые элементы владельца, а при равенстве
+                # раньше идет владелец, дольше не получавший элементов.
+                activity = self._fair_share_activity(session, fair_key)
+                q = q.outerjoin(
+                    activity, activity.c.owner.isnot_distinct_from(
+                        ranked.c.owner
+                    )
+                ).order_by(
+                    entity.priority.desc(),
+                    ranked.c.rank + sa.func.coalesce(activity.c.working, 0),
+                    activity.c.last_locked.asc().nullsfirst(),
+                    entity.created,
+                )
+
+            models = q.limit(limit).with_for_update(
+                skip_locked=True, of=entity
+            ).all()
+
+            if not models:
+                session.rollback()
+                return []
+
+            now = datetime.datetime.now()
+            items = []
+            for model in models:
+                model.status = entity.WORKING
+                model.locked_by = worker_name  # FIX race to postgres
+                model.locked_at = sa.func.now()
+                model.updated = now
+                model.lease_expires = sa.func.now() + self._lease
+                model.attempts = entity.attempts + 1
+                items.append(self._to_item(model))
+
+            session.commit()
+
+            return items
+
+    def ack(self, item_id, *, worker_name=None, result=None, extra=None,
+            status=None) -> bool:
+        values = {
+            "status": status or self._entity.FINISHED, "result": result,
+        }
+        if extra is not None:
+            values["extra"] = extra
+
+        return self._update(item_id, values, worker_name=worker_name)
+
+    def nack(self, item_id, *, worker_name=None, errortext=None,
+             result=None) -> bool:
+        values = {"status": self._entity.FAILED, "errortext": errortext}
+        if result is not None:
+            values["result"] = result
+
+        return self._update(item_id, values, worker_name=worker_name)
+
+    def requeue(self, item_id):
+        self._update(item_id, {
+            "status": self._entity.ENQUEUED, "locked_by": None,
+            "lease_expires": None,
+        })
+
+    def heartbeat(self, item_id, worker_name) -> bool:
+        entity = self._entity
+
+        with self._session() as session:
+            count = session.query(entity).filter(
+                entity.task_id == item_id,
+                entity.status == entity.WORKING,
+                entity.locked_by == worker_name,
+            ).update({
+                "lease_expires": sa.func.now() + self._lease,
+            }, synchronize_session=False)
+            session.commit()
+
+            return count > 0
+
+    def release_locked(self, worker_name, *, max_attempts,
+                       max_attempts_by_type=None, result=None) -> int:
+        entity = self._entity
+
+        return self._release(
+            [entity.locked_by == worker_name],
+            max_attempts=max_attempts,
+            max_attempts_by_type=max_attempts_by_type, result=result,
+        )
+
+    def reap_expired(self, *, max_attempts, max_attempts_by_type=None,
+                     result=None) -> int:
+        entity = self._entity
+
+        return self._release(
+            [entity.lease_expires < sa.func.now()],
+            max_attempts=max_attempts,
+            max_attempts_by_type=max_attempts_by_type, result=result,
+        )
+
+    def is_superseded(self, item_id) -> bool:
+        entity = self._entity
+        newer = aliased(entity)
+
+        with self._session() as session:
+            found = session.query(newer.task_id).join(
+                entity, sa.and_(
+                    entity.task_id == item_id,
+                    newer.coalesce_key == entity.coalesce_key,
+                    newer.created > entity.created,
+                )
+            ).filter(
+                newer.status.in_([entity.ENQUEUED, entity.WORKING]),
+            ).first()
+
+            return found is not None
+
+    def cancel(self, item_id) -> Optional[str]:
+        entity = self._entity
+
+        with self._session() as session:
+            # Блокировка строки: обработчик не выберет элемент, пока решаем,
+            # отменить его сразу или запросить отмену у обработчика
+            model = session.query(entity).filter(
+                entity.task_id == item_id
+            ).with_for_update().first()
+            if model is None:
+                return None
+
+            if model.status == entity.ENQUEUED:
+                model.status = entity.CANCELLED
+                model.updated = datetime.datetime.now()
+            elif model.status == entity.WORKING:
+                model.cancel_requested = True
+
+            status = model.status
+            session.commit()
+
+            return status
+
+    def is_cancel_requested(self, item_id) -> bool:
+        entity = self._entity
+
+        with self._session() as session:
+            found = session.query(entity.task_id).filter(
+                entity.task_id == item_id,
+                entity.cancel_requested.is_(True),
+            ).first()
+
+            return found is not None
+
+    def wait(self, route: QueueRoute, timeout) -> bool:
+        if not self._notify_channel:
+            time.sleep(self._retry_interval)
+            return True
+
+        if getattr(self._limited, "route", None) is route:
+            # Об освобождении места уведомлений нет, поэтому после отказа
+            # ограничения очередь опрашивается чаще. Без отказа ждем NOTIFY
+            # весь timeout.
+            timeout = min(timeout, self._retry_interval)
+
+        payloads = [route.item_type] if route.item_type else None
+        return self._get_listener().wait(timeout, payloads=payloads)
+
+    def _route_filter(self, route: QueueRoute):
+        entity = self._entity
+
+        filter_q = [entity.status == entity.ENQUEUED]
+
+        if route.item_type:
+            filter_q.append(entity.type == route.item_type)
+
+        for name, value in route.json_args:
+            filter_q.append(entity.args[name].astext == value)
+
+        return filter_q
+
+    def _apply_limits(self, session, limits, limit):
+        """
+        Сколько элементов можно выбрать, не превысив ограничения. Ограничение
+        блокируется до конца транзакции, поэтому обработчики одной группы
+        проверяют его и выбирают элементы по очереди.
+        """
+        entity = self._entity
+
+        for queue_limit in sorted(limits, key=lambda it: it.key):
+            session.execute(sa.select([sa.func.pg_advisory_xact_lock(
+                LIMIT_LOCK_CLASS, sa.func.hashtext(queue_limit.key)
+            )]))
+
+            locked_by = entity.locked_by.in_(queue_limit.worker_names)
+
+            if queue_limit.max_working is not None:
+                working = session.query(sa.func.count(entity.task_id)).filter(
+                    locked_by, entity.status == entity.WORKING,
+                ).scalar()
+                limit = min(limit, queue_limit.max_working - working)
+
+            if queue_limit.max_per_minute is not None:
+                claimed = session.query(sa.func.count(entity.task_id)).filter(
+                    locked_by,
+                    entity.locked_at > sa.func.now() - datetime.timedelta(
+                        minutes=1
+                    ),
+                ).scalar()
+                limit = min(limit, queue_limit.max_per_minute - claimed)
+
+            if limit <= 0:
+                logger.debug("Queue limit reached: %s", queue_limit)
+                break
+
+        return limit
+
+    def _find_coalesced(self, session, merged):
+        """
+        Ожидающие элементы с ключами объединения. Запросы объединяются с
+        ними: priority поднимается до наибольшего запрошенного, в meta и
+        extra добавляются переданные значения.
+
+        :param merged: поля запросов по ключам, см. merge_coalesced
+        :return: словарь ключ -> to_dict() элемента
+        """
+        entity = self._entity
+
+        if not merged:
+            return {}
+
+        # Блокировка ключей до конца транзакции: параллельные вызовы с одним
+        # ключом не создадут два элемента. Ключи блокируются в одном порядке,
+        # чтобы пачки не ждали друг друга по кругу.
+        for key in sorted(merged):
+            session.execute(sa.select([
+                sa.func.pg_advisory_xact_lock(sa.func.hashtext(key))
+            ]))
+
+        # Элемент, который обработчик уже выбирает, пропускается: объединять
+        # с ним нельзя, он может начать выполняться до нового запроса
+        models = session.query(entity).filter(
+            entity.status == entity.ENQUEUED,
+            entity.coalesce_key.in_(list(merged)),
+        ).order_by(
+            entity.created
+        ).with_for_update(skip_locked=True).all()
+
+        found = {}
+        for model in models:
+            key = model.coalesce_key
+            if key in found:
+                continue
+
+            values = coalesced_update(model.to_dict(), merged[key])
+            if values:
+                session.query(entity).filter(
+                    entity.task_id == model.task_id
+                ).update(values, synchronize_session=False)
+
+            found[key] = dict(model.to_dict(), **values)
+
+        return found
+
+    def _fair_share_activity(self, session, fair_key):
+        """
+        Подзапрос по владельцам: сколько элементов выполняется и когда
+        элемент владельца выбирался последний раз
+        """
+        entity = self._entity
+
+        return session.query(
+            fair_key.label("owner"),
+            sa.func.count(entity.task_id).filter(
+                entity.status == entity.WORKING
+            ).label("working"),
+            sa.func.max(entity.locked_at).label("last_locked"),
+        ).filter(sa.or_(
+            entity.status == entity.WORKING,
+            entity.locked_at > sa.func.now() - self._fair_share_window,
+        )).group_by(fair_key).subquery()
+
+    def _fair_key(self):
+        if not self._fair_share_keys:
+            return None
+
+        entity = self._entity
+        return sa.func.coalesce(*[
+            getattr(entity, field)[key].astext
+            for field, key in self._fair_share_keys
+        ])
+
+    def _update(self, item_id, values, worker_name=None) -> bool:
+        entity = self._entity
+
+        values = dict(values, updated=datetime.datetime.now())
+
+        filter_q = [entity.task_id == item_id]
+        if worker_name is not None:
+            # Проверка аренды и изменение одним UPDATE: если элемент успели
+            # вернуть в очередь и выбрать другим обработчиком, прежний
+            # владелец его не перезапишет
+            filter_q.extend([
+                entity.status == entity.WORKING,
+                entity.locked_by == worker_name,
+            ])
+            values["lease_expires"] = None
+
+        with self._session() as session:
+            count = session.query(entity).filter(*filter_q).update(
+                values, synchronize_session=False
+            )
+            session.commit()
+
+        if count != 1:
+            logger.error(
+                "Can't find queue item %s locked by %s", item_id, worker_name
+            )
+            return False
+
+        return True
+
+    def _release(self, filter_q, *, max_attempts, max_attempts_by_type,
+                 result) -> int:
+        entity = self._entity
+
+        if max_attempts_by_type:
+            max_attempts = sa.case(
+                max_attempts_by_type, value=entity.type, else_=max_attempts
+            )
+
+        exhausted = entity.attempts >= max_attempts
+        status_type = entity.status.type
+
+        with self._session() as session:
+            count = session.query(entity).filter(
+                entity.status == entity.WORKING, *filter_q
+            ).update({
+                # Отмененный элемент не возвращается в очередь, даже если
+                # обработчик не успел завершить его сам
+                "status": sa.case(
+                    [
+                        (entity.cancel_requested,
+                         sa.cast(entity.CANCELLED, status_type)),
+                        (exhausted, sa.cast(entity.FAILED, status_type)),
+                    ],
+                    else_=sa.cast(entity.ENQUEUED, status_type)
+                ),
+                "result": sa.case(
+                    [(exhausted, sa.cast(result, JSONB))],
+                    else_=entity.result
+                ),
+                "locked_by": None,
+                "lease_expires": None,
+            }, synchronize_session=False)
+            session.commit()
+
+            return count
+
+    def _get_listener(self) -> PostgresNotifyListener:
+        if self._listener is None:
+            with self._session() as session:
+                engine = session.get_bind()
+
+            with self._lock:
+                if self._listener is None:
+                    self._listener = PostgresNotifyListener(
+                        engine, channel=self._notify_channel,
+                        retry_interval=self._retry_interval,
+                    )
+
+        return self._listener
+
+    def _session(self):
+        if self._create_session is None:
+            with self._lock:
+                if self._create_session is None:
+                    self._create_session = self._sessionmaker_factory()
+
+        return self._create_session()
+
+    @staticmethod
+    def _to_item(model) -> QueueItem:
+        return QueueItem(
+            item_id=model.task_id,
+            type=model.type,
+            script=model.script,
+            args=model.args,
+            timeout=model.timeout,
+        )
@@ -0,0 +1,293 @@
+import asyncio
+import datetime
+import json
+import logging
+from typing import List
+
+from pyqu.core import QueueItem, QueueRoute
+
+logger = logging.getLogger()
+
+
+class QueueAsyncpgBackend:
+    """
+    Асинхронная очередь поверх той же таблицы, что и
+    QueuePostgresSqlachemyBackend, через пул asyncpg (nlab.postgres.Postgres).
+
+    Изменения статусов пишутся сырым SQL, историю статусов пишет триггер
+    таблицы (см. миграции).
+    """
+    def __init__(self, entity, db, *, notify_channel=None, lease_sec=60,
+                 fair_share_keys=None, fair_share_window_sec=600):
+        """
+        :param entity: модель sqlalchemy (для имени таблицы и статусов)
+        :param db: подключенный nlab.postgres.Postgres
+        :param notify_channel: канал NOTIFY о новых элементах
+        :param lease_sec: срок аренды элемента обработчиком (в секундах)
+        :param fair_share_keys: пары (поле jsonb, ключ) владельца элемента,
+            см. QueuePostgresSqlachemyBackend
+        :param fair_share_window_sec: за какое время учитываются выборки
+            элементов владельца (в секундах)
+        """
+        self._entity = entity
+        self._table = entity.__table__.name
+        self._db = db
+        self._notify_channel = notify_channel
+        self._lease = datetime.timedelta(seconds=lease_sec)
+        self._fair_share_keys = list(fair_share_keys or [])
+        self._fair_share_window = datetime.timedelta(
+            seconds=fair_share_window_sec
+        )
+
+        self._listen_conn = None
+        self._events = {}
+
+    async def listen(self):
+        """
+        Подписка на канал на отдельном соединении пула
+        """
+        if not self._notify_channel or self._listen_conn is not None:
+            return
+
+        self._listen_conn = await self._db.pool.acquire()
+        await self._listen_conn.add_listener(
+            self._notify_channel, self._on_notify
+        )
+
+    async def close(self):
+        if self._listen_conn is not None:
+            await self._listen_conn.remove_listener(
+                self._notify_channel, self._on_notify
+            )
+            await self._db.pool.release(self._listen_conn)
+            self._listen_conn = None
+
+    async def claim_many(self, route: QueueRoute, worker_name,
+                         limit) -> List[QueueItem]:
+        # Ограничения выборки нужны только обработчикам хостов движка,
+        # которые работают через QueuePostgresSqlachemyBackend
+        assert not route.limits, "Queue limits are not supported"
+
+        entity = self._entity
+
+        params = [entity.WORKING, worker_name, entity.ENQUEUED, self._lease]
+        conditions = ["status = $3"]
+
+        if route.item_type:
+            params.append(route.item_type)
+            conditions.append("type = $%d" % len(params))
+
+        for name, value in route.json_args:
+            params.extend([name, value])
+            conditions.append(
+                "args ->> $%d = $%d" % (len(params) - 1, len(params))
+            )
+
+        partition = ""
+        activity = ""
+        order = "priority DESC, rank, created"
+        if self._fair_share_keys:
+            keys = []
+            for field, key in self._fair_share_keys:
+                params.append(key)
+                keys.append("%s ->> $%d" % (field, len(params)))
+            owner = "coalesce(%s)" % ", ".join(keys)
+            partition = "PARTITION BY %s" % owner
+
+            # Как в QueuePostgresSqlachemyBackend: к номеру элемента у
+            # владельца прибавляются его выполняемые элементы, при равенстве
+            # раньше идет владелец, дольше не получавший элементов
+            params.append(self._fair_share_window)
+            activity = """
+                LEFT JOIN (
+                    SELECT {owner} AS owner,
+                        count(*) FILTER (WHERE status = $1) AS working,
+                        max(locked_at) AS last_locked
+                    FROM {table}
+                    WHERE status = $1
+                        OR locked_at > now() - ${window}::interval
+                    GROUP BY 1
+                ) activity ON activity.owner IS NOT DISTINCT FROM ranked.owner
+            """.format(owner=owner, table=self._table, window=len(params))
+            order = ("priority DESC, rank + coalesce(activity.working, 0), "
+                     "activity.last_locked NULLS FIRST, created")
+        else:
+            owner = "NULL"
+
+        # Очередность считается в подзапросе: оконные функции несовместимы
+        # с FOR UPDATE. SKIP LOCKED: обработчики одного типа не ждут
+        # блокировок друг друга, а берут следующие свободные элементы.
+        query = """
+            UPDATE {table} SET status = $1, locked_by = $2,
+                updated = now(), locked_at = now(),
+                lease_expires = now() + $4::interval,
+                attempts = attempts + 1
+            WHERE task_id IN (
+                SELECT task_id FROM {table}
+                JOIN (
+                    SELECT task_id, {owner} AS owner, row_number() OVER (
+                        {partition} ORDER BY priority DESC, created
+                    ) AS rank
+                    FROM {table}
+                    WHERE {conditions}
+                ) ranked USING (task_id)
+                {activity}
+                WHERE {conditions}
+                ORDER BY {order}
+                LIMIT {limit}
+                FOR UPDATE OF {table} SKIP LOCKED
+            )
+            RETURNING task_id, type, script, args, timeout
+        """.format(
+            table=self._table, conditions=" AND ".join(conditions),
+            partition=partition, owner=owner, activity=activity,
+            order=order, limit=int(limit),
+        )
+
+        rows = await self._db.fetch(query, *params)
+
+        return [
+            QueueItem(
+                item_id=str(row["task_id"]),
+                type=row["type"],
+                script=row["script"],
+                args=_load_json(row["args"]),
+                timeout=row["timeout"],
+            )
+            for row in rows
+        ]
+
+    async def claim(self, route: QueueRoute, worker_name):
+        items = await self.claim_many(route, worker_name, limit=1)
+        return items[0] if items else None
+
+    async def ack(self, item_id, *, worker_name=None, result=None,
+                  extra=None, status=None) -> bool:
+        values = {
+            "status": status or self._entity.FINISHED, "result": result,
+        }
+        if extra is not None:
+            values["extra"] = extra
+
+        return await self._update(item_id, values, worker_name=worker_name)
+
+    async def nack(self, item_id, *, worker_name=None, errortext=None,
+                   result=None) -> bool:
+        values = {"status": self._entity.FAILED, "errortext": errortext}
+        if result is not None:
+            values["result"] = result
+
+        return await self._update(item_id, values, worker_name=worker_name)
+
+    async def heartbeat(self, item_id, worker_name) -> bool:
+        entity = self._entity
+
+        task_id = await self._db.fetchval(
+            """
+            UPDATE {table} SET lease_expires = now() + $1::interval
+            WHERE task_id = $2 AND status = $3 AND locked_by = $4
+            RETURNING task_id
+            """.format(table=self._table),
+            self._lease, item_id, entity.WORKING, worker_name,
+        )
+
+        return task_id is not None
+
+    async def release_locked(self, worker_name, *, max_attempts,
+                             max_attempts_by_type=None, result=None):
+        entity = self._entity
+
+        # Количество попыток по типам передается массивами для unnest
+        by_type = max_attempts_by_type or {}
+
+        await self._db.execute(
+            """
+            UPDATE {table} t SET
+                status = CASE
+                    WHEN t.cancel_requested THEN $9::{status}
+                    WHEN t.attempts >= a.max_attempts THEN $1::{status}
+                    ELSE $2::{status} END,
+                result = CASE WHEN t.attempts >= a.max_attempts
+                    THEN $3::jsonb ELSE t.result END,
+                locked_by = NULL,
+                lease_expires = NULL
+            FROM (
+                SELECT t2.task_id, coalesce(m.attempts, $4) AS max_attempts
+                FROM {table} t2
+                LEFT JOIN unnest($5::text[], $6::int[]) AS m(type, attempts)
+                    ON m.type = t2.type
+                WHERE t2.status = $7 AND t2.locked_by = $8
+            ) a
+            WHERE t.task_id = a.task_id
+            """.format(table=self._table, status=entity.status.type.name),
+            entity.FAILED, entity.ENQUEUED, json.dumps(result),
+            max_attempts, list(by_type.keys()), list(by_type.values()),
+            entity.WORKING, worker_name, entity.CANCELLED,
+        )
+
+    async def is_cancel_requested(self, item_id) -> bool:
+        return bool(await self._db.fetchval(
+            """
+            SELECT cancel_requested FROM {table} WHERE task_id = $1
+            """.format(table=self._table),
+            item_id,
+        ))
+
+    async def wait(self, route: QueueRoute, timeout) -> bool:
+        event = self._events.setdefault(route.item_type, asyncio.Event())
+
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            event.clear()
+
+    async def _update(self, item_id, values, worker_name=None) -> bool:
+        params = [item_id]
+        conditions = ["task_id = $1"]
+        if worker_name is not None:
+            params.extend([self._entity.WORKING, worker_name])
+            conditions.extend(["status = $2", "locked_by = $3"])
+            values = dict(values, lease_expires=None)
+
+        assignments = []
+        for key, value in values.items():
+            if key in ("result", "extra"):
+                params.append(json.dumps(value))
+                assignments.append("%s = $%d::jsonb" % (key, len(params)))
+            else:
+                params.append(value)
+                assignments.append("%s = $%d" % (key, len(params)))
+
+        query = """
+            UPDATE {table} SET {assignments}, updated = now()
+            WHERE {conditions}
+            RETURNING task_id
+        """.format(
+            table=self._table, assignments=", ".join(assignments),
+            conditions=" AND ".join(conditions),
+        )
+
+        rows = await self._db.fetch(query, *params)
+        if not rows:
+            logger.error(
+                "Can't find queue item %s locked by %s", item_id, worker_name
+            )
+
+        return bool(rows)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        for item_type in (payload, None):
+            event = self._events.get(item_type)
+            if event is not None:
+                event.set()
+
+
+def _load_json(value):
+    # asyncpg без кодека возвращает jsonb строкой
+    if isinstance(value, str):
+        return json.loads(value)
+
+    return value
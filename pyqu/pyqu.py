@@ -32,6 +32,9 @@ class Pyqu:
     def wait(self, timeout=None):
         self._process_backend.wait(timeout=timeout)
 
+    def stats(self):
+        return self._process_backend.stats()
+
     def start_and_wait(self):
         self.start()
         self.wait()
@@ -0,0 +1,52 @@
+"""
+Реестр функций задач.
+
+Ставить в очередь можно только зарегистрированные скрипты. Модуль не
+импортирует сами скрипты, поэтому его можно использовать в сервисе для
+проверки задач при создании.
+"""
+import functools
+import importlib
+import logging
+
+logger = logging.getLogger()
+
+# script -> тип задачи, обработчики которого его выполняют
+TASK_SCRIPTS = {
+    "scripts.compiler.run": "compiler",
+    "scripts.processor.run": "compiler",
+    "scripts.deploy.run": "deploy",
+    "scripts.testcase.run": "testcase",
+    "scripts.suite.import_run": "suite",
+    "scripts.suite.export_run": "suite",
+    "scripts.dictionary.import_run": "dictionary",
+    "scripts.dictionary.export_run": "dictionary",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def load_task_function(script):
+    """
+    Функция задачи по пути script. Результат кешируется, повторные задачи
+    не тратят время на поиск модуля.
+    """
+    module_name, function_name = script.rsplit(".", 1)
+    module = importlib.import_module(module_name)
+    return getattr(module, function_name)
+
+
+def warm_up(task_types=None):
+    """
+    Загрузка функций задач при старте обработчика, чтобы первая задача
+    не ждала импорта тяжелых зависимостей
+
+    :param task_types: типы задач обработчика, None - все
+    """
+    for script, task_type in TASK_SCRIPTS.items():
+        if task_types is not None and task_type not in task_types:
+            continue
+
+        try:
+            load_task_function(script)
+        except (ImportError, AttributeError):
+            logger.exception("Can't load task function %s", script)
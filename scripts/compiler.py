@@ -1,4 +1,5 @@
 import logging
+from datetime import timedelta
 from pathlib import Path
 
 import settings
@@ -7,14 +8,18 @@ from engine.preprocessors.arm1.preprocessor import Arm1Preprocessor
 from engine.task import CompilerTask, CompilerTaskResult
 from engine.tasks.compiler import (EngineCompilerProcess,
                                    create_complect_revision,
+                                   find_cached_complect,
                                    format_output_result)
+from models import Task
 from nlab.rpc.client import WebClient
+from task_executor import create_stage_reporter, offload_task_output
 from utils import TaskResult
 
 logger = logging.getLogger()
 
 
-def run(complect_id, target, compiler_host, task_id, try_create_revision):
+def run(complect_id, target, compiler_host, task_id, try_create_revision,
+        cancel_token=None, is_superseded=None):
     """ Выполнение компиляции """
     root_path = Path("/var/tmp")
     root_path.mkdir(mode=0o775, parents=True, exist_ok=True)
@@ -37,15 +42,43 @@ def run(complect_id, target, compiler_host, task_id, try_create_revision):
     gateway_client = WebClient(settings.GATEWAY_URL)
     preprocessor = Arm1Preprocessor(gateway_client=gateway_client)
 
+    # При отмене и таймауте задачи процессы препроцессора и компилятора
+    # убиваются, не дожидаясь очередного этапа
+    backend.cancel_token = cancel_token
+    preprocessor.cancel_token = cancel_token
+
+    # Длительность этапов пишется в task_reports (см. task.progress)
+    stage_reporter = create_stage_reporter(task_id)
+    preprocessor.stage_reporter = stage_reporter
+
+    find_cached = None
+    if settings.ENGINE_COMPILE_CACHE_MAX_AGE_DAYS > 0:
+        def find_cached(source_hash):
+            return find_cached_complect(
+                source_hash=source_hash,
+                compiler_host=compiler_host,
+                complect_id=complect_id,
+                max_age=timedelta(
+                    days=settings.ENGINE_COMPILE_CACHE_MAX_AGE_DAYS
+                ),
+            )
+
     process = EngineCompilerProcess(
         preprocessor=preprocessor,
         backend=backend,
         task=task,
-        root_path=root_path
+        root_path=root_path,
+        # Прерываем компиляцию, если пользователь уже запросил более новую
+        is_superseded=is_superseded,
+        find_cached=find_cached,
+        cancel_token=cancel_token,
+        stage_reporter=stage_reporter,
     )
     result: CompilerTaskResult = process.execute()
 
-    output_result = format_output_result(result, gateway_client)
+    output_result = offload_task_output(
+        task_id, format_output_result(result, gateway_client)
+    )
 
     extra = {
         "complect_id": task.complect_id,
@@ -53,11 +86,23 @@ def run(complect_id, target, compiler_host, task_id, try_create_revision):
 
     logger.info("Got output result: %s", output_result)
 
+    if result.cancelled:
+        return TaskResult(
+            result=output_result, extra=extra, status=result.cancelled
+        )
+
+    if result.superseded:
+        return TaskResult(
+            result=output_result, extra=extra, status=Task.SUPERSEDED
+        )
+
     if task.try_create_revision and result.engine_complect:
         revision_result = create_complect_revision(
             remote_path=result.engine_complect.remote_path,
             compiler_host=task.compiler_host,
             complect_id=task.complect_id,
+            source_hash=result.source_hash
+            if output_result["success"] else None,
         )
 
         output_result.update(revision_result)
@@ -1,23 +1,23 @@
 import logging
 
-import settings
 from engine.factory import EngineFactory
 from engine.task import DeployTask, DeployTaskResult
 from engine.tasks.deploy import EngineDeployProcess
-from nlab.db import create_sessionmaker
+from task_executor import (create_stage_reporter, get_sessionmaker,
+                           offload_task_output)
 from utils import TaskResult
 
 logger = logging.getLogger()
 
 
-def run(complect_revision_id, target, task_id):
+def run(complect_revision_id, target, task_id, cancel_token=None):
     """ Выполнение деплоя """
     logger.info(f"Running deploy: task_id={task_id} "
                 f"target={target}")
 
     engine_factory = EngineFactory()
 
-    create_session = create_sessionmaker(env_prefix=settings.POSTGRES_PREFIX)
+    create_session = get_sessionmaker()
 
     task = DeployTask(
         complect_revision_id=complect_revision_id,
@@ -27,18 +27,22 @@ def run(complect_revision_id, target, task_id):
         factory=engine_factory,
         task=task,
         create_session=create_session,
+        cancel_token=cancel_token,
+        stage_reporter=create_stage_reporter(task_id),
     )
     result: DeployTaskResult = process.execute()
 
-    output_result = {
+    output_result = offload_task_output(task_id, {
         "output": result.output if result else "",
         "messages": [],
         "success": result.success if result else False,
-    }
+    })
 
     extra = {
         "complect_revision_id": complect_revision_id,
         "complect_id": result.complect_id if result else None,
     }
 
-    return TaskResult(result=output_result, extra=extra)
+    status = result.cancelled if result else None
+
+    return TaskResult(result=output_result, extra=extra, status=status)
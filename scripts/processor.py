@@ -1,7 +1,8 @@
 from scripts import compiler
 
 
-def run(complect_id, target, compiler_host, task_id, try_create_revision):
+def run(complect_id, target, compiler_host, task_id, try_create_revision,
+        cancel_token=None):
     """
     Compability method
 
@@ -10,6 +11,7 @@ def run(complect_id, target, compiler_host, task_id, try_create_revision):
     :param compiler_host:
     :param task_id:
     :param try_create_revision:
+    :param cancel_token:
     :return:
     """
     return compiler.run(
@@ -18,4 +20,5 @@ def run(complect_id, target, compiler_host, task_id, try_create_revision):
         compiler_host=compiler_host,
         task_id=task_id,
         try_create_revision=try_create_revision,
+        cancel_token=cancel_token,
     )
@@ -21,6 +21,159 @@ POSTGRES_PORT = os.getenv(POSTGRES_PREFIX + "PORT", "5432")
 
 TASK_RUN_TIME_INTERVAL_SEC = 2     # задается в секундах
 
+# Канал NOTIFY о новых задачах (см. триггер tasks_notify_enqueued в миграциях)
+TASK_NOTIFY_CHANNEL = "tasks_enqueued"
+# Канал NOTIFY о новых уведомлениях в task_events (см. триггер
+# tasks_outbox_status в миграциях)
+TASK_EVENTS_CHANNEL = "task_events"
+# Запасной интервал опроса очереди, если уведомление не пришло (в секундах)
+TASK_NOTIFY_WAIT_SEC = int(os.getenv("NLAB_ARM_TASK_NOTIFY_WAIT_SEC", "30"))
+
+# Количество обработчиков по типам задач. Переопределяется переменной
+# окружения, например: NLAB_ARM_TASK_CONCURRENCY='{"testcase": 8}'
+TASK_CONCURRENCY = {
+    "testcase": 1,
+    "suite": 1,
+    "dictionary": 1,
+}
+TASK_CONCURRENCY.update(
+    json.loads(os.getenv("NLAB_ARM_TASK_CONCURRENCY", "{}"))
+)
+
+# Типы задач, обработчики которых запускаются потоками одного процесса
+# (задачи в основном ждут HTTP/SSH). Пустая строка - каждый обработчик
+# в отдельном процессе.
+TASK_THREADED_TYPES = [
+    it.strip() for it in os.getenv(
+        "NLAB_ARM_TASK_THREADED_TYPES", "testcase,suite,dictionary"
+    ).split(",") if it.strip()
+]
+
+# Типы задач, которые выполняются asyncio-обработчиком в одном процессе:
+# выборка задач через asyncpg, корутины выполняются на event loop,
+# синхронные функции - в пуле потоков. Приоритетнее TASK_THREADED_TYPES.
+TASK_ASYNC_TYPES = [
+    it.strip() for it in os.getenv(
+        "NLAB_ARM_TASK_ASYNC_TYPES", ""
+    ).split(",") if it.strip()
+]
+# Максимум одновременно выполняемых задач asyncio-обработчиком
+TASK_ASYNC_MAX_IN_FLIGHT = int(
+    os.getenv("NLAB_ARM_TASK_ASYNC_MAX_IN_FLIGHT", "200")
+)
+# Размер пула потоков для синхронных функций задач
+TASK_ASYNC_SYNC_THREADS = int(
+    os.getenv("NLAB_ARM_TASK_ASYNC_SYNC_THREADS", "32")
+)
+
+# Срок аренды задачи обработчиком (в секундах). Пока задача выполняется,
+# аренда продлевается каждые TASK_HEARTBEAT_INTERVAL_SEC секунд.
+TASK_LEASE_SEC = int(os.getenv("NLAB_ARM_TASK_LEASE_SEC", "60"))
+TASK_HEARTBEAT_INTERVAL_SEC = int(
+    os.getenv("NLAB_ARM_TASK_HEARTBEAT_INTERVAL_SEC", "15")
+)
+# Период проверки задач с истекшей арендой (в секундах)
+TASK_REAPER_INTERVAL_SEC = int(
+    os.getenv("NLAB_ARM_TASK_REAPER_INTERVAL_SEC", "30")
+)
+# Сколько раз задача выдается обработчикам, прежде чем при потере аренды
+# перейти в failed. По умолчанию задача не перезапускается: повтор
+# незавершенной загрузки может оставить движок в непредсказуемом состоянии
+# (поэтому compiler и deploy, которые загружают и перезапускают движок, не
+# повторяются). Повторяются только задачи, которые только читают состояние
+# движка.
+TASK_MAX_ATTEMPTS = 1
+TASK_MAX_ATTEMPTS_BY_TYPE = {
+    "testcase": 2,
+    "suite": 2,
+}
+TASK_MAX_ATTEMPTS_BY_TYPE.update(
+    json.loads(os.getenv("NLAB_ARM_TASK_MAX_ATTEMPTS_BY_TYPE", "{}"))
+)
+
+# Ограничение времени выполнения задач по типам (в секундах), если при
+# создании задачи не передан timeout. 0 - без ограничения. По истечении
+# задача прерывается и получает статус timed_out.
+TASK_TIMEOUT_SEC = 0
+TASK_TIMEOUT_SEC_BY_TYPE = {
+    "compiler": 1800,
+    "deploy": 900,
+    "testcase": 600,
+    "suite": 3600,
+    "dictionary": 1800,
+}
+TASK_TIMEOUT_SEC_BY_TYPE.update(
+    json.loads(os.getenv("NLAB_ARM_TASK_TIMEOUT_SEC_BY_TYPE", "{}"))
+)
+# Сколько ждать завершения функции задачи после отмены или таймаута (в
+# секундах). Процесс обработчика, который не дождался, завершается и
+# перезапускается супервизором.
+TASK_CANCEL_GRACE_SEC = int(
+    os.getenv("NLAB_ARM_TASK_CANCEL_GRACE_SEC", "60")
+)
+# Сколько потоков с зависшими функциями задач может работать в процессе
+# обработчиков-потоков. Слот такого потока сразу отдается новому, а при
+# превышении процесс перезапускается целиком.
+TASK_MAX_ABANDONED_THREADS = int(
+    os.getenv("NLAB_ARM_TASK_MAX_ABANDONED_THREADS", "8")
+)
+
+# Владелец задачи для справедливой очереди: первое непустое значение из
+# пар (поле, ключ). Из задач одного приоритета раньше выдается задача
+# владельца, у которого меньше выполняемых задач и который дольше не получал
+# задач, поэтому пакет задач одного владельца не задерживает остальных.
+TASK_FAIR_SHARE_KEYS = [
+    ("extra", "complect_id"),
+    ("args", "complect_id"),
+    ("args", "profile_id"),
+]
+
+# Типы задач, которые объединяются при постановке в очередь: новая задача
+# с тем же скриптом и аргументами, что и ожидающая, не создается, клиенту
+# возвращается ожидающая
+TASK_COALESCE_TYPES = ["compiler"]
+
+# Способ запуска процессов обработчиков. В режиме forkserver модули задач
+# импортируются один раз, и перезапуск обработчика обходится без импорта.
+TASK_PROCESS_START_METHOD = os.getenv(
+    "NLAB_ARM_TASK_PROCESS_START_METHOD", "forkserver"
+)
+# Процесс обработчика перезапускается после заданного числа задач или при
+# превышении пиковым RSS порога (в мегабайтах). 0 - без ограничения.
+TASK_RECYCLE_AFTER_TASKS = int(
+    os.getenv("NLAB_ARM_TASK_RECYCLE_AFTER_TASKS", "500")
+)
+TASK_RECYCLE_MAX_RSS_MB = int(
+    os.getenv("NLAB_ARM_TASK_RECYCLE_MAX_RSS_MB", "1024")
+)
+# Период записи в лог состояния обработчиков: число перезапусков и
+# падающие при старте обработчики (в секундах)
+TASK_STATS_LOG_INTERVAL_SEC = int(
+    os.getenv("NLAB_ARM_TASK_STATS_LOG_INTERVAL_SEC", "300")
+)
+
+# Завершенные задачи старше заданного числа дней переносятся вместе с
+# историей статусов в tasks_archive и task_reports_archive. 0 - не переносить.
+TASK_ARCHIVE_AFTER_DAYS = int(
+    os.getenv("NLAB_ARM_TASK_ARCHIVE_AFTER_DAYS", "30")
+)
+# Перенос идет раз в TASK_ARCHIVE_INTERVAL_SEC секунд пачками по
+# TASK_ARCHIVE_BATCH_SIZE задач, каждая пачка в своей транзакции, за раз
+# не больше TASK_ARCHIVE_MAX_BATCHES пачек
+TASK_ARCHIVE_INTERVAL_SEC = 600
+TASK_ARCHIVE_BATCH_SIZE = 500
+TASK_ARCHIVE_MAX_BATCHES = 20
+
+# Вывод задач компиляции и деплоя длиннее TASK_OUTPUT_SUMMARY_CHARS символов
+# хранится сжатым в task_outputs, в результате задачи остается его конец.
+# task.output отдает вывод частями не больше TASK_OUTPUT_PAGE_CHARS символов.
+# При переносе задачи в архив полный вывод удаляется.
+TASK_OUTPUT_SUMMARY_CHARS = 4000
+TASK_OUTPUT_PAGE_CHARS = 100000
+
+# Максимум задач в одном вызове task.create_many
+TASK_CREATE_MANY_LIMIT = 1000
+
 GATEWAY_URL = os.getenv("NLAB_ARM_GATEWAY_URL")
 
 PROCESSOR_PORT = os.getenv("NLAB_ARM_PROCESSOR_PORT", "5000")
@@ -33,6 +186,10 @@ ENGINE_AUTH = {
     }
 }
 
+# Хосты компиляции и деплоя. Кроме параметров подключения поддерживаются:
+# - max_jobs: сколько задач хост выполняет одновременно (по умолчанию 1);
+# - tokens_per_minute: сколько задач хост может взять за минуту;
+# - capacity_group: группа из ENGINE_CAPACITY_GROUPS с общими ограничениями.
 ENGINE_COMPILER_HOSTS = {
     "sova-engine": {
         "host": os.getenv("NLAB_ARM_COMPILER_HOSTS"),
@@ -49,6 +206,20 @@ ENGINE_DEPLOY_HOSTS = json.loads(
     os.getenv("NLAB_ARM_PROCESSOR_DEPLOY_HOSTS", "{}")
 )
 
+# Общие ограничения групп хостов (max_jobs, tokens_per_minute), действуют
+# отдельно для задач компиляции и деплоя, например:
+# NLAB_ARM_ENGINE_CAPACITY_GROUPS='{"shared": {"max_jobs": 4}}'
+ENGINE_CAPACITY_GROUPS = json.loads(
+    os.getenv("NLAB_ARM_ENGINE_CAPACITY_GROUPS", "{}")
+)
+
+# Сколько дней можно использовать бинарник, собранный ранее из тех же
+# исходников, вместо новой компиляции. 0 - всегда компилировать. Старые
+# комплекты удаляются с хостов компиляции через неделю.
+ENGINE_COMPILE_CACHE_MAX_AGE_DAYS = int(
+    os.getenv("NLAB_ARM_ENGINE_COMPILE_CACHE_MAX_AGE_DAYS", "6")
+)
+
 NLAB_ARM_TEST_TESTCASE_INF_NAME = os.getenv("NLAB_ARM_TEST_TESTCASE_INF_NAME")
 
 NLAB_ARM_ENGINE_SERVICE_HOST = os.getenv("NLAB_ARM_ENGINE_SERVICE_HOST")
@@ -58,3 +229,11 @@ SESSION_ID = 1  # TODO номер сессии
 HEADERS = {"Content-type": "application/json"}
 
 NLAB_ARM_WS_NOTIFIER_URL = os.getenv("NLAB_ARM_WS_NOTIFIER_URL")
+# Уведомления о смене статуса задач пишутся триггером в task_events и
+# отправляются процессом event_relay: таймаут запроса (в секундах), максимум
+# уведомлений за одну транзакцию и пауза после ошибки отправки (в секундах)
+WS_NOTIFIER_TIMEOUT_SEC = float(
+    os.getenv("NLAB_ARM_WS_NOTIFIER_TIMEOUT_SEC", "5")
+)
+WS_NOTIFIER_BATCH_SIZE = 100
+WS_NOTIFIER_RETRY_SEC = 5
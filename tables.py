@@ -1,10 +1,14 @@
-from sqlalchemy import (BigInteger, Column, DateTime, ForeignKey, Integer,
-                        MetaData, String, Table, func)
+from sqlalchemy import (BigInteger, Boolean, Column, DateTime, ForeignKey,
+                        Index, Integer, LargeBinary, MetaData, String, Table,
+                        func)
 from sqlalchemy.dialects.postgresql import ENUM, JSONB, UUID
 
 metadata = MetaData()
 
-TASK_STATUSES = ("enqueued", "working", "finished", "failed")
+TASK_STATUSES = (
+    "enqueued", "working", "finished", "failed", "superseded", "cancelled",
+    "timed_out",
+)
 task_statuses = ENUM(*TASK_STATUSES, name="status")
 
 tasks_table = Table(
@@ -26,6 +30,9 @@ tasks_table = Table(
     Column(   # заблокирован задачей
         "locked_by", String, nullable=True
     ),
+    Column(   # время выборки задачи обработчиком
+        "locked_at", DateTime(timezone=True), nullable=True
+    ),
     Column(  # аргументы, которые будут переданы в функцию
         "args", JSONB
     ),
@@ -39,7 +46,7 @@ tasks_table = Table(
         "meta", JSONB, server_default="{}", nullable=False
     ),
     Column(  # дополнительные поля (такие как complect_id и т.п...)
-        "extra", JSONB, nullable=True  # индекс gin создан руками в миграции
+        "extra", JSONB, nullable=True
     ),
     Column(
         "created", DateTime(timezone=True), nullable=False,
@@ -48,20 +55,89 @@ tasks_table = Table(
     Column(
         "updated", DateTime(timezone=True), nullable=True, onupdate=func.now()
     ),
+    Column(  # срок аренды задачи обработчиком, продлевается heartbeat-ом
+        "lease_expires", DateTime(timezone=True), nullable=True
+    ),
+    Column(  # количество выборок задачи обработчиками
+        "attempts", Integer, server_default="0", nullable=False
+    ),
+    Column(  # приоритет выборки, больше - раньше
+        "priority", Integer, server_default="0", nullable=False
+    ),
+    Column(  # ключ объединения одинаковых задач в очереди
+        "coalesce_key", String, nullable=True
+    ),
+    Column(  # ограничение времени выполнения (в секундах), NULL - по типу
+        "timeout", Integer, nullable=True
+    ),
+    Column(  # запрошена отмена выполняемой задачи
+        "cancel_requested", Boolean, server_default="false", nullable=False
+    ),
+    Column(  # копия extra->>'complect_id', заполняется триггером
+        "complect_id", String, nullable=True
+    ),
+)
+# Индекс под выборку очередной задачи обработчиком
+Index(
+    "tasks_enqueued_index", tasks_table.c.type,
+    tasks_table.c.priority.desc(), tasks_table.c.created,
+    postgresql_where=tasks_table.c.status == "enqueued",
+)
+
+# Индекс под поиск ожидающей задачи с тем же ключом объединения
+Index(
+    "tasks_coalesce_key_index", tasks_table.c.coalesce_key,
+    postgresql_where=tasks_table.c.status == "enqueued",
+)
+
+# Индекс под подсчет задач обработчиков при проверке ограничений выборки
+Index(
+    "tasks_locked_index", tasks_table.c.locked_by, tasks_table.c.locked_at,
+)
+
+# Индекс под недавние выборки владельцев при справедливой очередности
+Index(
+    "tasks_locked_at_index", tasks_table.c.locked_at,
+)
+
+# Индекс под поиск задач с истекшей арендой
+Index(
+    "tasks_lease_expires_index", tasks_table.c.lease_expires,
+    postgresql_where=tasks_table.c.status == "working",
+)
+
+# Индекс под постраничный список задач типа (task.list с cursor)
+Index(
+    "tasks_type_created_index", tasks_table.c.type, tasks_table.c.created,
+    tasks_table.c.task_id,
+)
+
+# Завершенные задачи, которые переносятся в архив
+TASK_DONE_STATUSES = (
+    "finished", "failed", "superseded", "cancelled", "timed_out",
+)
+
+# Индекс под выборку завершенных задач для переноса в архив
+Index(
+    "tasks_done_created_index", tasks_table.c.created,
+    postgresql_where=tasks_table.c.status.in_(TASK_DONE_STATUSES),
+)
+
+# Индекс под фильтр task.list по extra (extra @> '{...}')
+Index(
+    "tasks_extra_index", tasks_table.c.extra,
+    postgresql_using="gin",
+    postgresql_ops={"extra": "jsonb_path_ops"},
+    postgresql_where=tasks_table.c.extra.isnot(None),
+)
+
+# Индекс под список задач комплекта. complect_id заполняет триггер
+# tasks_set_complect_id_trigger (см. миграции).
+Index(
+    "tasks_complect_id_index", tasks_table.c.type,
+    tasks_table.c.complect_id, tasks_table.c.created, tasks_table.c.task_id,
+    postgresql_where=tasks_table.c.complect_id.isnot(None),
 )
-# Внимание! Для таблицы "tasks" и поля "extra" рекомендуется создать
-# gin-индекс.
-#
-# SQL для него такой:
-#
-# CREATE INDEX tasks_extra_index
-#    ON tasks USING gin (extra)
-#    WHERE extra IS NOT NULL;
-#
-# Создать индекс можно так:
-# - Выполнить SQL скрипт в БД
-# или
-# - Добавить код создания и удаления индекса в миграцию (рекомендуемый способ)
 
 
 task_reports_table = Table(
@@ -84,6 +160,84 @@ task_reports_table = Table(
         server_default=func.now()
     ),
 )
+# Строки о смене статуса пишет триггер tasks_report_status_trigger (см.
+# миграции), строки этапов - обработчики задач.
+# Индекс под выборку истории задачи
+Index(
+    "task_reports_task_id_index", task_reports_table.c.task_id,
+)
+
+
+# Исходящие уведомления о смене статуса задач (outbox). Строки пишет триггер
+# tasks_outbox_status_trigger в транзакции изменения задачи, процесс
+# event_relay отправляет их в сервис уведомлений и удаляет. Внешнего ключа
+# нет: задача может уйти в архив раньше, чем уведомление будет отправлено.
+task_events_table = Table(
+    "task_events", metadata,
+
+    Column(
+        "id", BigInteger, primary_key=True, autoincrement=True
+    ),
+    Column(
+        "task_id", UUID, nullable=False
+    ),
+    Column(
+        "type", String, nullable=False
+    ),
+    Column(
+        "status", task_statuses, nullable=False
+    ),
+    Column(
+        "created", DateTime(timezone=True), nullable=False,
+        server_default=func.now()
+    ),
+)
+
+
+# Полный вывод задач (сжатый zlib текст в UTF-8), в tasks.result остается
+# конец вывода. Строки удаляются при переносе задачи в архив.
+task_outputs_table = Table(
+    "task_outputs", metadata,
+
+    Column(
+        "task_id", UUID, primary_key=True
+    ),
+    Column(
+        "data", LargeBinary, nullable=False
+    ),
+    Column(
+        "size", Integer, nullable=False
+    ),
+    Column(
+        "created", DateTime(timezone=True), nullable=False,
+        server_default=func.now()
+    ),
+)
+
+
+def _archive_table(name, table):
+    """
+    Архивная таблица с теми же колонками, что и table. Строки переносятся
+    целиком, поэтому значения по умолчанию и внешние ключи не нужны.
+    """
+    return Table(name, metadata, *[
+        Column(
+            column.name, column.type, primary_key=column.primary_key,
+            nullable=column.nullable, autoincrement=False,
+        )
+        for column in table.columns
+    ])
+
+
+# Завершенные задачи старше TASK_ARCHIVE_AFTER_DAYS и их история
+tasks_archive_table = _archive_table("tasks_archive", tasks_table)
+task_reports_archive_table = _archive_table(
+    "task_reports_archive", task_reports_table
+)
+Index(
+    "task_reports_archive_task_id_index",
+    task_reports_archive_table.c.task_id,
+)
 
 
 complects_revisions_table = Table(
@@ -116,6 +270,14 @@ complects_revisions_table = Table(
         server_default=func.now()
     ),
 )
+# Индекс под постраничный список ревизий комплекта
+# (complect_revision.list с cursor)
+Index(
+    "complects_revisions_complect_created_index",
+    complects_revisions_table.c.complect_id,
+    complects_revisions_table.c.created,
+    complects_revisions_table.c.revision_id,
+)
 
 
 complects_revisions_seq_table = Table(
@@ -1,22 +1,41 @@
-import datetime
-import importlib
+import asyncio
+import functools
 import logging
+import os
+import resource
+import sys
+import threading
+import time
 import traceback
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
 from time import sleep
-from urllib.parse import urljoin
 
-import requests
 import sqlalchemy
 from nlab import elk
 from nlab.db import create_sessionmaker
+from nlab.postgres import Postgres
 
 import settings
-from models import Task
-from pyqu.core import WorkerData
-from pyqu.impl.process.multiproc import MultiprocessingProcessBackend
-from pyqu.impl.queue.postgres import QueuePostgresSqlachemyBackend
+from components_utils.db import (archive_tasks, relay_task_events,
+                                 store_task_output)
+from components_utils.notifier import NotificationSender
+from engine.progress import StageReporter
+from models import Task, TaskReports
+from pyqu.cancel import CancelToken
+from pyqu.core import (QueueBackend, QueueItem, QueueLimit, QueueRoute,
+                       WorkerData)
+from pyqu.heartbeat import Heartbeat
+from pyqu.impl.process.multiproc import (RECYCLE_EXIT_CODE,
+                                        MultiprocessingProcessBackend)
+from pyqu.impl.process.threadpool import (ThreadPoolProcessBackend,
+                                          abandon_thread, is_abandoned)
+from pyqu.impl.queue.postgres import (PostgresNotifyListener,
+                                     QueuePostgresSqlachemyBackend)
+from pyqu.impl.queue.postgres_async import QueueAsyncpgBackend
 from pyqu.pyqu import Pyqu
+from scripts import TASK_SCRIPTS, load_task_function, warm_up
 from settings import NLAB_ARM_WS_NOTIFIER_URL
 from utils import TaskResult
 
@@ -32,33 +51,82 @@ class TaskRunArguments(WorkerData):
     task_json_args: list
     task_add_kwargs: dict
     task_add_vars: list
+    queue_backend: QueueBackend
     func: 'typing.Any'  # noqa
+    task_limits: list = field(default_factory=list)
 
 
-EVENT = "task_report"
+@dataclass
+class AsyncTaskRunArguments(WorkerData):
+    """
+    Процесс, в котором задачи выполняются на одном event loop asyncio
+    """
+    worker_name: str
+    workers: list
+    max_in_flight: int
+    sync_threads: int
+    func: 'typing.Any'  # noqa
 
 
-def send_change_status_notification(namespace, task_id, status, event=None):
+@dataclass
+class ThreadGroupRunArguments(WorkerData):
     """
-    Отправка уведомления об изменении статуса задачи
+    Процесс, в котором обработчики задач запускаются потоками
     """
-    try:
-        requests.post(
-            url=urljoin(NLAB_ARM_WS_NOTIFIER_URL, "send_notification"),
-            json={
-                "event": event or EVENT,
-                "data": {
-                    "data": {
-                        "task_id": task_id,
-                        "status": status,
-                    }
-                },
-                "namespace": "/{}".format(namespace)
-            }
-        )
-    except(requests.exceptions.HTTPError, requests.exceptions.ConnectionError,
-           requests.exceptions.Timeout, requests.exceptions.RequestException):
-        pass
+    worker_name: str
+    workers: list
+    func: 'typing.Any'  # noqa
+
+
+@dataclass
+class MaintenanceRunArguments(WorkerData):
+    """
+    Процесс обслуживания очереди: освобождение задач с истекшей арендой и
+    перенос завершенных задач в архив
+    """
+    worker_name: str
+    interval: int
+    archive_interval: int
+    queue_backend: QueueBackend
+    func: 'typing.Any'  # noqa
+
+
+@dataclass
+class EventRelayRunArguments(WorkerData):
+    """
+    Процесс передачи уведомлений о смене статуса задач из task_events в
+    сервис уведомлений
+    """
+    worker_name: str
+    batch_size: int
+    interval: int
+    retry_interval: int
+    func: 'typing.Any'  # noqa
+
+
+EVENT = "task_report"
+
+UNEXPECTED_FAIL_RESULT = {
+    "output": "Unexpected fail. Please restart task",
+    "success": False, "messages": [],
+}
+
+LEASE_EXPIRED_RESULT = {
+    "output": "Task worker stopped responding. Please restart task",
+    "success": False, "messages": [],
+}
+
+# Результаты задач, прерванных до того, как функция вернула свой
+CANCEL_RESULTS = {
+    Task.CANCELLED: {
+        "output": "Task was cancelled",
+        "success": False, "messages": [],
+    },
+    Task.TIMED_OUT: {
+        "output": "Task timed out",
+        "success": False, "messages": [],
+    },
+}
 
 
 def switch_failed_tasks(session):
@@ -68,206 +136,712 @@ def switch_failed_tasks(session):
     ).update({"status": Task.FAILED})
 
 
-def _task_cycle_impl(*, session, worker_name, task_type=None,
-                     task_json_args=None,
-                     task_add_kwargs=None, task_add_vars=None):
+def _make_task_kwargs(item: QueueItem, task_add_kwargs=None,
+                      task_add_vars=None, cancel_token=None,
+                      queue: QueueBackend = None):
 
-    # log.debug("Cycle: %s, %s", task_type, task_json_args)
-    pass_filter_q = [Task.status == Task.ENQUEUED]
+    task_add_vars = task_add_vars or []
 
-    if task_type:
-        pass_filter_q.append(Task.type == task_type)
+    task_kwargs = {}
+    task_kwargs.update(task_add_kwargs or {})
+    task_kwargs.update(**item.args)
+    if "task_id" in task_add_vars:
+        task_kwargs["task_id"] = item.item_id
+    if "cancel_token" in task_add_vars:
+        task_kwargs["cancel_token"] = cancel_token
+    if "is_superseded" in task_add_vars:
+        # Проверка через очередь обработчика, без своей очереди в задаче
+        task_kwargs["is_superseded"] = functools.partial(
+            queue.is_superseded, item.item_id
+        )
 
-    task_add_vars = task_add_vars or []
+    return task_kwargs
+
+
+def _task_timeout(item: QueueItem):
+    """
+    Ограничение времени выполнения задачи (в секундах) или None
+    """
+    return item.timeout or settings.TASK_TIMEOUT_SEC_BY_TYPE.get(
+        item.type, settings.TASK_TIMEOUT_SEC
+    ) or None
 
-    task_json_args = task_json_args or []
-    for arg in task_json_args:
-        assert isinstance(arg, (tuple, list))
-        pass_filter_q.append(Task.args[arg[0]].astext == arg[1])
 
-    task_model = session.query(Task).filter(*pass_filter_q).order_by(
-        Task.created
-    ).with_for_update().first()
+def _unpack_task_result(task_result):
+    """
+    Результат, extra и итоговый статус задачи из значения, которое вернула
+    функция
+    """
+    if isinstance(task_result, dict):
+        # Deprecated logic
+        return task_result, None, Task.FINISHED
+    elif isinstance(task_result, TaskResult):
+        return (
+            task_result.result, task_result.extra,
+            task_result.status or Task.FINISHED,
+        )
+
+    raise RuntimeError("Unhandled task result: %s" % task_result)
+
+
+def _task_outcome(task_result, cancel_token: CancelToken):
+    """
+    Результат, extra и итоговый статус задачи с учетом отмены. Функция
+    прерванной задачи могла ничего не вернуть.
+    """
+    if not cancel_token.cancelled:
+        return _unpack_task_result(task_result)
 
-    if not task_model:
-        sleep(settings.TASK_RUN_TIME_INTERVAL_SEC)
+    result, extra = None, None
+    if task_result is not None:
+        result, extra, _ = _unpack_task_result(task_result)
+
+    reason = cancel_token.reason
+    return result or CANCEL_RESULTS[reason], extra, reason
+
+
+def _call_task_function(function, task_kwargs, cancel_token: CancelToken):
+    """
+    Вызов функции задачи. Если задача отменена, ошибка функции считается
+    следствием прерывания (например, закрытого SSH-канала).
+
+    :return: результат, extra и итоговый статус
+    """
+    try:
+        task_result = function(**task_kwargs)
+    except Exception:
+        if not cancel_token.cancelled:
+            raise
+
+        log.warning("Task function interrupted: %s", cancel_token.reason,
+                    exc_info=True)
+        task_result = None
+
+    return _task_outcome(task_result, cancel_token)
+
+
+def _abandon_task(*, queue: QueueBackend, item: QueueItem, worker_name,
+                  cancel_token: CancelToken, thread: threading.Thread):
+    """
+    Отказ от задачи, функция которой не вышла после отмены: поток с ней
+    прервать нельзя. Задача получает статус отмены. Процесс с одним
+    обработчиком завершается и перезапускается супервизором, поток
+    обработчика в общем процессе заменяется новым, а сам завершается после
+    выхода из функции.
+    """
+    reason = cancel_token.reason
+    try:
+        queue.ack(item.item_id, worker_name=worker_name,
+                  result=CANCEL_RESULTS[reason], status=reason)
+    except Exception:
+        # Задачу освободит release_locked при перезапуске обработчика
+        log.exception("Can't finish stuck task %s", item.item_id)
+
+    if thread is not threading.main_thread():
+        log.error("Task %s is stuck, replace thread of worker %s",
+                  item.item_id, worker_name)
+        abandon_thread(thread)
         return
 
-    task_kwargs = {}
-    task_kwargs.update(task_add_kwargs or {})
-    task_kwargs.update(**task_model.args)
-    if "task_id" in task_add_vars:
-        task_kwargs["task_id"] = task_model.task_id
+    log.error("Task %s is stuck, exit worker %s", item.item_id, worker_name)
+    os._exit(1)
 
-    task_model.status = Task.WORKING
-    task_model.locked_by = worker_name  # FIX race to postgres
-    task_model.updated = datetime.datetime.now()
 
-    session.add(task_model)
-    session.commit()
+def _task_cycle_impl(*, queue: QueueBackend, route: QueueRoute,
+                     worker_name, task_add_kwargs=None,
+                     task_add_vars=None) -> bool:
+    """
+    Выборка и выполнение одной задачи
 
-    send_change_status_notification(
-        namespace=task_model.type, task_id=task_model.task_id,
-        status=task_model.status
+    :return: True, если задача была выбрана
+    """
+    # log.debug("Cycle: %s", route)
+    item = queue.claim(route, worker_name)
+
+    if not item:
+        # Ждем NOTIFY о новой задаче, опрос остается запасным вариантом
+        queue.wait(route, settings.TASK_NOTIFY_WAIT_SEC)
+        return False
+
+    cancel_token = CancelToken()
+    task_kwargs = _make_task_kwargs(
+        item, task_add_kwargs, task_add_vars, cancel_token=cancel_token,
+        queue=queue,
     )
 
-    log.info(f"The task {task_model.task_id} in progress...")
+    log.info(f"The task {item.item_id} in progress...")
 
+    status = Task.FAILED
     function = None
     try:
-        module_name, function_name = task_model.script.rsplit(".", 1)
-        module = importlib.import_module(module_name)
-        function = getattr(module, function_name)
+        function = load_task_function(item.script)
 
     except (ModuleNotFoundError, AttributeError):
-        task_model.status = Task.FAILED
-        task_model.errortext = traceback.format_exc()
+        queue.nack(
+            item.item_id, worker_name=worker_name,
+            errortext=traceback.format_exc(),
+        )
         log.exception(
             "Error in starting",
             extra={
-                "script": task_model.script,
-                "params": task_model.args,
-                "status": task_model.status,
+                "script": item.script,
+                "params": item.args,
+                "status": status,
             }
         )
 
     if function:
-        try:
-            task_result = function(**task_kwargs)
-
-            if isinstance(task_result, dict):
-                # Deprecated logic
-                task_model.result = task_result
-            elif isinstance(task_result, TaskResult):
-                task_model.result = task_result.result
-                task_model.extra = task_result.extra
-            else:
-                raise RuntimeError("Unhandled task result: %s" % task_result)
+        on_stuck = functools.partial(
+            _abandon_task, queue=queue, item=item,
+            worker_name=worker_name, cancel_token=cancel_token,
+            thread=threading.current_thread(),
+        )
 
-            task_model.status = Task.FINISHED
+        try:
+            with Heartbeat(queue, item.item_id, worker_name,
+                           interval=settings.TASK_HEARTBEAT_INTERVAL_SEC,
+                           cancel_token=cancel_token,
+                           timeout=_task_timeout(item),
+                           grace=settings.TASK_CANCEL_GRACE_SEC,
+                           on_stuck=on_stuck):
+                result, extra, final_status = _call_task_function(
+                    function, task_kwargs, cancel_token
+                )
 
         except Exception:
-            task_model.status = Task.FAILED
-            task_model.errortext = traceback.format_exc()
+            queue.nack(
+                item.item_id, worker_name=worker_name,
+                errortext=traceback.format_exc(),
+            )
             log.exception(
                 "Error in call",
                 extra={
-                    "script": task_model.script,
-                    "params": task_model.args,
-                    "status": task_model.status,
+                    "script": item.script,
+                    "params": item.args,
+                    "status": status,
                 }
             )
 
+        else:
+            if queue.ack(item.item_id, worker_name=worker_name,
+                         result=result, extra=extra, status=final_status):
+                status = final_status
+            else:
+                # Аренду забрал reaper: задача уже перезапущена или failed
+                log.error("Lease of task %s lost, result dropped",
+                          item.item_id)
+                return True
+
     log.info("Completed task {} with the status {}".format(
-        task_model.task_id, task_model.status.upper()))
+        item.item_id, status.upper()))
+
+    return True
+
+
+# Фабрика сессий процесса и pid, в котором она создана
+_sessionmaker = None
+_sessionmaker_pid = None
+_sessionmaker_lock = threading.Lock()
 
-    task_model.updated = datetime.datetime.now()
-    session.add(task_model)
-    session.commit()
 
-    send_change_status_notification(
-        namespace=task_model.type, task_id=task_model.task_id,
-        status=task_model.status
+def get_sessionmaker():
+    """
+    Фабрика сессий процесса обработчиков. Создается при первом вызове в
+    процессе, и все задачи, очередь и обслуживание процесса используют один
+    пул соединений. В дочернем процессе создается заново: соединения
+    родителя не наследуются.
+    """
+    global _sessionmaker, _sessionmaker_pid
+
+    with _sessionmaker_lock:
+        if _sessionmaker_pid != os.getpid():
+            _sessionmaker = create_sessionmaker(
+                env_prefix=settings.POSTGRES_PREFIX
+            )
+            _sessionmaker_pid = os.getpid()
+
+        return _sessionmaker
+
+
+def create_queue_backend() -> QueuePostgresSqlachemyBackend:
+
+    return QueuePostgresSqlachemyBackend(
+        entity=Task,
+        sessionmaker_factory=get_sessionmaker,
+        notify_channel=settings.TASK_NOTIFY_CHANNEL,
+        retry_interval=settings.TASK_RUN_TIME_INTERVAL_SEC,
+        lease_sec=settings.TASK_LEASE_SEC,
+        fair_share_keys=settings.TASK_FAIR_SHARE_KEYS,
     )
 
 
-def create_engine():
+def create_stage_reporter(task_id) -> StageReporter:
+    """
+    Запись событий этапов задачи в task_reports.meta. Статус таких записей
+    working, от смены статуса они отличаются ключом stage в meta.
+    """
+    create_session = get_sessionmaker()
+    table = TaskReports.__table__
+
+    def emit(event):
+        with create_session() as session:
+            session.execute(table.insert().values(
+                task_id=task_id, status=Task.WORKING, meta=event,
+            ))
+            session.commit()
+
+    return StageReporter(emit=emit)
+
+
+def offload_task_output(task_id, output_result) -> dict:
+    """
+    Перенос длинного вывода задачи из результата в task_outputs. В
+    результате остаются последние TASK_OUTPUT_SUMMARY_CHARS символов (там
+    итог и ошибки), полный вывод по частям возвращает task.output.
+    """
+    output = output_result.get("output") or ""
+    if len(output) <= settings.TASK_OUTPUT_SUMMARY_CHARS:
+        return output_result
 
-    sessionmaker = create_sessionmaker(
-        env_prefix=settings.POSTGRES_PREFIX
+    try:
+        create_session = get_sessionmaker()
+        with create_session() as session:
+            store_task_output(session, task_id, output)
+    except Exception:
+        # Лучше тяжелый результат, чем потерянный вывод
+        log.exception("Can't store output of task %s", task_id)
+        return output_result
+
+    return dict(
+        output_result,
+        output=output[-settings.TASK_OUTPUT_SUMMARY_CHARS:],
+        output_size=len(output),
+        output_truncated=True,
     )
-    return sessionmaker
 
 
 def _task_loop(args: TaskRunArguments):
     paramiko_transport_logger = logging.getLogger('paramiko.transport')
     paramiko_transport_logger.setLevel(logging.INFO)
 
-    RECREATE_SESSION_ERRORS = (
+    warm_up([args.task_type])
+
+    DATABASE_ERRORS = (
         sqlalchemy.exc.DatabaseError,
         sqlalchemy.exc.InvalidRequestError,
         sqlalchemy.exc.StatementError,
         sqlalchemy.exc.OperationalError,
     )
 
-    sessionmaker = create_engine()
-
-    # fail working tasks with exact such name
-    with sessionmaker() as session:
-        session.query(Task).filter(
-            Task.status == Task.WORKING,
-            Task.locked_by == args.worker_name,
-        ).update({
-            "status": Task.FAILED,
-            "result": {
-                "output": "Unexpected fail. Please restart task",
-                "success": False, "messages": [],
-            }
-        })
-        session.commit()
+    queue = args.queue_backend
+    route = QueueRoute(
+        item_type=args.task_type, json_args=args.task_json_args,
+        limits=args.task_limits,
+    )
+
+    # Задачи, оставшиеся за обработчиком с таким именем после рестарта,
+    # возвращаются в очередь или failed, если попытки исчерпаны
+    queue.release_locked(
+        args.worker_name,
+        max_attempts=settings.TASK_MAX_ATTEMPTS,
+        max_attempts_by_type=settings.TASK_MAX_ATTEMPTS_BY_TYPE,
+        result=UNEXPECTED_FAIL_RESULT,
+    )
+
+    processed = 0
+    while not _should_recycle(processed):
+        try:
+            if _task_cycle_impl(
+                queue=queue,
+                route=route,
+                worker_name=args.worker_name,
+                task_add_kwargs=args.task_add_kwargs,
+                task_add_vars=args.task_add_vars,
+            ):
+                processed += 1
+
+        except DATABASE_ERRORS:
+            # Сессии создаются на каждую операцию с очередью, поэтому
+            # достаточно переждать недоступность БД
+            log.exception("Database error")
+            sleep(settings.TASK_RUN_TIME_INTERVAL_SEC)
+
+        except Exception:
+            log.exception("Unhandled error in task cycle")
+
+    if threading.current_thread() is threading.main_thread():
+        # Отдельный код выхода: супервизор не считает перезапуск падением
+        sys.exit(RECYCLE_EXIT_CODE)
+
+
+def _should_recycle(processed):
+    """
+    Нужно ли завершить процесс обработчика, чтобы ограничить рост памяти.
+    Процесс завершается с кодом RECYCLE_EXIT_CODE и сразу перезапускается
+    супервизором. Обработчики-потоки не завершаются: память освобождается
+    только вместе с процессом. Завершается только брошенный поток, слот
+    которого уже отдан новому (см. _abandon_task).
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return is_abandoned(threading.current_thread())
+
+    if not processed:
+        # Перезапуск без задержки: процесс, которому уже при старте не
+        # хватает памяти, не должен перезапускаться в цикле
+        return False
+
+    if 0 < settings.TASK_RECYCLE_AFTER_TASKS <= processed:
+        log.info("Recycle worker after %d tasks", processed)
+        return True
+
+    # ru_maxrss в Linux в килобайтах
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    if 0 < settings.TASK_RECYCLE_MAX_RSS_MB <= max_rss_mb:
+        log.info("Recycle worker with RSS %d MB", max_rss_mb)
+        return True
+
+    return False
+
+
+def _maintenance_loop(args: MaintenanceRunArguments):
+
+    queue = args.queue_backend
+    create_session = get_sessionmaker()
+    next_archive = time.monotonic()
 
     while True:
         try:
-            with sessionmaker() as session:
-                while True:
-                    try:
-                        _task_cycle_impl(
-                            task_type=args.task_type,
-                            worker_name=args.worker_name,
-                            task_json_args=args.task_json_args,
-                            task_add_kwargs=args.task_add_kwargs,
-                            task_add_vars=args.task_add_vars,
-                            session=session,
-                        )
-                    except RECREATE_SESSION_ERRORS:
-                        log.exception("Database error")
-                        raise
-
-                    except Exception:
-                        log.exception("Unhandled error in task cycle")
-
-        except RECREATE_SESSION_ERRORS:
-            session.rollback()
-            log.exception("Recreate session error")
+            count = queue.reap_expired(
+                max_attempts=settings.TASK_MAX_ATTEMPTS,
+                max_attempts_by_type=settings.TASK_MAX_ATTEMPTS_BY_TYPE,
+                result=LEASE_EXPIRED_RESULT,
+            )
+            if count:
+                log.warning("Released %d tasks with expired lease", count)
 
         except Exception:
-            log.exception("Unhandled error in whole loop")
+            log.exception("Unhandled error in maintenance cycle")
 
+        if settings.TASK_ARCHIVE_AFTER_DAYS > 0 \
+                and time.monotonic() >= next_archive:
+            next_archive = time.monotonic() + args.archive_interval
+            try:
+                _archive_cycle(create_session)
+            except Exception:
+                log.exception("Unhandled error in archive cycle")
 
-def ok_callback(_):
-    pass
+        sleep(args.interval)
 
 
-def error_callback(e):
-    logger = logging.getLogger()
-    logger.exception("System exception in task: %s", e)
+def _archive_cycle(create_session):
+    """
+    Перенос завершенных задач в архив небольшими пачками, чтобы не держать
+    долгих блокировок и не раздувать транзакцию
+    """
+    before = datetime.now() - timedelta(days=settings.TASK_ARCHIVE_AFTER_DAYS)
+
+    total = 0
+    for _ in range(settings.TASK_ARCHIVE_MAX_BATCHES):
+        with create_session() as session:
+            count = archive_tasks(
+                session, before=before,
+                limit=settings.TASK_ARCHIVE_BATCH_SIZE,
+            )
 
+        total += count
+        if count < settings.TASK_ARCHIVE_BATCH_SIZE:
+            break
 
-if __name__ == "__main__":
+    if total:
+        log.info("Archived %d tasks", total)
 
-    # Список датаклассов с аргументами задач для процесса
-    run_process_args = [
-        TaskRunArguments(
-            func=_task_loop,
-            task_type="testcase", task_json_args=[],
-            task_add_kwargs={}, task_add_vars=[],
-            worker_name="testcase",
-        ),
-        TaskRunArguments(
-            func=_task_loop,
-            task_type="suite", task_json_args=[],
-            task_add_kwargs={}, task_add_vars=[],
-            worker_name="suite",
-        ),
-        TaskRunArguments(
-            func=_task_loop,
-            task_type="dictionary", task_json_args=[],
-            task_add_kwargs={}, task_add_vars=[],
-            worker_name="dictionary",
-        ),
+
+def _event_relay_loop(args: EventRelayRunArguments):
+
+    create_session = get_sessionmaker()
+    with create_session() as session:
+        engine = session.get_bind()
+
+    # Подписка до первой выборки, чтобы не пропустить уведомление
+    listener = PostgresNotifyListener(
+        engine, channel=settings.TASK_EVENTS_CHANNEL,
+        retry_interval=args.retry_interval,
+    )
+    listener.listen()
+
+    sender = NotificationSender(
+        NLAB_ARM_WS_NOTIFIER_URL, timeout=settings.WS_NOTIFIER_TIMEOUT_SEC
+    )
+    failed = False
+
+    def send(rows):
+        nonlocal failed
+
+        sent = sender.send([
+            (row.type, row.task_id, row.status, EVENT) for row in rows
+        ])
+        failed = sent < len(rows)
+        return sent
+
+    while True:
+        failed = False
+        try:
+            with create_session() as session:
+                count = relay_task_events(
+                    session, send, limit=args.batch_size
+                )
+        except Exception:
+            log.exception("Unhandled error in event relay cycle")
+            failed = True
+            count = None
+
+        if failed:
+            # Неотправленные уведомления остаются в таблице
+            sleep(args.retry_interval)
+        elif count != args.batch_size:
+            # Уведомлений больше нет или их передает другой процесс
+            listener.wait(args.interval)
+
+
+def _thread_group_loop(args: ThreadGroupRunArguments):
+
+    warm_up({worker_args.task_type for worker_args in args.workers})
+
+    process_backend = ThreadPoolProcessBackend(
+        max_abandoned=settings.TASK_MAX_ABANDONED_THREADS,
+    )
+    process_backend.init(args.workers)
+    process_backend.start()
+    process_backend.wait()
+
+
+def _async_task_loop(args: AsyncTaskRunArguments):
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_async_task_main(args))
+
+
+async def _async_task_main(args: AsyncTaskRunArguments):
+
+    warm_up({worker_args.task_type for worker_args in args.workers})
+
+    db = Postgres(env_prefix=settings.POSTGRES_PREFIX, connectNow=False)
+    await db.connect()
+
+    queue = QueueAsyncpgBackend(
+        entity=Task, db=db,
+        notify_channel=settings.TASK_NOTIFY_CHANNEL,
+        lease_sec=settings.TASK_LEASE_SEC,
+        fair_share_keys=settings.TASK_FAIR_SHARE_KEYS,
+    )
+    await queue.listen()
+
+    # Синхронные функции задач выполняются в пуле потоков
+    executor = ThreadPoolExecutor(max_workers=args.sync_threads)
+    in_flight = asyncio.Semaphore(args.max_in_flight)
+
+    await asyncio.gather(*[
+        _async_claim_loop(
+            queue=queue, args=worker_args, in_flight=in_flight,
+            executor=executor,
+        )
+        for worker_args in args.workers
+    ])
+
+
+async def _async_claim_loop(*, queue: QueueAsyncpgBackend,
+                            args: TaskRunArguments,
+                            in_flight: asyncio.Semaphore, executor):
+
+    route = QueueRoute(
+        item_type=args.task_type, json_args=args.task_json_args
+    )
+
+    await queue.release_locked(
+        args.worker_name,
+        max_attempts=settings.TASK_MAX_ATTEMPTS,
+        max_attempts_by_type=settings.TASK_MAX_ATTEMPTS_BY_TYPE,
+        result=UNEXPECTED_FAIL_RESULT,
+    )
+
+    while True:
+        await in_flight.acquire()
+
+        try:
+            item = await queue.claim(route, args.worker_name)
+        except Exception:
+            in_flight.release()
+            log.exception("Database error")
+            await asyncio.sleep(settings.TASK_RUN_TIME_INTERVAL_SEC)
+            continue
+
+        if not item:
+            in_flight.release()
+            # Ждем NOTIFY о новой задаче, опрос остается запасным вариантом
+            await queue.wait(route, settings.TASK_NOTIFY_WAIT_SEC)
+            continue
+
+        task = asyncio.ensure_future(_async_task_run(
+            queue=queue, item=item, args=args, executor=executor,
+        ))
+        task.add_done_callback(lambda _: in_flight.release())
+
+
+async def _async_task_run(*, queue: QueueAsyncpgBackend, item: QueueItem,
+                          args: TaskRunArguments, executor):
+
+    loop = asyncio.get_event_loop()
+
+    cancel_token = CancelToken()
+    task_kwargs = _make_task_kwargs(
+        item, args.task_add_kwargs, args.task_add_vars,
+        cancel_token=cancel_token,
+    )
+
+    log.info(f"The task {item.item_id} in progress...")
+
+    status = Task.FAILED
+    heartbeat = asyncio.ensure_future(_async_heartbeat(
+        queue=queue, item=item, worker_name=args.worker_name,
+        cancel_token=cancel_token,
+    ))
+    try:
+        function = load_task_function(item.script)
+
+        if asyncio.iscoroutinefunction(function):
+            call = asyncio.ensure_future(function(**task_kwargs))
+        else:
+            # Поток пула не прерывается: синхронная функция узнает об
+            # отмене только через cancel_token
+            call = loop.run_in_executor(
+                executor, functools.partial(function, **task_kwargs)
+            )
+
+        cancel_token.add_callback(
+            lambda _: loop.call_soon_threadsafe(call.cancel)
+        )
+
+        try:
+            task_result = await asyncio.wait_for(call, _task_timeout(item))
+        except asyncio.TimeoutError:
+            cancel_token.cancel(Task.TIMED_OUT)
+            task_result = None
+        except (asyncio.CancelledError, Exception):
+            if not cancel_token.cancelled:
+                raise
+            task_result = None
+
+        result, extra, final_status = _task_outcome(task_result, cancel_token)
+
+    except Exception:
+        heartbeat.cancel()
+        try:
+            await queue.nack(
+                item.item_id, worker_name=args.worker_name,
+                errortext=traceback.format_exc(),
+            )
+        except Exception:
+            # Задача без продления аренды вернется в очередь через
+            # reap_expired
+            log.exception("Can't fail task %s", item.item_id)
+        log.exception(
+            "Error in call",
+            extra={
+                "script": item.script,
+                "params": item.args,
+                "status": status,
+            }
+        )
+
+    else:
+        heartbeat.cancel()
+        try:
+            acked = await queue.ack(
+                item.item_id, worker_name=args.worker_name,
+                result=result, extra=extra, status=final_status,
+            )
+        except Exception:
+            log.exception("Can't finish task %s", item.item_id)
+            return
+
+        if acked:
+            status = final_status
+        else:
+            log.error("Lease of task %s lost, result dropped", item.item_id)
+            return
+
+    log.info("Completed task {} with the status {}".format(
+        item.item_id, status.upper()))
+
+
+async def _async_heartbeat(*, queue: QueueAsyncpgBackend, item: QueueItem,
+                           worker_name, cancel_token: CancelToken):
+    """
+    Продление аренды задачи, пока она выполняется на event loop, и проверка
+    запроса отмены
+    """
+    while True:
+        await asyncio.sleep(settings.TASK_HEARTBEAT_INTERVAL_SEC)
+
+        try:
+            alive = await queue.heartbeat(item.item_id, worker_name)
+            if alive and not cancel_token.cancelled \
+                    and await queue.is_cancel_requested(item.item_id):
+                log.warning("Task %s cancelled", item.item_id)
+                cancel_token.cancel(Task.CANCELLED)
+        except Exception:
+            log.exception("Heartbeat error: task=%s", item.item_id)
+            continue
+
+        if not alive:
+            log.error("Lease of task %s lost", item.item_id)
+            return
+
+
+def make_worker_names(name, concurrency):
+    """
+    Уникальные имена обработчиков по слотам. Первый слот сохраняет имя без
+    номера, чтобы при запуске освобождались задачи, заблокированные до
+    включения нескольких слотов.
+    """
+    assert concurrency >= 1, "Concurrency for %s must be positive" % name
+
+    return [name] + [
+        "%s-%d" % (name, slot) for slot in range(2, concurrency + 1)
     ]
 
-    for host_name, host_info in settings.ENGINE_COMPILER_HOSTS.items():
+
+def make_host_worker_args(*, task_type, hosts, host_kwarg,
+                          queue_backend: QueueBackend,
+                          task_add_vars=("task_id", "cancel_token")):
+    """
+    Обработчики задач хостов движка: max_jobs слотов на хост. Ограничения
+    хоста и его группы (ENGINE_CAPACITY_GROUPS) проверяются при выборке,
+    поэтому соблюдаются и при нескольких запущенных task_executor.
+    """
+    worker_names = {
+        host_name: make_worker_names(
+            f"{task_type}-{host_name}", host_info.get("max_jobs", 1)
+        )
+        for host_name, host_info in hosts.items()
+    }
+
+    group_limits = {}
+    for group, group_info in settings.ENGINE_CAPACITY_GROUPS.items():
+        group_limits[group] = QueueLimit(
+            key=f"{task_type}-group-{group}",
+            worker_names=[
+                worker_name
+                for host_name, host_info in hosts.items()
+                if host_info.get("capacity_group") == group
+                for worker_name in worker_names[host_name]
+            ],
+            max_working=group_info.get("max_jobs"),
+            max_per_minute=group_info.get("tokens_per_minute"),
+        )
+
+    all_run_args = []
+    for host_name, host_info in hosts.items():
 
         target = ""
         group = host_info.get("group")
@@ -279,42 +853,152 @@ if __name__ == "__main__":
         else:
             assert not group
 
-        run_args = TaskRunArguments(
-            func=_task_loop,
-            task_type="compiler",
-            task_json_args=[("target", target), ],
-            task_add_kwargs={"compiler_host": host_name},
-            task_add_vars=["task_id"],
-            worker_name=f"compiler-{host_name}",
-        )
-        run_process_args.append(run_args)
+        limits = [QueueLimit(
+            key=f"{task_type}-host-{host_name}",
+            worker_names=worker_names[host_name],
+            max_working=host_info.get("max_jobs", 1),
+            max_per_minute=host_info.get("tokens_per_minute"),
+        )]
+
+        capacity_group = host_info.get("capacity_group")
+        if capacity_group:
+            assert capacity_group in group_limits, \
+                "Unknown capacity group %s" % capacity_group
+            limits.append(group_limits[capacity_group])
+
+        for worker_name in worker_names[host_name]:
+            all_run_args.append(TaskRunArguments(
+                func=_task_loop,
+                task_type=task_type,
+                task_json_args=[("target", target), ],
+                task_add_kwargs={host_kwarg: host_name},
+                task_add_vars=list(task_add_vars),
+                queue_backend=queue_backend,
+                worker_name=worker_name,
+                task_limits=limits,
+            ))
+
+    return all_run_args
+
+
+def log_worker_stats(stats):
+    """
+    Состояние обработчиков в лог: падающие при старте (в задержке
+    перезапуска) отдельно, чтобы их было видно среди остальных
+    """
+    for worker in stats:
+        if worker["failures"]:
+            log.warning("Worker is crash-looping: %s", worker)
+
+    log.info(
+        "Workers: %d; alive: %d; restarts: %d; crash-looping: %d",
+        len(stats),
+        sum(1 for worker in stats if worker["alive"]),
+        sum(worker["restarts"] for worker in stats),
+        sum(1 for worker in stats if worker["failures"]),
+    )
 
-    for host_name, host_info in settings.ENGINE_DEPLOY_HOSTS.items():
 
-        target = ""
-        group = host_info.get("group")
-        if host_info["exclusive"]:
-            target = group if group else host_name
-        else:
-            assert not group
+def ok_callback(_):
+    pass
 
-        run_args = TaskRunArguments(
-            func=_task_loop,
-            task_type="deploy",
-            task_json_args=[("target", target), ],
-            task_add_kwargs={"target": host_name},
-            task_add_vars=["task_id"],
-            worker_name=f"deploy-{host_name}",
-        )
 
-        run_process_args.append(run_args)
+def error_callback(e):
+    logger = logging.getLogger()
+    logger.exception("System exception in task: %s", e)
+
+
+if __name__ == "__main__":
+
+    queue_backend = create_queue_backend()
+
+    # Список датаклассов с аргументами задач для процесса
+    run_process_args = []
+    # Обработчики задач, ожидающих сеть, запускаются потоками одного процесса
+    # или на event loop asyncio
+    run_thread_args = []
+    run_async_args = []
+
+    for task_type in ("testcase", "suite", "dictionary"):
+        concurrency = settings.TASK_CONCURRENCY.get(task_type, 1)
+
+        for worker_name in make_worker_names(task_type, concurrency):
+            run_args = TaskRunArguments(
+                func=_task_loop,
+                task_type=task_type, task_json_args=[],
+                task_add_kwargs={}, task_add_vars=[],
+                queue_backend=queue_backend,
+                worker_name=worker_name,
+            )
+
+            if task_type in settings.TASK_ASYNC_TYPES:
+                run_async_args.append(run_args)
+            elif task_type in settings.TASK_THREADED_TYPES:
+                run_thread_args.append(run_args)
+            else:
+                run_process_args.append(run_args)
+
+    if run_async_args:
+        run_process_args.append(AsyncTaskRunArguments(
+            func=_async_task_loop,
+            worker_name="async",
+            workers=run_async_args,
+            max_in_flight=settings.TASK_ASYNC_MAX_IN_FLIGHT,
+            sync_threads=settings.TASK_ASYNC_SYNC_THREADS,
+        ))
+
+    if run_thread_args:
+        run_process_args.append(ThreadGroupRunArguments(
+            func=_thread_group_loop,
+            worker_name="threads",
+            workers=run_thread_args,
+        ))
+
+    run_process_args.extend(make_host_worker_args(
+        task_type="compiler",
+        hosts=settings.ENGINE_COMPILER_HOSTS,
+        host_kwarg="compiler_host",
+        queue_backend=queue_backend,
+        task_add_vars=("task_id", "cancel_token", "is_superseded"),
+    ))
+    run_process_args.extend(make_host_worker_args(
+        task_type="deploy",
+        hosts=settings.ENGINE_DEPLOY_HOSTS,
+        host_kwarg="target",
+        queue_backend=queue_backend,
+    ))
+
+    run_process_args.append(MaintenanceRunArguments(
+        func=_maintenance_loop,
+        worker_name="maintenance",
+        interval=settings.TASK_REAPER_INTERVAL_SEC,
+        archive_interval=settings.TASK_ARCHIVE_INTERVAL_SEC,
+        queue_backend=queue_backend,
+    ))
+
+    run_process_args.append(EventRelayRunArguments(
+        func=_event_relay_loop,
+        worker_name="event_relay",
+        batch_size=settings.WS_NOTIFIER_BATCH_SIZE,
+        interval=settings.TASK_NOTIFY_WAIT_SEC,
+        retry_interval=settings.WS_NOTIFIER_RETRY_SEC,
+    ))
 
     log.info("Running %d processes", len(run_process_args))
     for args in run_process_args:
         log.info("Running %s", args)
     queue = Pyqu(
-        process_backend=MultiprocessingProcessBackend(),
-        queue_backend=QueuePostgresSqlachemyBackend(),
+        process_backend=MultiprocessingProcessBackend(
+            start_method=settings.TASK_PROCESS_START_METHOD,
+            preload=["__main__"] + sorted({
+                script.rsplit(".", 1)[0] for script in TASK_SCRIPTS
+            }),
+        ),
+        queue_backend=queue_backend,
     )
     queue.init(run_process_args)
-    queue.start_and_wait()
+    queue.start()
+
+    while True:
+        queue.wait(timeout=settings.TASK_STATS_LOG_INTERVAL_SEC)
+        log_worker_stats(queue.stats())
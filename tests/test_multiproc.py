@@ -0,0 +1,54 @@
+"""
+Перезапуск обработчиков MultiprocessingWorker: падение при старте
+откладывает перезапуск, плановый выход для освобождения памяти - нет
+"""
+import multiprocessing
+import sys
+import time
+
+from pyqu.core import WorkerContext
+from pyqu.impl.process.multiproc import (RECYCLE_EXIT_CODE,
+                                         MultiprocessingWorker, RestartBackoff)
+
+
+def crash(args):
+    sys.exit(1)
+
+
+def recycle(args):
+    sys.exit(RECYCLE_EXIT_CODE)
+
+
+def exited(func):
+    worker = MultiprocessingWorker(
+        WorkerContext(func), context=multiprocessing.get_context("fork"),
+        backoff=RestartBackoff(min_uptime=60),
+    )
+    worker.start()
+    worker._process.join()
+    worker.ensure_alive()
+    return worker
+
+
+def test_crash_delays_restart():
+    worker = exited(crash)
+
+    assert worker.stats()["failures"] == 1
+    assert worker.restart_at > time.monotonic()
+    assert worker.stats()["restarts"] == 0
+
+
+def test_recycle_restarts_immediately():
+    worker = exited(recycle)
+
+    assert worker.stats()["failures"] == 0
+    assert worker.restart_at is None
+    assert worker.stats()["restarts"] == 1
+
+
+def test_restart_is_counted():
+    worker = exited(recycle)
+
+    worker.restart()
+
+    assert worker.stats()["restarts"] == 2
@@ -0,0 +1,258 @@
+"""
+Контракт очереди на QueueMemoryBackend: выборка, завершение, аренда,
+объединение и ограничения выборки ведут себя как в
+QueuePostgresSqlachemyBackend
+"""
+import time
+
+import pytest
+
+from pyqu.core import QueueLimit, QueueRoute
+from pyqu.impl.queue.memory import (ENQUEUED, FAILED, FINISHED, WORKING,
+                                    QueueMemoryBackend)
+
+ROUTE = QueueRoute(item_type="compiler")
+
+
+@pytest.fixture
+def queue():
+    return QueueMemoryBackend()
+
+
+def enqueue(queue, **fields):
+    fields.setdefault("script", "scripts.compiler.run")
+    fields.setdefault("type", "compiler")
+    return queue.enqueue(**fields)
+
+
+def test_claim_locks_item(queue):
+    task = enqueue(queue, args={"complect_id": 1})
+
+    item = queue.claim(ROUTE, "worker")
+
+    assert item.item_id == task["task_id"]
+    assert item.args == {"complect_id": 1}
+    state = queue.get(task["task_id"])
+    assert state["status"] == WORKING
+    assert state["locked_by"] == "worker"
+    assert state["attempts"] == 1
+    assert queue.claim(ROUTE, "other") is None
+
+
+def test_claim_filters_type_and_args(queue):
+    enqueue(queue, type="deploy")
+    enqueue(queue, args={"target": "host-1"})
+    task = enqueue(queue, args={"target": "host-2"})
+
+    route = QueueRoute(item_type="compiler", json_args=[("target", "host-2")])
+
+    assert queue.claim(route, "worker").item_id == task["task_id"]
+    assert queue.claim(route, "worker") is None
+
+
+@pytest.mark.parametrize("value, text, matches", [
+    (True, "true", True),
+    (True, "True", False),
+    (5, "5", True),
+    ("5", "5", True),
+    (None, "None", False),
+])
+def test_claim_compares_args_as_json_text(queue, value, text, matches):
+    enqueue(queue, args={"flag": value})
+
+    route = QueueRoute(item_type="compiler", json_args=[("flag", text)])
+
+    assert (queue.claim(route, "worker") is not None) == matches
+
+
+def test_claim_by_priority_then_created(queue):
+    first = enqueue(queue)
+    urgent = enqueue(queue, priority=10)
+
+    assert queue.claim(ROUTE, "worker").item_id == urgent["task_id"]
+    assert queue.claim(ROUTE, "worker").item_id == first["task_id"]
+
+
+def test_ack_finishes_item(queue):
+    task = enqueue(queue)
+    item = queue.claim(ROUTE, "worker")
+
+    assert queue.ack(item.item_id, worker_name="worker",
+                     result={"success": True}, extra={"complect_id": 1})
+
+    state = queue.get(task["task_id"])
+    assert state["status"] == FINISHED
+    assert state["result"] == {"success": True}
+    assert state["extra"] == {"complect_id": 1}
+    assert state["lease_expires"] is None
+
+
+def test_ack_by_other_worker_is_rejected(queue):
+    task = enqueue(queue)
+    queue.claim(ROUTE, "worker")
+
+    assert not queue.ack(task["task_id"], worker_name="other", result={})
+    assert queue.get(task["task_id"])["status"] == WORKING
+
+
+def test_nack_fails_item(queue):
+    task = enqueue(queue)
+    queue.claim(ROUTE, "worker")
+
+    assert queue.nack(task["task_id"], worker_name="worker",
+                      errortext="boom")
+
+    state = queue.get(task["task_id"])
+    assert state["status"] == FAILED
+    assert state["errortext"] == "boom"
+
+
+def test_expired_lease_is_requeued():
+    queue = QueueMemoryBackend(lease_sec=0.01)
+    task = enqueue(queue)
+    queue.claim(ROUTE, "worker")
+    time.sleep(0.02)
+
+    assert queue.reap_expired(max_attempts=2) == 1
+
+    state = queue.get(task["task_id"])
+    assert state["status"] == ENQUEUED
+    assert state["locked_by"] is None
+    assert not queue.heartbeat(task["task_id"], "worker")
+
+
+def test_heartbeat_extends_lease():
+    queue = QueueMemoryBackend(lease_sec=0.05)
+    task = enqueue(queue)
+    queue.claim(ROUTE, "worker")
+    time.sleep(0.03)
+
+    assert queue.heartbeat(task["task_id"], "worker")
+    time.sleep(0.03)
+
+    assert queue.reap_expired(max_attempts=2) == 0
+
+
+def test_expired_lease_fails_after_attempts():
+    queue = QueueMemoryBackend(lease_sec=0.01)
+    task = enqueue(queue)
+    queue.claim(ROUTE, "worker")
+    time.sleep(0.02)
+
+    assert queue.reap_expired(max_attempts=1, result={"success": False}) == 1
+
+    state = queue.get(task["task_id"])
+    assert state["status"] == FAILED
+    assert state["result"] == {"success": False}
+
+
+def test_release_of_cancelled_item_writes_result(queue):
+    task = enqueue(queue)
+    queue.claim(ROUTE, "worker")
+    assert queue.cancel(task["task_id"]) == WORKING
+
+    assert queue.release_locked(
+        "worker", max_attempts=1, result={"success": False}
+    ) == 1
+
+    state = queue.get(task["task_id"])
+    assert state["status"] == "cancelled"
+    assert state["result"] == {"success": False}
+
+
+def test_coalesce_returns_enqueued_item(queue):
+    first = enqueue(queue, coalesce_key="key")
+    second = enqueue(queue, coalesce_key="key", priority=5)
+
+    assert second["task_id"] == first["task_id"]
+    assert queue.get(first["task_id"])["priority"] == 5
+
+
+def test_coalesce_merges_meta_and_extra(queue):
+    first = enqueue(queue, coalesce_key="key", priority=5,
+                    meta={"user": "a"}, extra={"complect_id": "1"})
+    enqueue(queue, coalesce_key="key", priority=1,
+            meta={"user": "b", "source": "ide"}, extra={"note": "x"})
+
+    state = queue.get(first["task_id"])
+    assert state["priority"] == 5
+    assert state["meta"] == {"user": "b", "source": "ide"}
+    assert state["extra"] == {"complect_id": "1", "note": "x"}
+
+
+def test_coalesce_skips_working_item(queue):
+    first = enqueue(queue, coalesce_key="key")
+    queue.claim(ROUTE, "worker")
+
+    second = enqueue(queue, coalesce_key="key")
+
+    assert second["task_id"] != first["task_id"]
+    assert queue.is_superseded(first["task_id"])
+
+
+def test_limit_max_working(queue):
+    limit = QueueLimit("host", ["worker-1", "worker-2"], max_working=1)
+    route = QueueRoute(item_type="compiler", limits=[limit])
+    first = enqueue(queue)
+    enqueue(queue)
+
+    assert queue.claim(route, "worker-1") is not None
+    assert queue.claim(route, "worker-2") is None
+
+    queue.ack(first["task_id"], worker_name="worker-1", result={})
+    assert queue.claim(route, "worker-2") is not None
+
+
+def test_limit_max_per_minute(queue):
+    limit = QueueLimit("host", ["worker"], max_per_minute=2)
+    route = QueueRoute(item_type="compiler", limits=[limit])
+    for _ in range(3):
+        enqueue(queue)
+
+    for _ in range(2):
+        item = queue.claim(route, "worker")
+        queue.ack(item.item_id, worker_name="worker", result={})
+
+    assert queue.claim(route, "worker") is None
+
+
+@pytest.fixture
+def fair_queue():
+    return QueueMemoryBackend(fair_share_keys=[("extra", "complect_id")])
+
+
+def test_fair_share_serves_other_owner_between_batch_items(fair_queue):
+    for _ in range(5):
+        enqueue(fair_queue, extra={"complect_id": "A"})
+    later = enqueue(fair_queue, extra={"complect_id": "B"})
+
+    owners = []
+    for _ in range(6):
+        item = fair_queue.claim(ROUTE, "worker")
+        owners.append(fair_queue.get(item.item_id)["extra"]["complect_id"])
+        fair_queue.ack(item.item_id, worker_name="worker", result={})
+
+    assert owners == ["A", "B", "A", "A", "A", "A"]
+    assert fair_queue.get(later["task_id"])["status"] == FINISHED
+
+
+def test_fair_share_prefers_owner_without_working_items(fair_queue):
+    for _ in range(5):
+        enqueue(fair_queue, extra={"complect_id": "A"})
+    fair_queue.claim(ROUTE, "worker-1")
+    later = enqueue(fair_queue, extra={"complect_id": "B"})
+
+    assert fair_queue.claim(ROUTE, "worker-2").item_id == later["task_id"]
+
+
+def test_fair_share_interleaves_owners_in_one_claim(fair_queue):
+    for _ in range(3):
+        enqueue(fair_queue, extra={"complect_id": "A"})
+    for _ in range(2):
+        enqueue(fair_queue, extra={"complect_id": "B"})
+
+    items = fair_queue.claim_many(ROUTE, "worker", limit=4)
+
+    owners = [fair_queue.get(it.item_id)["extra"]["complect_id"]
+              for it in items]
+    assert owners == ["A", "B", "A", "B"]
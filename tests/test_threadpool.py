@@ -0,0 +1,106 @@
+"""
+Отказ от зависшего обработчика-потока: аренда задачи больше не продлевается,
+слот обработчика занимает новый поток
+"""
+import threading
+import time
+
+from pyqu.cancel import TIMED_OUT, CancelToken
+from pyqu.core import QueueRoute, WorkerContext
+from pyqu.heartbeat import Heartbeat
+from pyqu.impl.process.threadpool import (ThreadPoolProcessBackend,
+                                          abandon_thread, is_abandoned)
+from pyqu.impl.queue.memory import QueueMemoryBackend
+
+
+def test_heartbeat_stops_after_stuck():
+    queue = QueueMemoryBackend()
+    queue.enqueue(script="scripts.compiler.run", type="compiler")
+    item = queue.claim(QueueRoute(item_type="compiler"), "worker")
+    token = CancelToken()
+    stuck = threading.Event()
+
+    with Heartbeat(queue, item.item_id, "worker", interval=0.01,
+                   cancel_token=token, timeout=0.02, grace=0.02,
+                   on_stuck=stuck.set):
+        assert stuck.wait(1)
+        lease = queue.get(item.item_id)["lease_expires"]
+        time.sleep(0.05)
+
+        assert queue.get(item.item_id)["lease_expires"] == lease
+
+    assert token.reason == TIMED_OUT
+
+
+def wait_started(started, count):
+    deadline = time.monotonic() + 1
+    while len(started) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert len(started) == count
+
+
+def test_abandoned_thread_is_replaced():
+    release = threading.Event()
+    started = []
+
+    def work(args):
+        started.append(threading.current_thread())
+        release.wait(1)
+
+    backend = ThreadPoolProcessBackend()
+    backend.init([WorkerContext(work)])
+    backend.start()
+    wait_started(started, 1)
+
+    stuck = started[0]
+    abandon_thread(stuck)
+    backend.handle_cycle()
+    wait_started(started, 2)
+
+    assert started[1] is not stuck
+    assert backend._threads[0].abandoned == 1
+
+    release.set()
+    stuck.join(1)
+    backend.handle_cycle()
+
+    assert backend._threads[0].abandoned == 0
+    assert not is_abandoned(stuck)
+
+
+def test_exited_thread_restarts_after_interval():
+    started = []
+
+    def work(args):
+        started.append(threading.current_thread())
+
+    backend = ThreadPoolProcessBackend()
+    backend.init([WorkerContext(work)])
+    backend._threads[0].min_restart_interval = 0.1
+    backend.start()
+
+    backend.wait(timeout=0.35)
+
+    assert 2 <= len(started) <= 5
+
+
+def test_abandon_wakes_supervisor():
+    release = threading.Event()
+    started = []
+
+    def work(args):
+        started.append(threading.current_thread())
+        release.wait(1)
+
+    backend = ThreadPoolProcessBackend()
+    backend.init([WorkerContext(work)])
+    backend.start()
+    wait_started(started, 1)
+
+    threading.Timer(0.05, abandon_thread, args=(started[0],)).start()
+    backend.wait(timeout=0.3)
+
+    assert len(started) == 2
+    assert backend._threads[0].abandoned == 1
+    release.set()
@@ -34,6 +34,10 @@ def uint_8_array_to_file(path, array):
 
 
 class TaskResult:
-    def __init__(self, result, extra=None):
+    def __init__(self, result, extra=None, status=None):
+        """
+        :param status: итоговый статус задачи, None - finished
+        """
         self.result = result
         self.extra = extra
+        self.status = status